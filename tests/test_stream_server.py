@@ -0,0 +1,62 @@
+"""End-to-end checks of tsq-stream-server.py over loopback QUIC"""
+import asyncio
+import importlib.util
+import os
+import ssl
+import sys
+import tempfile
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from aioquic.asyncio import connect
+from aioquic.quic.configuration import QuicConfiguration
+
+from tsq_codec import RESPONSE, decode_response, encode_request
+
+spec = importlib.util.spec_from_file_location("tsq_load_bench", os.path.join(ROOT, "tsq-load-bench.py"))
+load_bench = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(load_bench)
+
+# Loopback T2 should land within this of the client's send time
+T2_TOLERANCE_NS = 50_000_000
+
+@pytest.fixture(scope="module")
+def server():
+    with tempfile.TemporaryDirectory() as workdir:
+        proc = load_bench.ServerProcess(workdir, 1, [], os.path.join(workdir, "server.log"))
+        try:
+            proc.wait_ready()
+            yield proc
+        finally:
+            proc.stop()
+
+async def pipelined_exchange(port: int, gap: float):
+    """Send two requests gap seconds apart on one stream; return [(t1_ns, nonce, response)]"""
+    cfg = QuicConfiguration(is_client=True, alpn_protocols=["tsq/1"], verify_mode=ssl.CERT_NONE)
+    results = []
+    async with connect("127.0.0.1", port, configuration=cfg) as client:
+        reader, writer = await client.create_stream()
+        for i in range(2):
+            if i:
+                await asyncio.sleep(gap)
+            nonce = os.urandom(16)
+            writer.write(encode_request(nonce))
+            t1 = time.time_ns()
+            # Without FIN: the server must answer as soon as the request is whole
+            response = await asyncio.wait_for(reader.readexactly(RESPONSE.size), timeout=2.0)
+            results.append((t1, nonce, response))
+        writer.write_eof()
+        assert await asyncio.wait_for(reader.read(), timeout=2.0) == b""
+    return results
+
+def test_pipelined_requests_get_their_own_t2(server):
+    results = asyncio.run(pipelined_exchange(server.port, 0.3))
+    for t1, nonce, response in results:
+        echoed_nonce, t2, t3, _ = decode_response(response)
+        assert echoed_nonce == nonce
+        assert abs(t2 - t1) < T2_TOLERANCE_NS
+        assert t2 <= t3
@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+"""TSQ log analyzer: usage statistics from the servers' [TSQ-LOG] lines in one streaming pass.
+
+Reads the systemd journal (journalctl -o json) or log files, and with --checkpoint
+keeps its totals and read position so the next run only reads new lines.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import math
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+
+from tsq_metrics import Histogram
+
+MARKER = b"[TSQ-LOG] "
+# [TSQ-LOG] 2025-11-07 18:30:45.123 UTC key=value key="quoted value" ...
+LINE = re.compile(r"(\d{4}-\d\d-\d\d) (\d\d:\d\d:\d\d(?:\.\d+)?) UTC (.*)")
+FIELD = re.compile(r'(\w+)=(?:"([^"]*)"|(\S+))')
+DURATION = re.compile(r"([\d.]+)ms")
+
+DEFAULT_UNITS = ("tsq-datagram", "tsq-stream")
+CHECKPOINT_VERSION = 1
+# Fixed bounds on per-key state, so memory does not grow with the log
+MAX_ERRORS = 200       # distinct error texts; the rest count as "(other)"
+CLIENT_COUNTERS = 200  # clients tracked for the top-clients list (Space-Saving)
+HLL_BITS = 12          # HyperLogLog registers (2**12) for unique clients, ~1.6% error
+
+class UniqueCounter:
+    """HyperLogLog estimate of the number of distinct strings in fixed memory"""
+
+    def __init__(self, registers: bytes = None):
+        self.registers = bytearray(registers or bytes(1 << HLL_BITS))
+
+    def add(self, value: str):
+        h = int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+        index = h >> (64 - HLL_BITS)
+        rest = h & ((1 << (64 - HLL_BITS)) - 1)
+        rank = (64 - HLL_BITS) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def estimate(self) -> int:
+        m = len(self.registers)
+        raw = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * m and zeros:
+            # Small-range correction (linear counting)
+            return round(m * math.log(m / zeros))
+        return round(raw)
+
+class TopCounter:
+    """Counts of the most frequent keys in a fixed number of counters.
+
+    When the counters are full, the smaller half is dropped. Counts are exact
+    until then; afterwards a count may be short by at most dropped (the largest
+    count ever dropped), and no key outside the list has more than that.
+    """
+
+    def __init__(self, counts: dict = None, dropped: int = 0):
+        self.counts = counts or {}
+        self.dropped = dropped
+
+    def add(self, key: str, n: int = 1):
+        counts = self.counts
+        if key not in counts and len(counts) >= CLIENT_COUNTERS:
+            ranked = sorted(counts.items(), key=lambda item: -item[1])
+            half = CLIENT_COUNTERS // 2
+            self.dropped = max(self.dropped, ranked[half][1])
+            counts = self.counts = dict(ranked[:half])
+        counts[key] = counts.get(key, 0) + n
+
+    def top(self, count: int) -> list:
+        return sorted(self.counts.items(), key=lambda item: -item[1])[:count]
+
+class Stats:
+    """Running totals over [TSQ-LOG] lines; to_dict()/from_dict() carry them between runs"""
+
+    def __init__(self):
+        self.lines = 0
+        self.unparsed = 0
+        self.first = None
+        self.last = None
+        self.sessions = {}    # protocol -> sessions
+        self.queries = {}     # protocol -> queries in those sessions
+        self.failed = {}      # protocol -> failed requests
+        self.errors = {}      # error text -> count
+        self.durations = {}   # protocol -> Histogram of session durations (us)
+        self.daily = {}       # date -> [sessions, queries, failed]
+        self.rollups = 0
+        self.last_rollup = None
+        self.clients = UniqueCounter()
+        self.top_clients = TopCounter()
+
+    def add_line(self, text: str):
+        """Account for one log line (the text after "[TSQ-LOG] ")"""
+        self.lines += 1
+        match = LINE.match(text)
+        if match is None:
+            self.unparsed += 1
+            return
+        date, clock, rest = match.groups()
+        fields = {key: quoted or plain for key, quoted, plain in FIELD.findall(rest)}
+        protocol = fields.get("protocol")
+        if not protocol:
+            self.unparsed += 1
+            return
+        stamp = f"{date} {clock}"
+        if self.first is None or stamp < self.first:
+            self.first = stamp
+        if self.last is None or stamp > self.last:
+            self.last = stamp
+        if protocol == "all":
+            # Periodic --workers rollup of the server's counters
+            self.rollups += 1
+            self.last_rollup = stamp + " " + rest
+            return
+        day = self.daily.get(date)
+        if day is None:
+            day = self.daily[date] = [0, 0, 0]
+        client = fields.get("client")
+        if "status" in fields:
+            if fields["status"] != "FAILED":
+                return
+            self.failed[protocol] = self.failed.get(protocol, 0) + 1
+            day[2] += 1
+            error = fields.get("error", "")
+            if error not in self.errors and len(self.errors) >= MAX_ERRORS:
+                error = "(other)"
+            self.errors[error] = self.errors.get(error, 0) + 1
+        elif "queries" in fields:
+            try:
+                queries = int(fields["queries"])
+                duration = DURATION.fullmatch(fields.get("duration", ""))
+                duration_us = round(float(duration.group(1)) * 1000) if duration else None
+            except ValueError:
+                self.unparsed += 1
+                return
+            self.sessions[protocol] = self.sessions.get(protocol, 0) + 1
+            self.queries[protocol] = self.queries.get(protocol, 0) + queries
+            day[0] += 1
+            day[1] += queries
+            if duration_us is not None:
+                hist = self.durations.get(protocol)
+                if hist is None:
+                    hist = self.durations[protocol] = Histogram()
+                hist.record(duration_us)
+            if client:
+                self.top_clients.add(client, queries)
+        else:
+            self.unparsed += 1
+            return
+        if client:
+            self.clients.add(client)
+
+    def to_dict(self) -> dict:
+        state = {key: getattr(self, key) for key in (
+            "lines", "unparsed", "first", "last", "sessions", "queries", "failed", "errors",
+            "daily", "rollups", "last_rollup")}
+        state["durations"] = {protocol: hist.to_dict() for protocol, hist in self.durations.items()}
+        state["clients"] = base64.b64encode(self.clients.registers).decode()
+        state["top_clients"] = {"counts": self.top_clients.counts, "dropped": self.top_clients.dropped}
+        return state
+
+    @classmethod
+    def from_dict(cls, state: dict) -> "Stats":
+        stats = cls()
+        for key, value in state.items():
+            if key == "durations":
+                stats.durations = {protocol: Histogram.from_dict(h) for protocol, h in value.items()}
+            elif key == "clients":
+                stats.clients = UniqueCounter(base64.b64decode(value))
+            elif key == "top_clients":
+                stats.top_clients = TopCounter(value["counts"], value["dropped"])
+            else:
+                setattr(stats, key, value)
+        return stats
+
+    def report(self, top: int) -> dict:
+        protocols = sorted(set(self.sessions) | set(self.failed))
+        report = {
+            "lines": self.lines,
+            "unparsed": self.unparsed,
+            "first": self.first,
+            "last": self.last,
+            "protocols": {},
+            "errors": dict(sorted(self.errors.items(), key=lambda item: -item[1])),
+            "daily": {day: dict(zip(("sessions", "queries", "failed"), counts))
+                      for day, counts in sorted(self.daily.items())},
+            "unique_clients": self.clients.estimate(),
+            "top_clients": dict(self.top_clients.top(top)),
+            "top_clients_max_error": self.top_clients.dropped,
+            "worker_rollups": self.rollups,
+            "last_rollup": self.last_rollup,
+        }
+        for protocol in protocols:
+            hist = self.durations.get(protocol) or Histogram()
+            sessions = self.sessions.get(protocol, 0)
+            report["protocols"][protocol] = {
+                "sessions": sessions,
+                "queries": self.queries.get(protocol, 0),
+                "failed": self.failed.get(protocol, 0),
+                "queries_per_session": self.queries.get(protocol, 0) / sessions if sessions else 0,
+                "duration_ms": {
+                    "mean": hist.sum / hist.count / 1000 if hist.count else 0,
+                    **{f"p{q:g}": hist.percentile(q) / 1000 for q in (50, 90, 99, 99.9)},
+                    "max": hist.max / 1000,
+                },
+            }
+        return report
+
+def print_report(report: dict):
+    print("==========================================")
+    print("TSQ Server Usage Statistics")
+    print("==========================================")
+    if not report["lines"]:
+        print("No [TSQ-LOG] lines found.")
+        return
+    print(f"Log lines: {report['lines']} ({report['unparsed']} unparsed), "
+          f"{report['first']} to {report['last']} UTC")
+    print()
+    print("=== By Protocol ===")
+    print(f"  {'protocol':<10} {'sessions':>10} {'queries':>12} {'failed':>10} {'q/session':>10}")
+    for protocol, p in report["protocols"].items():
+        print(f"  {protocol:<10} {p['sessions']:>10} {p['queries']:>12} {p['failed']:>10} "
+              f"{p['queries_per_session']:>10.1f}")
+    print()
+    # The servers log one line per session, not per query, so these are
+    # percentiles of whole session lengths rather than query latencies
+    print("=== Session Duration (ms; whole sessions, not per-query latency) ===")
+    print(f"  {'protocol':<10} {'mean':>9} {'p50':>9} {'p90':>9} {'p99':>9} {'p99.9':>9} {'max':>9}")
+    for protocol, p in report["protocols"].items():
+        d = p["duration_ms"]
+        print(f"  {protocol:<10} {d['mean']:>9.1f} {d['p50']:>9.1f} {d['p90']:>9.1f} {d['p99']:>9.1f} "
+              f"{d['p99.9']:>9.1f} {d['max']:>9.1f}")
+    print()
+    if report["errors"]:
+        print("=== Errors ===")
+        for error, count in report["errors"].items():
+            print(f"  {error or '(no message)'}: {count}")
+        print()
+    if report["top_clients"]:
+        print("=== Clients (datagram server only) ===")
+        print(f"  Unique IP addresses: ~{report['unique_clients']}")
+        if report["top_clients_max_error"]:
+            print(f"  (query counts below may be short by up to {report['top_clients_max_error']})")
+        for client, queries in report["top_clients"].items():
+            print(f"  {client}: {queries} queries")
+        print()
+    print("=== Daily Activity ===")
+    for day, counts in report["daily"].items():
+        print(f"  {day}: {counts['sessions']} sessions, {counts['queries']} queries, {counts['failed']} failed")
+    if report["last_rollup"]:
+        print()
+        print(f"=== Latest Worker Rollup ({report['worker_rollups']} lines) ===")
+        print(f"  {report['last_rollup']}")
+    print("==========================================")
+
+def message_text(raw: bytes):
+    """The [TSQ-LOG] text of one input line (plain or journalctl JSON), or None"""
+    if raw[:1] == b"{":
+        try:
+            message = json.loads(raw).get("MESSAGE")
+        except (ValueError, AttributeError):
+            return None
+        if isinstance(message, list):
+            # journald exports non-UTF-8 messages as byte arrays
+            message = bytes(message).decode("utf-8", "replace")
+        if not isinstance(message, str):
+            return None
+        raw = message.encode()
+    start = raw.find(MARKER)
+    if start < 0:
+        return None
+    return raw[start + len(MARKER):].rstrip(b"\r\n").decode("utf-8", "replace")
+
+def scan(stream, stats: Stats):
+    """Feed complete lines from a binary stream to stats; returns (bytes consumed, last line)"""
+    consumed = 0
+    last = None
+    for raw in stream:
+        if not raw.endswith(b"\n"):
+            # Still being written: leave it for the next run
+            break
+        consumed += len(raw)
+        last = raw
+        if MARKER in raw:
+            text = message_text(raw)
+            if text is not None:
+                stats.add_line(text)
+    return consumed, last
+
+def read_file(path: str, stats: Stats, positions: dict):
+    """Read path from its checkpointed offset, or from the start if it was rotated"""
+    if path == "-":
+        scan(sys.stdin.buffer, stats)
+        return
+    with open(path, "rb") as f:
+        st = os.fstat(f.fileno())
+        saved = positions.get(os.path.abspath(path))
+        offset = 0
+        if saved and saved["inode"] == st.st_ino and saved["offset"] <= st.st_size:
+            offset = saved["offset"]
+        f.seek(offset)
+        consumed, _ = scan(f, stats)
+    positions[os.path.abspath(path)] = {"inode": st.st_ino, "offset": offset + consumed}
+
+def read_journal(args, stats: Stats, cursor):
+    """Stream journalctl -o json for the units; returns the cursor of the last entry read"""
+    command = ["journalctl", "-o", "json", "--no-pager"]
+    for unit in args.unit or DEFAULT_UNITS:
+        command += ["-u", unit]
+    command += [f"--after-cursor={cursor}"] if cursor else ["--since", args.since]
+    # stderr goes to a file: a pipe nobody reads until stdout ends could fill
+    # up and block journalctl
+    with tempfile.TemporaryFile() as stderr:
+        try:
+            proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr)
+        except FileNotFoundError:
+            print("Error: journalctl not found; pass log files instead", file=sys.stderr)
+            sys.exit(1)
+        _, last = scan(proc.stdout, stats)
+        if proc.wait() != 0:
+            stderr.seek(0)
+            error = stderr.read().decode(errors="replace").strip()
+            print(f"Error: journalctl failed: {error}", file=sys.stderr)
+            sys.exit(1)
+    if last is not None:
+        try:
+            return json.loads(last)["__CURSOR"]
+        except (ValueError, KeyError):
+            pass
+    return cursor
+
+def load_checkpoint(path: str) -> dict:
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"Error: Cannot read checkpoint {path}: {e}", file=sys.stderr)
+        sys.exit(1)
+    if state.get("version") != CHECKPOINT_VERSION:
+        print(f"Error: Checkpoint {path} is from another version; use --reset", file=sys.stderr)
+        sys.exit(1)
+    return state
+
+def save_checkpoint(path: str, state: dict):
+    """Write the checkpoint atomically"""
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f, separators=(",", ":"))
+    os.replace(tmp, path)
+
+def main():
+    ap = argparse.ArgumentParser(description="Usage statistics from TSQ server [TSQ-LOG] lines")
+    ap.add_argument("files", nargs="*", metavar="FILE",
+                    help="Log files, plain or journalctl -o json ('-' for stdin; default: read the journal)")
+    ap.add_argument("--unit", "-u", action="append", metavar="UNIT",
+                    help=f"systemd unit to read from the journal (repeatable; default: {' '.join(DEFAULT_UNITS)})")
+    ap.add_argument("--since", default="7 days ago",
+                    help="Journal start when there is no checkpoint cursor (default: '7 days ago')")
+    ap.add_argument("--checkpoint", metavar="FILE",
+                    help="Keep totals and read positions here; re-runs only read new lines")
+    ap.add_argument("--reset", action="store_true", help="Ignore the existing checkpoint and start over")
+    ap.add_argument("--top", type=int, default=10, help="Top clients to list (default: 10)")
+    ap.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = ap.parse_args()
+
+    if args.top < 0 or args.top > CLIENT_COUNTERS:
+        print(f"Error: Top must be between 0 and {CLIENT_COUNTERS}", file=sys.stderr)
+        sys.exit(1)
+
+    state = load_checkpoint(args.checkpoint) if args.checkpoint and not args.reset else {}
+    stats = Stats.from_dict(state["stats"]) if "stats" in state else Stats()
+    positions = state.get("files", {})
+    cursor = state.get("cursor")
+
+    if args.files:
+        for path in args.files:
+            try:
+                read_file(path, stats, positions)
+            except OSError as e:
+                print(f"Error: Cannot read {path}: {e}", file=sys.stderr)
+                sys.exit(1)
+    else:
+        cursor = read_journal(args, stats, cursor)
+
+    if args.checkpoint:
+        save_checkpoint(args.checkpoint, {
+            "version": CHECKPOINT_VERSION,
+            "updated": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "cursor": cursor,
+            "files": positions,
+            "stats": stats.to_dict(),
+        })
+
+    report = stats.report(args.top)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+if __name__ == "__main__":
+    main()
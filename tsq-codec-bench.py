@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""Microbenchmark: TSQ message encode/decode with tsq_codec vs the previous inline code,
+and the cost of signed (TLV 255) responses"""
+import argparse
+import asyncio
+import os
+import struct
+import time
+import timeit
+
+from tsq_codec import (
+    T_SIGNATURE_REQUEST,
+    ResponseEncoder,
+    decode_request,
+    decode_response,
+    encode_request,
+    ns_to_ntp,
+    ntp_to_ns,
+)
+from tsq_sign import ALG_ED25519, ALG_HMAC_SHA256, ResponseSigner, ResponseVerifier, key_id, raw_public_bytes
+
+# --- Previous implementation (server build_response, client response parsing) ---
+
+LEGACY_NTP_EPOCH_OFFSET = 2208988800
+
+def legacy_tlv_unpack(data):
+    if len(data) < 2:
+        raise ValueError("TLV too short")
+    t = data[0]
+    l = data[1]
+    if len(data) < 2 + l:
+        raise ValueError("TLV length mismatch")
+    return t, data[2:2+l], 2 + l
+
+def legacy_tlv_pack(t, v):
+    if len(v) > 255:
+        raise ValueError("TLV value too long (max 255 bytes)")
+    return struct.pack("!BB", t, len(v)) + v
+
+def legacy_parse_tlvs(data):
+    tlvs = []
+    offset = 0
+    while offset < len(data):
+        t, v, consumed = legacy_tlv_unpack(data[offset:])
+        tlvs.append((t, v))
+        offset += consumed
+    return tlvs
+
+def legacy_ns_to_ntp(ns_timestamp):
+    seconds = ns_timestamp // 1_000_000_000
+    nanos = ns_timestamp % 1_000_000_000
+    ntp_seconds = seconds + LEGACY_NTP_EPOCH_OFFSET
+    ntp_fraction = int((nanos * 2**32) / 1_000_000_000)
+    return struct.pack("!II", ntp_seconds, ntp_fraction)
+
+def legacy_build_response(message, t1_recv):
+    tlvs = legacy_parse_tlvs(message)
+    if not tlvs or tlvs[0][0] != 1 or len(tlvs[0][1]) != 16:
+        raise ValueError("Missing nonce")
+    nonce = tlvs[0][1]
+    response = b""
+    response += legacy_tlv_pack(1, nonce)
+    response += legacy_tlv_pack(2, legacy_ns_to_ntp(t1_recv))
+    response += legacy_tlv_pack(3, legacy_ns_to_ntp(time.time_ns()))
+    return response
+
+def legacy_decode_response(response_data):
+    offset = 0
+    echoed_nonce = t2_ntp = t3_ntp = None
+    while offset < len(response_data):
+        if offset + 2 > len(response_data):
+            break
+        tlv_type = response_data[offset]
+        tlv_len = response_data[offset + 1]
+        tlv_val = response_data[offset + 2:offset + 2 + tlv_len]
+        if tlv_type == 1:
+            echoed_nonce = tlv_val
+        elif tlv_type == 2:
+            t2_ntp = tlv_val
+        elif tlv_type == 3:
+            t3_ntp = tlv_val
+        offset += 2 + tlv_len
+    ntp_seconds, ntp_fraction = struct.unpack("!II", t2_ntp)
+    t2 = (ntp_seconds - LEGACY_NTP_EPOCH_OFFSET) * 1_000_000_000 + int((ntp_fraction * 1_000_000_000) / 2**32)
+    ntp_seconds, ntp_fraction = struct.unpack("!II", t3_ntp)
+    t3 = (ntp_seconds - LEGACY_NTP_EPOCH_OFFSET) * 1_000_000_000 + int((ntp_fraction * 1_000_000_000) / 2**32)
+    return echoed_nonce, t2, t3
+
+# --- Benchmark ---
+
+def rate(stmt, number: int, repeat: int) -> float:
+    """Best-of-repeat operations per second"""
+    return number / min(timeit.repeat(stmt, number=number, repeat=repeat))
+
+def check_round_trip(samples: int):
+    """Integer conversion must round-trip every nanosecond exactly"""
+    base = time.time_ns()
+    for ns in [base + i * 7919 for i in range(samples)] + [base - base % 1_000_000_000 + 999_999_999]:
+        assert ntp_to_ns(ns_to_ntp(ns)) == ns, ns
+    legacy_errors = 0
+    for i in range(samples):
+        ns = base + i * 7919
+        ntp_seconds, ntp_fraction = struct.unpack("!II", legacy_ns_to_ntp(ns))
+        back = (ntp_seconds - LEGACY_NTP_EPOCH_OFFSET) * 1_000_000_000 + int((ntp_fraction * 1_000_000_000) / 2**32)
+        legacy_errors += back != ns
+    return legacy_errors
+
+def main():
+    ap = argparse.ArgumentParser(description="TSQ codec microbenchmark")
+    ap.add_argument("--number", type=int, default=200_000, help="Operations per timing run (default: 200000)")
+    ap.add_argument("--repeat", type=int, default=5, help="Timing runs, best is reported (default: 5)")
+    args = ap.parse_args()
+
+    nonce = os.urandom(16)
+    request = encode_request(nonce)
+    t2 = time.time_ns()
+    encoder = ResponseEncoder()
+    response = bytes(encoder.encode(nonce, t2, time.time_ns()))
+    assert legacy_build_response(request, t2)[:20] == response[:20]
+    assert decode_response(response)[:2] == (nonce, t2)
+    assert legacy_decode_response(response)[0] == nonce
+
+    legacy_errors = check_round_trip(100_000)
+    print(f"NTP round trip: tsq_codec exact, previous code inexact in {legacy_errors}/100000 samples")
+    print()
+
+    cases = [
+        ("server encode (parse request + build response)",
+         lambda: legacy_build_response(request, t2),
+         lambda: encoder.encode(decode_request(request)[0], t2, time.time_ns())),
+        ("client decode (parse response + NTP->ns)",
+         lambda: legacy_decode_response(response),
+         lambda: decode_response(response)),
+    ]
+    print(f"{'operation':<50} {'previous/s':>12} {'tsq_codec/s':>12} {'speedup':>8}")
+    for name, legacy, current in cases:
+        legacy_rate = rate(legacy, args.number, args.repeat)
+        current_rate = rate(current, args.number, args.repeat)
+        print(f"{name:<50} {legacy_rate:>12,.0f} {current_rate:>12,.0f} {current_rate / legacy_rate:>7.2f}x")
+
+    bench_signatures(args.number, args.repeat)
+
+def make_signers():
+    """Throwaway HMAC and Ed25519 signers with matching verifiers"""
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+    secret = os.urandom(32)
+    private_key = Ed25519PrivateKey.generate()
+    public_key = private_key.public_key()
+    hmac_verifier, ed_verifier = ResponseVerifier(), ResponseVerifier()
+    hmac_verifier.keys[key_id(secret)] = (ALG_HMAC_SHA256, secret)
+    ed_verifier.keys[key_id(raw_public_bytes(public_key))] = (ALG_ED25519, public_key)
+    return [
+        ("HMAC-SHA256", ResponseSigner(ALG_HMAC_SHA256, secret, key_id(secret)), hmac_verifier),
+        ("Ed25519", ResponseSigner(ALG_ED25519, private_key, key_id(raw_public_bytes(public_key))), ed_verifier),
+    ]
+
+async def signed_rate(signer, response: bytes, count: int) -> float:
+    """Responses per second through ResponseSigner.sign() with count requests in flight"""
+    start = time.perf_counter()
+    await asyncio.gather(*(signer.sign(response) for _ in range(count)))
+    return count / (time.perf_counter() - start)
+
+def bench_signatures(number: int, repeat: int):
+    """Per-query server and client cost of signed vs unsigned responses"""
+    nonce = os.urandom(16)
+    request = encode_request(nonce, {T_SIGNATURE_REQUEST})
+    encoder = ResponseEncoder()
+    t2 = time.time_ns()
+    number = max(number // 10, 1000)
+
+    unsigned = lambda: encoder.encode(decode_request(request)[0], t2, time.time_ns())
+    unsigned_rate = rate(unsigned, number, repeat)
+    response = bytes(unsigned())
+    decode_rate = rate(lambda: decode_response(response), number, repeat)
+
+    print()
+    print(f"{'signed responses':<34} {'server q/s':>12} {'vs unsigned':>12} {'batched q/s':>12} {'client q/s':>12}")
+    print(f"{'unsigned':<34} {unsigned_rate:>12,.0f} {'1.00x':>12} {'-':>12} {decode_rate:>12,.0f}")
+    for name, signer, verifier in make_signers():
+        build = lambda: signer.sign_now(encoder.encode(decode_request(request)[0], t2, time.time_ns()).tobytes())
+        server_rate = rate(build, number, repeat)
+        batched = "-" if signer.inline else f"{asyncio.run(signed_rate(signer, response, number)):,.0f}"
+        signed = signer.sign_now(response)
+
+        def check():
+            decode_response(signed)
+            verifier.verify(signed)
+
+        client_rate = rate(check, number, repeat)
+        print(f"{name:<34} {server_rate:>12,.0f} {server_rate / unsigned_rate:>11.2f}x "
+              f"{batched:>12} {client_rate:>12,.0f}")
+        signer.close()
+    print("(server q/s: build + sign inline; batched: Ed25519 signed in batches on the worker thread;"
+          " client q/s: decode + verify)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+"""Load generator for tsq-stream-server.py: starts the server on loopback with a
+throwaway self-signed certificate, drives concurrent clients and reports
+throughput, latency percentiles, server CPU per query, RSS and handshake rate as JSON"""
+import argparse
+import asyncio
+import dataclasses
+import datetime
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+
+from tsq_codec import T_ERROR, T_NONCE, TSQError, decode_response, encode_request
+from tsq_metrics import Histogram
+
+PATTERNS = ("new", "reused", "pipelined")
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tsq-stream-server.py")
+ALPN = ["tsq/1"]
+QUERY_TIMEOUT = 5.0
+
+# --- Server side: certificate, process, /proc and /metrics sampling ---
+
+def write_self_signed_cert(directory: str):
+    """Write a P-256 certificate and key for 127.0.0.1 and return their paths"""
+    import ipaddress
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "tsq-load-bench")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]),
+                       critical=False)
+        .sign(key, hashes.SHA256())
+    )
+    cert_path = os.path.join(directory, "server.crt")
+    key_path = os.path.join(directory, "server.key")
+    with open(cert_path, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return cert_path, key_path
+
+def free_port(kind: int, count: int = 1) -> int:
+    """A port with count consecutive free ports of the given socket type on loopback"""
+    for _ in range(50):
+        with socket.socket(socket.AF_INET, kind) as s:
+            s.bind(("127.0.0.1", 0))
+            base = s.getsockname()[1]
+        if base + count > 65536:
+            continue
+        try:
+            for port in range(base, base + count):
+                with socket.socket(socket.AF_INET, kind) as s:
+                    s.bind(("127.0.0.1", port))
+            return base
+        except OSError:
+            continue
+    raise RuntimeError("no free port range on 127.0.0.1")
+
+def process_tree(pid: int) -> list:
+    """pid and all of its descendants (Linux /proc)"""
+    pids = [pid]
+    for p in pids:
+        try:
+            for task in os.listdir(f"/proc/{p}/task"):
+                with open(f"/proc/{p}/task/{task}/children") as f:
+                    pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+def tree_usage(pid: int):
+    """(CPU seconds, RSS bytes, peak RSS bytes) summed over the process tree, or Nones off Linux"""
+    if not os.path.isdir(f"/proc/{pid}"):
+        return None, None, None
+    ticks = os.sysconf("SC_CLK_TCK")
+    cpu = rss = peak = 0
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{p}/status") as f:
+                status = dict(line.split(":", 1) for line in f if ":" in line)
+        except OSError:
+            continue
+        # utime and stime are fields 14 and 15 of stat; fields[0] here is field 3
+        cpu += (int(fields[11]) + int(fields[12])) / ticks
+        rss += int(status.get("VmRSS", "0 kB").split()[0]) * 1024
+        peak += int(status.get("VmHWM", "0 kB").split()[0]) * 1024
+    return cpu, rss, peak
+
+def scrape_metrics(ports) -> dict:
+    """Sum tsq_* samples across the metrics endpoints of every worker"""
+    totals = {}
+    for port in ports:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=2.0) as response:
+            text = response.read().decode()
+        for line in text.splitlines():
+            if not line or line.startswith("#"):
+                continue
+            name, _, value = line.rpartition(" ")
+            totals[name] = totals.get(name, 0.0) + float(value)
+    return totals
+
+def metric_sum(metrics: dict, prefix: str) -> float:
+    return sum(value for name, value in metrics.items() if name == prefix or name.startswith(prefix + "{"))
+
+class ServerProcess:
+    """tsq-stream-server.py running on loopback with its metrics endpoint enabled"""
+
+    def __init__(self, workdir: str, workers: int, extra_args, log_path: str):
+        self.workers = workers
+        self.port = free_port(socket.SOCK_DGRAM)
+        metrics_port = free_port(socket.SOCK_STREAM, workers)
+        self.metrics_ports = [metrics_port + i for i in range(workers)]
+        cert, key = write_self_signed_cert(workdir)
+        self.args = ["--host", "127.0.0.1", "--port", str(self.port), "--cert", cert, "--key", key,
+                     "--workers", str(workers), "--metrics-port", str(metrics_port), *extra_args]
+        self.log = open(log_path, "w")
+        self.proc = subprocess.Popen([sys.executable, SERVER_SCRIPT, *self.args],
+                                     stdout=self.log, stderr=subprocess.STDOUT)
+
+    def wait_ready(self, timeout: float = 15.0):
+        deadline = time.monotonic() + timeout
+        while True:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"server exited with code {self.proc.returncode}, see {self.log.name}")
+            try:
+                return scrape_metrics(self.metrics_ports)
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"server did not start within {timeout:g}s, see {self.log.name}")
+                time.sleep(0.1)
+
+    def sample(self) -> dict:
+        cpu, rss, peak = tree_usage(self.proc.pid)
+        metrics = scrape_metrics(self.metrics_ports)
+        return {
+            "time": time.monotonic(),
+            "cpu": cpu,
+            "rss": rss,
+            "peak_rss": peak,
+            "queries": metric_sum(metrics, "tsq_queries_total"),
+            "handshakes": metric_sum(metrics, "tsq_handshakes_total"),
+            "rejected": metric_sum(metrics, "tsq_rejected_total"),
+        }
+
+    def stop(self):
+        self.proc.terminate()
+        try:
+            self.proc.wait(10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self.log.close()
+
+# --- Client side: one load generator process drives a share of the connections ---
+
+def split_responses(buffer: bytearray):
+    """Pop complete responses off the front of a pipelined stream buffer.
+
+    A response starts with a Nonce TLV, or is a lone Error TLV, so a message runs
+    to the next such TLV. The last message is complete only once the stream ends,
+    which the caller handles.
+    """
+    messages = []
+    start = offset = 0
+    while offset + 2 <= len(buffer) and offset + 2 + buffer[offset + 1] <= len(buffer):
+        if buffer[offset] in (T_NONCE, T_ERROR) and offset > start:
+            messages.append(bytes(buffer[start:offset]))
+            start = offset
+        offset += 2 + buffer[offset + 1]
+    del buffer[:start]
+    return messages
+
+class LoadStats:
+    """What one generator process measured inside the measurement window"""
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.handshake = Histogram()
+        self.queries = 0
+        self.errors = 0
+        self.handshakes = 0
+        self.cpu = 0.0
+
+    def merge(self, other: "LoadStats"):
+        self.latency.merge(other.latency)
+        self.handshake.merge(other.handshake)
+        self.queries += other.queries
+        self.errors += other.errors
+        self.handshakes += other.handshakes
+        self.cpu += other.cpu
+
+class LoadGenerator:
+    def __init__(self, pattern: str, port: int, depth: int, resume: bool, window):
+        from aioquic.quic.configuration import QuicConfiguration
+        self.pattern = pattern
+        self.port = port
+        self.depth = depth
+        self.resume = resume
+        self.ticket = None
+        self.measure_start, self.measure_end = window
+        self.stats = LoadStats()
+        self.configuration = QuicConfiguration(is_client=True, alpn_protocols=ALPN, verify_mode=False)
+
+    def measuring(self, when: float) -> bool:
+        return self.measure_start <= when < self.measure_end
+
+    def record(self, sent_ns: int, response: bytes, nonce: bytes):
+        """Count one response received now for a request written at sent_ns"""
+        done_ns = time.perf_counter_ns()
+        if not self.measuring(time.time()):
+            return
+        try:
+            ok = decode_response(response)[0] == nonce
+        except TSQError:
+            ok = False
+        if ok:
+            self.stats.queries += 1
+            self.stats.latency.record(done_ns - sent_ns)
+        else:
+            self.stats.errors += 1
+
+    def fail(self, count: int = 1):
+        if self.measuring(time.time()):
+            self.stats.errors += count
+
+    async def connect(self):
+        """Open a connection and return (protocol, exit stack), counting the handshake"""
+        from contextlib import AsyncExitStack
+        from aioquic.asyncio.client import connect
+        configuration = self.configuration
+        if self.resume and self.ticket is not None:
+            configuration = dataclasses.replace(configuration, session_ticket=self.ticket)
+        stack = AsyncExitStack()
+        start = time.perf_counter_ns()
+        client = await stack.enter_async_context(connect(
+            "127.0.0.1", self.port, configuration=configuration,
+            session_ticket_handler=self.store_ticket if self.resume else None,
+        ))
+        if self.measuring(time.time()):
+            self.stats.handshakes += 1
+            self.stats.handshake.record(time.perf_counter_ns() - start)
+        return client, stack
+
+    def store_ticket(self, ticket):
+        self.ticket = ticket
+
+    async def query(self, client):
+        """One request on a new stream of client"""
+        nonce = os.urandom(16)
+        reader, writer = await client.create_stream()
+        sent = time.perf_counter_ns()
+        writer.write(encode_request(nonce))
+        writer.write_eof()
+        response = await asyncio.wait_for(reader.read(), QUERY_TIMEOUT)
+        self.record(sent, response, nonce)
+
+    async def pipeline(self, client):
+        """depth requests written back to back on one stream, answered in order"""
+        nonces = [os.urandom(16) for _ in range(self.depth)]
+        reader, writer = await client.create_stream()
+        sent = time.perf_counter_ns()
+        writer.write(b"".join(encode_request(nonce) for nonce in nonces))
+        writer.write_eof()
+        buffer = bytearray()
+        answered = 0
+        while True:
+            chunk = await asyncio.wait_for(reader.read(65536), QUERY_TIMEOUT)
+            buffer += chunk
+            messages = split_responses(buffer)
+            if not chunk and buffer:
+                messages.append(bytes(buffer))
+            for message in messages[:self.depth - answered]:
+                self.record(sent, message, nonces[answered])
+                answered += 1
+            if not chunk:
+                break
+        self.fail(self.depth - answered)
+
+    async def client_loop(self):
+        deadline = self.measure_end
+        stack = None
+        client = None
+        while time.time() < deadline:
+            try:
+                if client is None:
+                    client, stack = await self.connect()
+                if self.pattern == "pipelined":
+                    await self.pipeline(client)
+                else:
+                    await self.query(client)
+                if self.pattern == "new":
+                    await stack.aclose()
+                    client = None
+            except (ConnectionError, asyncio.TimeoutError, RuntimeError):
+                self.fail()
+                if stack is not None:
+                    await stack.aclose()
+                client = None
+        if client is not None:
+            await stack.aclose()
+
+    async def run(self, connections: int) -> LoadStats:
+        clients = asyncio.gather(*(self.client_loop() for _ in range(connections)))
+        # Sample this process's CPU time at the window edges, as the server's is sampled
+        await asyncio.sleep(max(self.measure_start - time.time(), 0))
+        cpu_start = time.process_time()
+        await asyncio.sleep(max(self.measure_end - time.time(), 0))
+        self.stats.cpu = time.process_time() - cpu_start
+        await clients
+        return self.stats
+
+def generate(pattern, port, connections, depth, resume, window) -> LoadStats:
+    """Entry point of one load generator process"""
+    return asyncio.run(LoadGenerator(pattern, port, depth, resume, window).run(connections))
+
+# --- Orchestration and reporting ---
+
+def ms(ns: int) -> float:
+    return round(ns / 1e6, 4)
+
+def run_pattern(server: ServerProcess, executor, pattern: str, args) -> dict:
+    """Run one pattern for --warmup + --duration seconds and summarise the window"""
+    start = time.time() + 0.5
+    window = (start + args.warmup, start + args.warmup + args.duration)
+    shares = [args.connections // args.processes + (i < args.connections % args.processes)
+              for i in range(args.processes)]
+    futures = [executor.submit(generate, pattern, server.port, n, args.pipeline_depth, args.resume, window)
+               for n in shares if n]
+    time.sleep(max(window[0] - time.time(), 0))
+    before = server.sample()
+    time.sleep(max(window[1] - time.time(), 0))
+    after = server.sample()
+    stats = LoadStats()
+    for future in futures:
+        stats.merge(future.result())
+
+    elapsed = after["time"] - before["time"]
+    server_queries = after["queries"] - before["queries"]
+    server_cpu = None if before["cpu"] is None else after["cpu"] - before["cpu"]
+    result = {
+        "pattern": pattern,
+        "connections": args.connections,
+        "duration_s": round(elapsed, 3),
+        "queries": stats.queries,
+        "errors": stats.errors,
+        "server_queries": int(server_queries),
+        "server_rejected": int(after["rejected"] - before["rejected"]),
+        "throughput_qps": round(stats.queries / elapsed, 1),
+        "latency_ms": {
+            "p50": ms(stats.latency.percentile(50)),
+            "p99": ms(stats.latency.percentile(99)),
+            "p999": ms(stats.latency.percentile(99.9)),
+            "max": ms(stats.latency.max),
+            "mean": ms(stats.latency.sum // stats.latency.count) if stats.latency.count else 0.0,
+        },
+        "handshakes_per_second": round((after["handshakes"] - before["handshakes"]) / elapsed, 1),
+        "server_cpu_utilization": None if server_cpu is None else round(server_cpu / elapsed, 3),
+        "server_cpu_us_per_query": (round(server_cpu / server_queries * 1e6, 2)
+                                    if server_cpu is not None and server_queries else None),
+        "server_rss_bytes": after["rss"],
+        "server_peak_rss_bytes": after["peak_rss"],
+        "client_cpu_utilization": round(stats.cpu / elapsed, 3),
+    }
+    if pattern == "pipelined":
+        result["pipeline_depth"] = args.pipeline_depth
+    if stats.handshake.count:
+        result["handshake_ms"] = {"p50": ms(stats.handshake.percentile(50)),
+                                  "p99": ms(stats.handshake.percentile(99))}
+    return result
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(SERVER_SCRIPT),
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+
+def print_summary(results, processes: int, baseline=None):
+    """Human-readable table on stderr, with ratios against a previous report if given"""
+    previous = {r["pattern"]: r for r in baseline["results"]} if baseline else {}
+    print(f"{'pattern':<10} {'q/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'p999 ms':>8} {'errors':>7} "
+          f"{'cpu us/q':>9} {'hs/s':>8} {'rss MB':>7}", file=sys.stderr)
+    for r in results:
+        cpu = r["server_cpu_us_per_query"]
+        rss = r["server_rss_bytes"]
+        print(f"{r['pattern']:<10} {r['throughput_qps']:>10,.0f} {r['latency_ms']['p50']:>8.3f} "
+              f"{r['latency_ms']['p99']:>8.3f} {r['latency_ms']['p999']:>8.3f} {r['errors']:>7} "
+              f"{'-' if cpu is None else f'{cpu:.1f}':>9} {r['handshakes_per_second']:>8,.0f} "
+              f"{'-' if rss is None else f'{rss / 2**20:.1f}':>7}", file=sys.stderr)
+        old = previous.get(r["pattern"])
+        if old:
+            ratio = lambda new, prev: f"{new / prev:.2f}x" if new and prev else "-"
+            old_cpu = old.get("server_cpu_us_per_query")
+            print(f"{'  vs base':<10} {ratio(r['throughput_qps'], old['throughput_qps']):>10} "
+                  f"{ratio(r['latency_ms']['p50'], old['latency_ms']['p50']):>8} "
+                  f"{ratio(r['latency_ms']['p99'], old['latency_ms']['p99']):>8} "
+                  f"{ratio(r['latency_ms']['p999'], old['latency_ms']['p999']):>8} {'':>7} "
+                  f"{ratio(cpu, old_cpu):>9}", file=sys.stderr)
+    saturated = [r["pattern"] for r in results if r["client_cpu_utilization"] >= 0.9 * processes]
+    if saturated:
+        print(f"note: load generator CPU was >= 90% during {', '.join(saturated)}; "
+              "add --processes to push the server harder", file=sys.stderr)
+
+def main():
+    ap = argparse.ArgumentParser(
+        description="Load test tsq-stream-server.py on loopback and report results as JSON",
+        epilog="Arguments after -- are passed to the server, e.g. -- --hmac-key key --rate-limit 100",
+    )
+    ap.add_argument("--patterns", default=",".join(PATTERNS),
+                    help="Comma-separated client patterns: new (a connection per query), reused "
+                         "(a stream per query on one connection), pipelined (--pipeline-depth "
+                         "queries per stream) (default: all)")
+    ap.add_argument("--connections", type=int, default=50,
+                    help="Concurrent simulated clients, each with its own connection (default: 50)")
+    ap.add_argument("--duration", type=float, default=10.0, help="Measured seconds per pattern (default: 10)")
+    ap.add_argument("--warmup", type=float, default=2.0,
+                    help="Unmeasured seconds before each measurement (default: 2)")
+    ap.add_argument("--pipeline-depth", type=int, default=16,
+                    help="Requests per stream in the pipelined pattern (default: 16)")
+    ap.add_argument("--resume", action="store_true",
+                    help="Resume sessions with tickets in the new pattern instead of full handshakes")
+    ap.add_argument("--processes", type=int, default=1,
+                    help="Load generator processes sharing --connections (default: 1)")
+    ap.add_argument("--workers", type=int, default=1, help="Server --workers (default: 1)")
+    ap.add_argument("--output", metavar="FILE", help="Write the JSON report here instead of stdout")
+    ap.add_argument("--compare", metavar="FILE", help="Previous JSON report to show ratios against")
+    ap.add_argument("--server-log", metavar="FILE", help="Keep the server's output in FILE")
+    ap.add_argument("server_args", nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    patterns = [p.strip() for p in args.patterns.split(",") if p.strip()]
+    unknown = [p for p in patterns if p not in PATTERNS]
+    if unknown or not patterns:
+        print(f"Error: Unknown pattern(s) {', '.join(unknown) or '(none)'}; choose from {', '.join(PATTERNS)}",
+              file=sys.stderr)
+        sys.exit(1)
+    if args.connections < 1 or args.processes < 1 or args.pipeline_depth < 1 or args.workers < 1:
+        print("Error: Connections, processes, pipeline-depth and workers must be >= 1", file=sys.stderr)
+        sys.exit(1)
+    if args.duration <= 0 or args.warmup < 0:
+        print("Error: Duration must be > 0 and warmup must be >= 0", file=sys.stderr)
+        sys.exit(1)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    server_args = args.server_args[1:] if args.server_args[:1] == ["--"] else args.server_args
+
+    with tempfile.TemporaryDirectory(prefix="tsq-bench-") as workdir:
+        server = ServerProcess(workdir, args.workers, server_args,
+                               args.server_log or os.path.join(workdir, "server.log"))
+        results = []
+        try:
+            server.wait_ready()
+            idle_rss = server.sample()["rss"]
+            print(f"[TSQ] Server on 127.0.0.1:{server.port} (workers={args.workers}), "
+                  f"{args.connections} clients, {args.duration:g}s per pattern", file=sys.stderr)
+            with ProcessPoolExecutor(args.processes) as executor:
+                for pattern in patterns:
+                    print(f"[TSQ] Running {pattern}...", file=sys.stderr)
+                    results.append(run_pattern(server, executor, pattern, args))
+        finally:
+            server.stop()
+
+    import aioquic
+    report = {
+        "tool": "tsq-load-bench",
+        "started": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "aioquic": aioquic.__version__,
+        "cpus": os.cpu_count(),
+        "config": {
+            "connections": args.connections,
+            "duration_s": args.duration,
+            "warmup_s": args.warmup,
+            "pipeline_depth": args.pipeline_depth,
+            "resume": args.resume,
+            "processes": args.processes,
+            "workers": args.workers,
+            "server_args": server_args,
+        },
+        "server_idle_rss_bytes": idle_rss,
+        "results": results,
+    }
+    print_summary(results, args.processes, baseline)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,549 @@
+#!/usr/bin/env python3
+"""
+TSQ fleet monitor
+
+Polls many TSQ servers with bounded concurrency, each on its own schedule,
+and streams one record per probe (offset, RTT, handshake time or failure
+reason) as NDJSON or CSV. Nothing is accumulated per probe, so memory stays
+flat however long it runs; only a few fields per target are kept.
+"""
+import argparse
+import asyncio
+import copy
+import csv
+import heapq
+import io
+import json
+import multiprocessing
+import os
+import select
+import signal
+import sys
+import time
+from datetime import datetime, timezone
+
+from aioquic.asyncio import QuicConnectionProtocol
+from aioquic.asyncio.client import connect
+from aioquic.quic.configuration import QuicConfiguration
+from aioquic.quic.events import ConnectionTerminated, HandshakeCompleted
+
+from tsq_codec import (
+    T_CLOCK_QUALITY,
+    T_SIGNATURE_REQUEST,
+    T_TIME_SOURCE,
+    TSQError,
+    decode_clock_quality,
+    decode_response,
+    decode_time_source,
+    encode_request,
+)
+
+ALPN = ["tsq/1"]
+FIELDS = ("time", "target", "ok", "offset_ms", "rtt_ms", "handshake_ms", "resumed",
+          "samples", "stratum", "clock_class", "error")
+# Consecutive failures push a target's next probe out by up to this many intervals
+MAX_BACKOFF = 8
+# File descriptors kept free for everything other than probe sockets
+SPARE_FDS = 64
+# New probes wait while the event loop runs this late (seconds): handshakes are
+# CPU-bound, and starting more on a saturated loop only turns them into timeouts
+MAX_LOOP_LAG = 0.05
+LAG_TICK = 0.02
+# Writes up to PIPE_BUF bytes to a pipe are atomic
+WRITE_CHUNK = getattr(select, "PIPE_BUF", 512)
+# Per-worker counters in the shared stats array
+STAT_FIELDS = ("probes", "ok", "failed")
+
+def parse_target(text, default_port):
+    """Split "host", "host:port" or "[v6addr]:port" into (host, port)"""
+    if text.startswith("["):
+        host, _, rest = text[1:].partition("]")
+        port = rest[1:] if rest.startswith(":") else ""
+    elif text.count(":") == 1:
+        host, _, port = text.partition(":")
+    else:
+        host, port = text, ""
+    port = int(port) if port else default_port
+    if not host or not 0 < port < 65536:
+        raise ValueError(f"bad target '{text}'")
+    return host, port
+
+def read_targets(paths, extra, default_port):
+    """Targets from files ("-" is stdin; one per line, # comments) and the command line"""
+    seen = set()
+    targets = []
+    lines = list(extra)
+    for path in paths:
+        with (sys.stdin if path == "-" else open(path)) as f:
+            lines.extend(f)
+    for line in lines:
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        target = parse_target(line, default_port)
+        if target not in seen:
+            seen.add(target)
+            targets.append(Target(*target))
+    return targets
+
+class Target:
+    """Schedule and resumption state of one server"""
+
+    __slots__ = ("host", "port", "name", "ticket", "failures")
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.name = f"[{host}]:{port}" if ":" in host else f"{host}:{port}"
+        self.ticket = None
+        self.failures = 0
+
+    def store_ticket(self, ticket):
+        self.ticket = ticket
+
+class ProbeProtocol(QuicConnectionProtocol):
+    """Remembers how the handshake ended and why the connection closed"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.handshake = None
+        self.handshake_done_ns = None
+        self.close_reason = None
+
+    def quic_event_received(self, event):
+        if isinstance(event, HandshakeCompleted):
+            self.handshake = event
+            self.handshake_done_ns = time.perf_counter_ns()
+        elif isinstance(event, ConnectionTerminated):
+            self.close_reason = event.reason_phrase or f"error code {event.error_code:#x}"
+        super().quic_event_received(event)
+
+    def close(self, *args, **kwargs):
+        """Send CONNECTION_CLOSE and count the connection as closed right away,
+        rather than holding a socket and a concurrency slot for 3 PTOs"""
+        super().close(*args, **kwargs)
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._closed.set()
+
+class RecordWriter:
+    """Formats probe records as NDJSON or CSV lines and writes them to a file
+    descriptor in chunks of whole lines no larger than PIPE_BUF, so worker
+    processes sharing one output never interleave inside a line"""
+
+    def __init__(self, fd, fmt):
+        self.fd = fd
+        self.pending = []
+        self.size = 0
+        self.text = io.StringIO() if fmt == "csv" else None
+        self.csv = csv.writer(self.text) if fmt == "csv" else None
+
+    @staticmethod
+    def header(fmt):
+        return (",".join(FIELDS) + "\r\n").encode() if fmt == "csv" else b""
+
+    def write(self, record):
+        if self.csv is not None:
+            self.csv.writerow("" if record[f] is None else record[f] for f in FIELDS)
+            line = self.text.getvalue().encode()
+            self.text.seek(0)
+            self.text.truncate()
+        else:
+            line = (json.dumps(record, separators=(",", ":")) + "\n").encode()
+        if self.size + len(line) > WRITE_CHUNK:
+            self.flush()
+        self.pending.append(line)
+        self.size += len(line)
+
+    def flush(self):
+        if not self.pending:
+            return
+        data = b"".join(self.pending)
+        self.pending.clear()
+        self.size = 0
+        while data:
+            data = data[os.write(self.fd, data):]
+
+class Monitor:
+    def __init__(self, targets, writer, insecure=False, cafile=None, queries=2, timeout=3.0,
+                 concurrency=256, interval=60.0, sweeps=1, verifier=None):
+        self.targets = targets
+        self.writer = writer
+        self.queries = queries
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.interval = interval
+        self.sweeps = sweeps          # probes per target; 0 runs until stopped
+        self.verifier = verifier
+        self.request_flags = {T_SIGNATURE_REQUEST} if verifier else ()
+        self.configuration = QuicConfiguration(is_client=True, alpn_protocols=ALPN)
+        if insecure:
+            self.configuration.verify_mode = False
+        elif cafile:
+            self.configuration.load_verify_locations(cafile)
+        self.stats = dict.fromkeys(STAT_FIELDS, 0)
+        self.stopping = asyncio.Event()
+        self.lag = 0.0
+
+    async def query(self, client):
+        """One request on a new stream; returns (offset_ms, rtt_ms, tlvs)"""
+        nonce = os.urandom(16)
+        reader, writer = await client.create_stream()
+        writer.write(encode_request(nonce, self.request_flags))
+        t1 = time.time_ns()
+        writer.write_eof()
+        response = await reader.read()
+        t4 = time.time_ns()
+        if not response:
+            raise ConnectionError("stream closed without a response")
+        echoed_nonce, t2, t3, tlvs = decode_response(response)
+        if echoed_nonce != nonce:
+            raise ValueError("mismatched nonce")
+        if self.verifier is not None:
+            self.verifier.verify(response)
+        if t2 is None or t3 is None:
+            raise ValueError("response without timestamps")
+        rtt_ns = (t4 - t1) - (t3 - t2)
+        offset_ns = ((t2 - t1) + (t3 - t4)) // 2
+        return offset_ns / 1e6, rtt_ns / 1e6, tlvs
+
+    async def exchange(self, target, record):
+        """Connect (resuming when possible) and keep the lowest-RTT of the queries"""
+        cfg = copy.copy(self.configuration)
+        if target.ticket is not None and target.ticket.is_valid:
+            cfg.session_ticket = target.ticket
+        protocols = []
+
+        def create_protocol(*args, **kwargs):
+            protocols.append(ProbeProtocol(*args, **kwargs))
+            return protocols[0]
+
+        start = time.perf_counter_ns()
+        try:
+            async with connect(target.host, target.port, configuration=cfg,
+                               create_protocol=create_protocol,
+                               session_ticket_handler=target.store_ticket) as client:
+                record["handshake_ms"] = round((client.handshake_done_ns - start) / 1e6, 3)
+                record["resumed"] = bool(client.handshake.session_resumed)
+                best = None
+                for _ in range(self.queries):
+                    sample = await self.query(client)
+                    if best is None or sample[1] < best[1]:
+                        best = sample
+        except ConnectionError:
+            if protocols and protocols[0].close_reason:
+                raise ConnectionError(f"connection closed: {protocols[0].close_reason}") from None
+            raise
+        offset_ms, rtt_ms, tlvs = best
+        record.update(ok=True, offset_ms=round(offset_ms, 3), rtt_ms=round(rtt_ms, 3),
+                      samples=self.queries)
+        if T_TIME_SOURCE in tlvs:
+            record["stratum"] = decode_time_source(tlvs[T_TIME_SOURCE])[0]
+        if T_CLOCK_QUALITY in tlvs:
+            record["clock_class"] = decode_clock_quality(tlvs[T_CLOCK_QUALITY])[0]
+
+    async def probe(self, target):
+        """Probe one target and write its record; returns True on success"""
+        record = dict.fromkeys(FIELDS)
+        record["time"] = datetime.now(timezone.utc).isoformat(timespec="milliseconds")
+        record["target"] = target.name
+        record["ok"] = False
+        try:
+            await asyncio.wait_for(self.exchange(target, record), self.timeout)
+        except asyncio.TimeoutError:
+            record["error"] = "timeout" if record["handshake_ms"] is not None else "handshake timeout"
+        except TSQError as e:
+            record["error"] = str(e)
+        except (OSError, ValueError) as e:
+            # OSError covers ConnectionError and name resolution failures
+            record["error"] = str(e) or type(e).__name__
+        self.stats["probes"] += 1
+        self.stats["ok" if record["ok"] else "failed"] += 1
+        self.writer.write(record)
+        return record["ok"]
+
+    def next_due(self, target, started, ok):
+        """Next probe time: one interval after this one, backing off while it fails"""
+        target.failures = 0 if ok else target.failures + 1
+        return started + self.interval * min(2 ** target.failures, MAX_BACKOFF)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        # (due, seq, target, probes done); the first sweep is due at once
+        heap = [(now, i, target, 0) for i, target in enumerate(self.targets)]
+        seq = len(heap)
+        wakeup = asyncio.Event()
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+
+        async def run_probe(target, probes):
+            nonlocal seq
+            started = loop.time()
+            try:
+                ok = await self.probe(target)
+                probes += 1
+                if self.sweeps == 0 or probes < self.sweeps:
+                    seq += 1
+                    heapq.heappush(heap, (self.next_due(target, started, ok), seq, target, probes))
+            finally:
+                tasks.discard(asyncio.current_task())
+                slots.release()
+                wakeup.set()
+
+        lag_watcher = asyncio.create_task(self.watch_lag())
+        while (heap or tasks) and not self.stopping.is_set():
+            if not heap:
+                wakeup.clear()
+                await self.wait(wakeup, None)
+                continue
+            delay = heap[0][0] - loop.time()
+            if delay > 0:
+                wakeup.clear()
+                await self.wait(wakeup, delay)
+                continue
+            if self.lag > MAX_LOOP_LAG:
+                await asyncio.sleep(LAG_TICK)
+                continue
+            # Blocks while all slots are busy; probes finishing free them
+            await slots.acquire()
+            _, _, target, probes = heapq.heappop(heap)
+            tasks.add(asyncio.create_task(run_probe(target, probes)))
+
+        if self.stopping.is_set():
+            for task in tasks:
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        lag_watcher.cancel()
+
+    async def watch_lag(self):
+        """Measure how late the event loop wakes from a short sleep"""
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(LAG_TICK)
+            self.lag = loop.time() - start - LAG_TICK
+
+    async def wait(self, event, timeout):
+        """Wait for event, the timeout, or a stop request"""
+        waiters = [asyncio.ensure_future(event.wait()), asyncio.ensure_future(self.stopping.wait())]
+        try:
+            await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+
+    async def report(self, stats_interval, publish=None):
+        """Flush records and publish counters every second; log progress to
+        stderr every stats_interval (0 for never)"""
+        start = last_report = time.monotonic()
+        last_probes = 0
+        while True:
+            await asyncio.sleep(1.0)
+            self.writer.flush()
+            if publish is not None:
+                publish(self.stats)
+            now = time.monotonic()
+            if stats_interval and now - last_report >= stats_interval:
+                rate = (self.stats["probes"] - last_probes) / (now - last_report)
+                print(f"[TSQ] {now - start:.0f}s: probes={self.stats['probes']} ok={self.stats['ok']} "
+                      f"failed={self.stats['failed']} rate={rate:.0f}/s loop_lag={self.lag * 1000:.0f}ms",
+                      file=sys.stderr)
+                last_report, last_probes = now, self.stats["probes"]
+
+def raise_fd_limit(wanted):
+    """Raise the open-file soft limit so each concurrent probe can have its socket;
+    returns the number of probes that fit"""
+    try:
+        import resource
+    except ImportError:
+        return wanted
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    need = wanted + SPARE_FDS
+    if soft != resource.RLIM_INFINITY and soft < need:
+        new_soft = need if hard == resource.RLIM_INFINITY else min(need, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
+            soft = new_soft
+        except (ValueError, OSError):
+            pass
+    if soft == resource.RLIM_INFINITY:
+        return wanted
+    return max(1, min(wanted, soft - SPARE_FDS))
+
+def load_verifier(args):
+    if not (args.hmac_key or args.verify_key):
+        return None
+    from tsq_sign import ResponseVerifier
+    return ResponseVerifier.from_files(args.hmac_key, args.verify_key)
+
+def open_output(args, worker=False):
+    """File descriptor for records: --output (appended to by workers) or stdout"""
+    if not args.output:
+        return sys.stdout.fileno()
+    flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+    if not (args.append or worker):
+        flags |= os.O_TRUNC
+    return os.open(args.output, flags, 0o644)
+
+async def run_monitor(args, targets, fd, concurrency, stats_interval, publish=None):
+    """Probe targets until done or stopped; returns the counters"""
+    concurrency = raise_fd_limit(concurrency)
+    writer = RecordWriter(fd, args.format)
+    monitor = Monitor(targets, writer, insecure=args.insecure, cafile=args.cafile, queries=args.queries,
+                      timeout=args.timeout, concurrency=concurrency, interval=args.interval,
+                      sweeps=args.sweeps, verifier=load_verifier(args))
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, monitor.stopping.set)
+    reporter = asyncio.create_task(monitor.report(stats_interval, publish))
+    try:
+        await monitor.run()
+    finally:
+        reporter.cancel()
+        writer.flush()
+        if publish is not None:
+            publish(monitor.stats)
+    return monitor.stats
+
+def run_worker(args, targets, worker_id, shared_stats):
+    """Entry point of one --workers process"""
+    base = worker_id * len(STAT_FIELDS)
+
+    def publish(stats):
+        for i, field in enumerate(STAT_FIELDS):
+            shared_stats[base + i] = stats[field]
+
+    fd = open_output(args, worker=True)
+    asyncio.run(run_monitor(args, targets, fd, max(1, args.concurrency // args.workers), 0, publish))
+
+def run_workers(args, targets):
+    """Split the targets across --workers processes and roll up their counters"""
+    width = len(STAT_FIELDS)
+    shared_stats = multiprocessing.Array("Q", args.workers * width, lock=False)
+    workers = [
+        multiprocessing.Process(target=run_worker, args=(args, targets[i::args.workers], i, shared_stats))
+        for i in range(args.workers)
+    ]
+    for proc in workers:
+        proc.start()
+
+    def totals():
+        return {field: sum(shared_stats[w * width + i] for w in range(args.workers))
+                for i, field in enumerate(STAT_FIELDS)}
+
+    def stop(*_):
+        for proc in workers:
+            if proc.is_alive():
+                proc.terminate()
+
+    # Workers stop admitting probes on SIGTERM and finish the ones in flight
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    start = last_report = time.monotonic()
+    last_probes = 0
+    while any(proc.is_alive() for proc in workers):
+        time.sleep(0.2)
+        now = time.monotonic()
+        if args.stats_interval and now - last_report >= args.stats_interval:
+            stats = totals()
+            rate = (stats["probes"] - last_probes) / (now - last_report)
+            print(f"[TSQ] {now - start:.0f}s: probes={stats['probes']} ok={stats['ok']} "
+                  f"failed={stats['failed']} rate={rate:.0f}/s", file=sys.stderr)
+            last_report, last_probes = now, stats["probes"]
+    for proc in workers:
+        proc.join()
+    return totals()
+
+def main(args, targets):
+    fd = open_output(args)
+    header = RecordWriter.header(args.format)
+    if header and not (args.append and os.lseek(fd, 0, os.SEEK_END) > 0):
+        os.write(fd, header)
+
+    sweeps = f"{args.sweeps} sweep(s)" if args.sweeps else "until stopped"
+    print(f"[TSQ] Monitoring {len(targets)} target(s), {args.concurrency} at a time in "
+          f"{args.workers} process(es), every {args.interval:g}s, {sweeps}", file=sys.stderr)
+    start = time.monotonic()
+    if args.workers > 1:
+        stats = run_workers(args, targets)
+    else:
+        stats = asyncio.run(run_monitor(args, targets, fd, args.concurrency, args.stats_interval))
+    elapsed = time.monotonic() - start
+    print(f"[TSQ] Done: probes={stats['probes']} ok={stats['ok']} failed={stats['failed']} "
+          f"in {elapsed:.1f}s ({stats['probes'] / elapsed if elapsed else 0:.0f}/s)", file=sys.stderr)
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="TSQ fleet monitor - probe many TSQ servers and stream the results"
+    )
+    parser.add_argument("targets", nargs="*", help="host, host:port or [v6addr]:port")
+    parser.add_argument("--targets-file", "-f", action="append", default=[], metavar="FILE",
+                        help="File with one target per line ('-' for stdin, repeatable)")
+    parser.add_argument("--port", type=int, default=443, help="Port for targets without one (default: 443)")
+    parser.add_argument("--concurrency", type=int, default=256,
+                        help="Probes in flight at once (default: 256)")
+    parser.add_argument("--interval", type=float, default=60.0,
+                        help="Seconds between probes of the same target (default: 60)")
+    parser.add_argument("--sweeps", type=int, default=1,
+                        help="Probes per target, 0 to run until stopped (default: 1)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Processes to split the targets across, for more handshakes per second "
+                             "(default: 1)")
+    parser.add_argument("--queries", type=int, default=2,
+                        help="Queries per probe; the lowest-RTT one is reported (default: 2)")
+    parser.add_argument("--timeout", type=float, default=3.0,
+                        help="Seconds allowed for a whole probe, handshake included (default: 3)")
+    parser.add_argument("--format", choices=["ndjson", "csv"], default="ndjson",
+                        help="Output format (default: ndjson)")
+    parser.add_argument("--output", "-o", metavar="FILE", help="Write records here instead of stdout")
+    parser.add_argument("--append", action="store_true", help="Append to --output instead of replacing it")
+    parser.add_argument("--stats-interval", type=float, default=10.0,
+                        help="Seconds between progress lines on stderr, 0 for none (default: 10)")
+    parser.add_argument("--cafile", metavar="FILE",
+                        help="Verify servers against these CA certificates instead of the system bundle")
+    parser.add_argument("--insecure", action="store_true", help="Skip certificate verification")
+    parser.add_argument("--hmac-key", action="append", default=[], metavar="FILE",
+                        help="Require responses signed with this HMAC-SHA256 shared secret (repeatable)")
+    parser.add_argument("--verify-key", action="append", default=[], metavar="FILE",
+                        help="Require responses signed by this Ed25519 public key (PEM, repeatable)")
+    args = parser.parse_args()
+
+    if args.port < 1 or args.port > 65535:
+        print("Error: Port must be between 1 and 65535", file=sys.stderr)
+        sys.exit(1)
+
+    if args.concurrency < 1 or args.queries < 1 or args.sweeps < 0:
+        print("Error: Concurrency and queries must be >= 1 and sweeps must be >= 0", file=sys.stderr)
+        sys.exit(1)
+
+    if args.workers < 1 or args.workers > args.concurrency:
+        print("Error: Workers must be between 1 and --concurrency", file=sys.stderr)
+        sys.exit(1)
+
+    if args.interval <= 0 or args.timeout <= 0 or args.stats_interval < 0:
+        print("Error: Interval and timeout must be > 0 and stats-interval must be >= 0", file=sys.stderr)
+        sys.exit(1)
+
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+    try:
+        targets = read_targets(args.targets_file, args.targets, args.port)
+    except (OSError, ValueError) as e:
+        print(f"Error: Cannot read targets: {e}", file=sys.stderr)
+        sys.exit(1)
+    if not targets:
+        print("Error: No targets given", file=sys.stderr)
+        sys.exit(1)
+
+    # Fail fast on a bad key before starting any workers
+    try:
+        load_verifier(args)
+    except (OSError, ValueError) as e:
+        print(f"Error: Cannot load signature key: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    main(args, targets)
@@ -5,51 +5,64 @@ Similar to ntpdate but using TSQ (Time Synchronization over QUIC)
 
 Queries TSQ servers, calculates offset, and adjusts system clock.
 """
-import asyncio
-import struct
 import time
+# First thing, so --timing can split interpreter startup from imports
+SCRIPT_START_NS = time.perf_counter_ns()
+
+import asyncio
+import collections
+import copy
+import errno
 import os
 import sys
 import argparse
-import statistics
+import math
+import pickle
+import signal
+from contextlib import AsyncExitStack
 from datetime import datetime
 import ctypes
-import ctypes.util
-import platform
 
 # aioquic imports
+from aioquic.asyncio import QuicConnectionProtocol
 from aioquic.asyncio.client import connect
 from aioquic.quic.configuration import QuicConfiguration
+from aioquic.quic.events import ConnectionTerminated, DatagramFrameReceived, HandshakeCompleted
 
-# Detect OS
-IS_LINUX = platform.system() == 'Linux'
-IS_MACOS = platform.system() == 'Darwin'
+from tsq_codec import (
+    NS_PER_SEC,
+    T_CLOCK_QUALITY,
+    T_SIGNATURE_REQUEST,
+    T_TIME_SOURCE,
+    TSQError,
+    decode_clock_quality,
+    decode_response,
+    decode_time_source,
+    encode_request,
+)
+from tsq_clock import (
+    ADJ_ESTERROR,
+    ADJ_FREQUENCY,
+    ADJ_MAXERROR,
+    ADJ_NANO,
+    ADJ_OFFSET,
+    ADJ_OFFSET_SINGLESHOT,
+    ADJ_SETOFFSET,
+    ADJ_STATUS,
+    ADJ_TIMECONST,
+    STA_NANO,
+    STA_PLL,
+    STA_UNSYNC,
+    Timex,
+)
+from tsq_metrics import PhaseSpans, SamplingProfiler, add_sigusr1_handler
 
-# Linux timex structure for adjtimex
-class Timex(ctypes.Structure):
-    _fields_ = [
-        ("modes", ctypes.c_uint),
-        ("offset", ctypes.c_long),
-        ("freq", ctypes.c_long),
-        ("maxerror", ctypes.c_long),
-        ("esterror", ctypes.c_long),
-        ("status", ctypes.c_int),
-        ("constant", ctypes.c_long),
-        ("precision", ctypes.c_long),
-        ("tolerance", ctypes.c_long),
-        ("time", ctypes.c_long * 2),
-        ("tick", ctypes.c_long),
-        ("ppsfreq", ctypes.c_long),
-        ("jitter", ctypes.c_long),
-        ("shift", ctypes.c_int),
-        ("stabil", ctypes.c_long),
-        ("jitcnt", ctypes.c_long),
-        ("calcnt", ctypes.c_long),
-        ("errcnt", ctypes.c_long),
-        ("stbcnt", ctypes.c_long),
-        ("tai", ctypes.c_int),
-        ("_padding", ctypes.c_int * 11),
-    ]
+# Seldom-needed modules (statistics, tsq_sign, uvloop) are imported where used
+IMPORTS_DONE_NS = time.perf_counter_ns()
+
+# Detect OS
+IS_LINUX = sys.platform.startswith("linux")
+IS_MACOS = sys.platform == "darwin"
 
 # macOS timeval structure for adjtime
 class Timeval(ctypes.Structure):
@@ -58,243 +71,1101 @@ class Timeval(ctypes.Structure):
         ("tv_usec", ctypes.c_long),
     ]
 
-# adjtimex modes
-ADJ_OFFSET = 0x0001
-ADJ_FREQUENCY = 0x0002
-ADJ_MAXERROR = 0x0004
-ADJ_ESTERROR = 0x0008
-ADJ_STATUS = 0x0010
-ADJ_TIMECONST = 0x0020
-ADJ_SETOFFSET = 0x0100
-ADJ_MICRO = 0x1000
-ADJ_NANO = 0x2000
+# Kernel PLL limits: offsets are clamped to +-0.5s, time constants to 0..10
+MAX_PLL_OFFSET_NS = 500_000_000
+MAX_TIME_CONSTANT = 10
+
+# Largest QUIC DATAGRAM frame accepted in datagram mode
+MAX_DATAGRAM_FRAME_SIZE = 65536
+
+# A sample counts as "good" when its RTT is within this factor of the
+# lowest RTT seen from the same server
+GOOD_RTT_FACTOR = 1.5
+
+# Clock filter: samples kept per server (as in NTP), and the dispersion a
+# sample gains with age (15 ppm frequency tolerance, in ms per second)
+FILTER_WINDOW = 8
+PHI_MS_PER_S = 15e-3
+
+# Server weighting from optional response TLVs: distance added per stratum
+# below 1 (TLV 251), and the Clock Quality class (TLV 248) for holdover
+STRATUM_DISTANCE_MS = 1.0
+CLOCK_CLASS_HOLDOVER = 5
+
+class ClockFilter:
+    """The last FILTER_WINDOW samples from one server.
+    
+    Network queuing only ever adds delay, and asymmetric delay is what skews
+    an offset, so the sample with the lowest delay (after aging) is the most
+    accurate one; the others only contribute to the jitter estimate.
+    """
+    
+    def __init__(self, window=FILTER_WINDOW):
+        self.samples = collections.deque(maxlen=window)   # (offset_ms, delay_ms, monotonic time)
+    
+    def add(self, offset_ms, delay_ms, when):
+        self.samples.append((offset_ms, delay_ms, when))
+    
+    def clear(self):
+        self.samples.clear()
+    
+    def good(self):
+        """Samples whose delay is within GOOD_RTT_FACTOR of the lowest"""
+        if not self.samples:
+            return 0
+        limit = min(delay for _, delay, _ in self.samples) * GOOD_RTT_FACTOR
+        return sum(1 for _, delay, _ in self.samples if delay <= limit)
+    
+    def best(self, now):
+        """Return (offset_ms, delay_ms, jitter_ms, dispersion_ms, when) of the best sample, or None"""
+        if not self.samples:
+            return None
+        offset, delay, when = min(self.samples, key=lambda s: s[1] + 2 * PHI_MS_PER_S * (now - s[2]))
+        jitter = 0.0
+        if len(self.samples) > 1:
+            jitter = math.sqrt(sum((o - offset) ** 2 for o, _, _ in self.samples) / (len(self.samples) - 1))
+        return offset, delay, jitter, PHI_MS_PER_S * (now - when), when
+
+def select_truechimers(candidates):
+    """Intersection (Marzullo) selection as in RFC 5905 section 11.2.1.
+    
+    candidates is a list of (name, offset_ms, distance_ms). Returns the names
+    whose correctness interval [offset - distance, offset + distance] overlaps
+    the interval shared by a majority, or an empty list if there is none.
+    """
+    n = len(candidates)
+    edges = []
+    for _, offset, distance in candidates:
+        edges += [(offset - distance, -1), (offset, 0), (offset + distance, 1)]
+    edges.sort()
+    allow = 0
+    while 2 * allow < n:
+        found = 0
+        chime = 0
+        low = high = None
+        for edge, kind in edges:
+            chime -= kind
+            if chime >= n - allow:
+                low = edge
+                break
+            if kind == 0:
+                found += 1
+        chime = 0
+        for edge, kind in reversed(edges):
+            chime += kind
+            if chime >= n - allow:
+                high = edge
+                break
+            if kind == 0:
+                found += 1
+        if found <= allow and low is not None and high is not None and low <= high:
+            return [name for name, offset, distance in candidates
+                    if offset - distance <= high and offset + distance >= low]
+        allow += 1
+    return []
+
+DEFAULT_TICKET_CACHE = os.path.expanduser("~/.cache/tsq/session-tickets.pickle")
+DEFAULT_DRIFT_FILE = os.path.expanduser("~/.cache/tsq/drift")
+
+# Default --probe-timeout: how long to wait for one answer before counting it as
+# failed; streams retransmit, so they get longer than a lost datagram
+DATAGRAM_TIMEOUT = 1.0
+STREAM_TIMEOUT = 3.0
+
+# Daemon poll interval bounds, as powers of two seconds (16s .. 1024s)
+MIN_POLL_EXP = 4
+MAX_POLL_EXP = 10
+# Poll adaptation (as in NTP): offsets within POLL_GATE x jitter add the poll
+# exponent to a counter, others subtract twice it; at +-POLL_LIMIT the
+# interval doubles or halves
+POLL_GATE = 4.0
+POLL_LIMIT = 30
+# Jitter floor for the poll gate (timestamping noise of a Python client)
+MIN_JITTER_MS = 0.05
+
+def adapt_poll(poll_exp, counter, offset_ms, jitter_ms, min_exp, max_exp):
+    """Return the next (poll_exp, counter): back off while offsets stay within the jitter"""
+    # Weight by at least 1 so a 1s interval (poll_exp 0) can still back off
+    weight = max(poll_exp, 1)
+    if abs(offset_ms) < POLL_GATE * max(jitter_ms, MIN_JITTER_MS):
+        counter += weight
+        if counter > POLL_LIMIT:
+            return min(poll_exp + 1, max_exp), 0
+    else:
+        counter -= 2 * weight
+        if counter < -POLL_LIMIT:
+            return max(poll_exp - 1, min_exp), 0
+    return poll_exp, counter
+
+class ClockBackend:
+    """Clock control through libc, which is loaded once per process.
+    
+    step() and slew() block for a system call; the async callers run them in
+    an executor. Both return (method, latency_ns, residual_ns): how long the
+    adjustment itself took and how far it missed the requested offset.
+    """
+    
+    simulated = False
+    
+    def __init__(self):
+        # The process's own symbols include libc; find_library("c") would run ldconfig
+        self.libc = ctypes.CDLL(None, use_errno=True)
+    
+    def _check(self, result, name):
+        if result == -1:
+            err = ctypes.get_errno()
+            raise OSError(err, f"{name} failed: {os.strerror(err)}")
+        return result
+    
+    def now_ns(self):
+        return time.clock_gettime_ns(time.CLOCK_REALTIME)
+    
+    def adjtimex(self, tx):
+        """Call adjtimex(2) with tx; tx is filled in with the kernel state"""
+        self._check(self.libc.adjtimex(ctypes.byref(tx)), "adjtimex")
+        return tx
+    
+    def _clock_difference(self):
+        """CLOCK_REALTIME minus CLOCK_MONOTONIC, read between two monotonic reads"""
+        mono_before = time.monotonic_ns()
+        real = self.now_ns()
+        mono_after = time.monotonic_ns()
+        return real - (mono_before + mono_after) // 2
+    
+    def _timed_step(self, offset_ns, apply):
+        """Run apply() and measure its latency and how far the step missed offset_ns"""
+        before = self._clock_difference()
+        start = time.monotonic_ns()
+        apply()
+        latency_ns = time.monotonic_ns() - start
+        after = self._clock_difference()
+        return latency_ns, after - before - offset_ns
+    
+    def step(self, offset_ns):
+        """Step CLOCK_REALTIME by offset_ns with ADJ_SETOFFSET, else clock_settime"""
+        tx = Timex()
+        tx.modes = ADJ_SETOFFSET | ADJ_NANO
+        # With ADJ_NANO the timeval's second field holds nanoseconds (0..1e9)
+        tx.time[0], tx.time[1] = divmod(offset_ns, NS_PER_SEC)
+        try:
+            return ("adjtimex ADJ_SETOFFSET",) + self._timed_step(offset_ns, lambda: self.adjtimex(tx))
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                raise
+        # Kernels before 2.6.39: read, add, set (the time between read and set is lost)
+        set_clock = lambda: time.clock_settime_ns(time.CLOCK_REALTIME, self.now_ns() + offset_ns)
+        return ("clock_settime",) + self._timed_step(offset_ns, set_clock)
+    
+    def slew(self, offset_ns):
+        """Slew by offset_ns once, like adjtime(2) (ADJ_OFFSET_SINGLESHOT, microseconds).
+        The kernel PLL and clock status are left to ClockDiscipline."""
+        usec = int(offset_ns / 1000)
+        tx = Timex()
+        tx.modes = ADJ_OFFSET_SINGLESHOT
+        tx.offset = usec
+        start = time.monotonic_ns()
+        self.adjtimex(tx)
+        return "adjtimex ADJ_OFFSET_SINGLESHOT", time.monotonic_ns() - start, offset_ns - usec * 1000
+
+class MacClockBackend(ClockBackend):
+    """macOS: adjtime(2) slews at a fixed rate; there is no kernel PLL or relative step"""
+    
+    def adjtimex(self, tx):
+        raise OSError(errno.ENOSYS, "adjtimex is not available on macOS")
+    
+    def step(self, offset_ns):
+        raise OSError(errno.ENOSYS, "stepping is not supported on macOS")
+    
+    def slew(self, offset_ns):
+        delta = Timeval()
+        seconds, nanos = divmod(offset_ns, NS_PER_SEC)
+        delta.tv_sec = seconds
+        delta.tv_usec = nanos // 1000
+        olddelta = Timeval()
+        start = time.monotonic_ns()
+        self._check(self.libc.adjtime(ctypes.byref(delta), ctypes.byref(olddelta)), "adjtime")
+        return "adjtime", time.monotonic_ns() - start, offset_ns % 1000
+
+class MockClockBackend(ClockBackend):
+    """Simulated clock for --dry-run: adjustments move a private offset, not the system clock"""
+    
+    simulated = True
+    
+    def __init__(self):
+        self.offset_ns = 0      # simulated clock minus the real clock
+        self.state = Timex()    # simulated kernel clock state
+    
+    def now_ns(self):
+        return time.clock_gettime_ns(time.CLOCK_REALTIME) + self.offset_ns
+    
+    def adjtimex(self, tx):
+        modes = tx.modes
+        if modes & ADJ_STATUS:
+            self.state.status = tx.status
+        if modes & ADJ_FREQUENCY:
+            self.state.freq = tx.freq
+        if modes & ADJ_OFFSET:
+            self.state.offset = tx.offset
+        if modes & ADJ_TIMECONST:
+            self.state.constant = tx.constant
+        if modes & ADJ_MAXERROR:
+            self.state.maxerror = tx.maxerror
+        if modes & ADJ_ESTERROR:
+            self.state.esterror = tx.esterror
+        if modes & ADJ_SETOFFSET:
+            self.offset_ns += tx.time[0] * NS_PER_SEC + tx.time[1]
+        ctypes.memmove(ctypes.byref(tx), ctypes.byref(self.state), ctypes.sizeof(Timex))
+        return tx
+
+class ClockDiscipline:
+    """Continuous phase and frequency discipline through the Linux kernel PLL.
+    
+    Every measured offset is handed to adjtimex (ADJ_OFFSET with STA_PLL set),
+    and the kernel slews the phase and trains its frequency from the sequence,
+    with a time constant that follows the poll interval. The learned frequency
+    is saved to a drift file and restored with ADJ_FREQUENCY on start, so a
+    restarted daemon does not have to learn it again.
+    """
+    
+    def __init__(self, log, clock, drift_file=DEFAULT_DRIFT_FILE):
+        self.log = log
+        self.clock = clock
+        self.drift_file = drift_file
+        self.freq_ppm = None
+    
+    def read(self):
+        """Current kernel clock state (no privileges needed)"""
+        return self.clock.adjtimex(Timex())
+    
+    def start(self):
+        """Restore the saved frequency and switch the kernel to PLL mode.
+        
+        STA_UNSYNC is left as it is until update() has a measured offset.
+        """
+        tx = Timex()
+        tx.modes = ADJ_STATUS
+        tx.status = self.read().status | STA_PLL
+        self.freq_ppm = self.read().freq / 65536.0
+        if self.drift_file:
+            try:
+                with open(self.drift_file) as f:
+                    saved_ppm = float(f.read().strip())
+                tx.modes |= ADJ_FREQUENCY
+                tx.freq = int(saved_ppm * 65536)
+                self.freq_ppm = saved_ppm
+                self.log(f"Restored clock frequency {saved_ppm:+.3f}ppm from {self.drift_file}")
+            except (OSError, ValueError):
+                pass
+        self.clock.adjtimex(tx)
+    
+    def update(self, offset_ms, jitter_ms, rtt_ms, poll_exp):
+        """Feed one filtered offset to the kernel PLL; returns the kernel frequency (ppm)"""
+        tx = Timex()
+        tx.modes = ADJ_OFFSET | ADJ_NANO | ADJ_TIMECONST | ADJ_STATUS | ADJ_MAXERROR | ADJ_ESTERROR
+        tx.offset = max(-MAX_PLL_OFFSET_NS, min(MAX_PLL_OFFSET_NS, int(offset_ms * 1e6)))
+        tx.constant = min(MAX_TIME_CONSTANT, max(0, poll_exp - 4))
+        tx.status = (self.read().status | STA_PLL | STA_NANO) & ~STA_UNSYNC
+        tx.esterror = int(jitter_ms * 1000)
+        tx.maxerror = int((abs(offset_ms) + rtt_ms / 2 + jitter_ms) * 1000)
+        self.clock.adjtimex(tx)
+        self.freq_ppm = self.read().freq / 65536.0
+        return self.freq_ppm
+    
+    def save(self):
+        """Persist the learned frequency for the next start (not for a simulated clock)"""
+        if self.clock.simulated or not self.drift_file or self.freq_ppm is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.drift_file) or ".", exist_ok=True)
+            tmp_path = self.drift_file + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(f"{self.freq_ppm:.3f}\n")
+            os.replace(tmp_path, self.drift_file)
+        except OSError as e:
+            self.log(f"Could not save drift file: {e}", "WARN")
+
+def make_clock_backend(dry_run=False):
+    """The clock backend for this platform, or a simulated one for --dry-run"""
+    if dry_run:
+        return MockClockBackend()
+    if IS_MACOS:
+        return MacClockBackend()
+    return ClockBackend()
+
+def process_age_ns():
+    """Time since this process was started (Linux, clock-tick resolution), or None"""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        return time.clock_gettime_ns(time.CLOCK_BOOTTIME) - start_ticks * NS_PER_SEC // os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+class PhaseTimer:
+    """Where the time of a one-shot run goes, for --timing.
+    
+    Each phase ends at mark(). "startup" (exec up to the first line of this
+    script) comes from /proc and has only clock-tick (usually 10ms) resolution.
+    """
+    
+    def __init__(self):
+        age = process_age_ns()
+        self.process_start_ns = None if age is None else time.perf_counter_ns() - age
+        self.marks = [("imports", IMPORTS_DONE_NS)]
+        self.first_request_ns = None
+    
+    def mark(self, phase, when=None):
+        self.marks.append((phase, when if when is not None else time.perf_counter_ns()))
+    
+    def request_sent(self):
+        if self.first_request_ns is None:
+            self.first_request_ns = time.perf_counter_ns()
+    
+    def report(self):
+        origin = SCRIPT_START_NS
+        parts = []
+        if self.process_start_ns is not None and self.process_start_ns < SCRIPT_START_NS:
+            origin = self.process_start_ns
+            parts.append(f"startup={(SCRIPT_START_NS - origin) / 1e6:.1f}ms")
+        previous = SCRIPT_START_NS
+        for phase, when in self.marks:
+            parts.append(f"{phase}={(when - previous) / 1e6:.1f}ms")
+            previous = when
+        parts.append(f"total={(previous - origin) / 1e6:.1f}ms")
+        if self.first_request_ns is not None:
+            parts.append(f"first request at {(self.first_request_ns - origin) / 1e6:.1f}ms")
+        return ", ".join(parts)
+
+class SessionTicketCache:
+    """On-disk TLS session tickets so scheduled runs can resume (and send 0-RTT)"""
+    
+    def __init__(self, path):
+        self.path = path
+        self.tickets = {}            # "server:port" -> SessionTicket
+        self.full_handshake_ms = {}  # "server:port" -> last full (non-resumed) handshake
+        self.stats = {"connections": 0, "resumed": 0, "saved_ms": 0.0}
+        self.load()
+    
+    def load(self):
+        """Load tickets and lifetime counters; a missing or unreadable cache starts empty"""
+        try:
+            with open(self.path, "rb") as f:
+                data = pickle.load(f)
+            self.tickets = data.get("tickets", {})
+            self.full_handshake_ms = data.get("full_handshake_ms", {})
+            self.stats.update(data.get("stats", {}))
+        except FileNotFoundError:
+            pass
+        except Exception:
+            self.tickets = {}
+            self.full_handshake_ms = {}
+    
+    def save(self):
+        """Write the cache atomically, readable by the owner only"""
+        os.makedirs(os.path.dirname(self.path) or ".", mode=0o700, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump({
+                "tickets": {k: t for k, t in self.tickets.items() if t.is_valid},
+                "full_handshake_ms": self.full_handshake_ms,
+                "stats": self.stats,
+            }, f)
+        os.replace(tmp_path, self.path)
+    
+    def get(self, server, port):
+        """Return a still-valid ticket for server:port, or None"""
+        key = f"{server}:{port}"
+        ticket = self.tickets.get(key)
+        if ticket is not None and not ticket.is_valid:
+            del self.tickets[key]
+            return None
+        return ticket
+    
+    def store(self, server, port, ticket):
+        self.tickets[f"{server}:{port}"] = ticket
+    
+    def record(self, server, port, handshake_ms, resumed, early_data):
+        """Update the hit counters and return the handshake latency saved (ms)"""
+        key = f"{server}:{port}"
+        self.stats["connections"] += 1
+        if not resumed:
+            self.full_handshake_ms[key] = handshake_ms
+            return 0.0
+        
+        self.stats["resumed"] += 1
+        full_ms = self.full_handshake_ms.get(key)
+        if full_ms is None:
+            return 0.0
+        # With 0-RTT the first request does not wait for the handshake at all
+        saved_ms = full_ms if early_data else max(0.0, full_ms - handshake_ms)
+        self.stats["saved_ms"] += saved_ms
+        return saved_ms
+
+class TSQClientProtocol(QuicConnectionProtocol):
+    """Connection protocol that remembers how the handshake completed and
+    matches DATAGRAM-mode responses to their requests by nonce"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.handshake = None
+        self.handshake_done_ns = None
+        self.terminated = False
+        self._datagram_waiters = {}   # nonce -> future of (response, t4)
+    
+    def datagrams_supported(self):
+        """True if the server advertised QUIC DATAGRAM support"""
+        return self._quic._remote_max_datagram_frame_size is not None
+    
+    def send_datagram_request(self, request, nonce):
+        """Send one TSQ request as a DATAGRAM frame; returns (future, t1)"""
+        waiter = self._loop.create_future()
+        self._datagram_waiters[nonce] = waiter
+        self._quic.send_datagram_frame(request)
+        t1 = time.time_ns()
+        self.transmit()
+        return waiter, t1
+    
+    def cancel_datagram_request(self, nonce):
+        self._datagram_waiters.pop(nonce, None)
+    
+    def close_without_linger(self):
+        """Send CONNECTION_CLOSE and count the connection as closed right away,
+        skipping the closing period (3 PTOs) of re-sending it to late packets"""
+        self.close()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._closed.set()
+    
+    def quic_event_received(self, event):
+        if isinstance(event, DatagramFrameReceived):
+            t4 = time.time_ns()
+            data = event.data
+            # Responses start with the echoed nonce; anything else is dropped
+            if len(data) >= 18 and data[0] == 1 and data[1] == 16:
+                waiter = self._datagram_waiters.pop(data[2:18], None)
+                if waiter is not None and not waiter.done():
+                    waiter.set_result((data, t4))
+        elif isinstance(event, HandshakeCompleted):
+            self.handshake = event
+            self.handshake_done_ns = time.perf_counter_ns()
+        elif isinstance(event, ConnectionTerminated):
+            self.terminated = True
+        super().quic_event_received(event)
+
+class QuicConnectionPool:
+    """One QUIC connection per (server, port); every query runs on a fresh stream"""
+    
+    def __init__(self, insecure=False, connect_timeout=3.0, ticket_cache=None, datagrams=False, spans=None):
+        self.insecure = insecure
+        self.spans = spans if spans is not None else PhaseSpans()
+        self.datagrams = datagrams
+        self.connect_timeout = connect_timeout
+        self.ticket_cache = ticket_cache
+        self._connections = {}   # (server, port) -> (client, exit_stack)
+        self._locks = {}
+        self._handshake_tasks = set()
+        self.handshake_ms = {}   # (server, port) -> handshake duration of the last connect
+        self.resumed = {}        # (server, port) -> (session_resumed, early_data_accepted)
+        self.saved_ms = 0.0      # handshake latency saved by resumption in this run
+        self.connects = 0        # completed handshakes
+        self.first_ready_ns = None   # when the first connection could take requests
+        self._configuration = None
+    
+    def _make_configuration(self):
+        """A copy of the client configuration, which is built once (aioquic sets
+        server_name and the session ticket on it, so each connection gets its own)"""
+        if self._configuration is None:
+            cfg = QuicConfiguration(is_client=True, alpn_protocols=["tsq/1"])
+            if self.insecure:
+                cfg.verify_mode = False
+            if self.datagrams:
+                cfg.max_datagram_frame_size = MAX_DATAGRAM_FRAME_SIZE
+            self._configuration = cfg
+        return copy.copy(self._configuration)
+    
+    async def get(self, server, port):
+        """Return the pooled connection for (server, port), handshaking on first use"""
+        key = (server, port)
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            entry = self._connections.get(key)
+            if entry is not None:
+                if not entry[0].terminated:
+                    return entry[0]
+                # Closed by the server (e.g. idle timeout) since the last query
+                await self.discard(server, port)
+            
+            cfg = self._make_configuration()
+            ticket_handler = None
+            if self.ticket_cache is not None:
+                cfg.session_ticket = self.ticket_cache.get(server, port)
+                ticket_handler = lambda ticket: self.ticket_cache.store(server, port, ticket)
+            
+            # A ticket that allows early data lets the first request ride in 0-RTT,
+            # so don't block on the handshake in that case
+            early_data = (cfg.session_ticket is not None
+                          and cfg.session_ticket.max_early_data_size is not None)
+            
+            stack = AsyncExitStack()
+            start = time.perf_counter_ns()
+            try:
+                client = await asyncio.wait_for(
+                    stack.enter_async_context(
+                        connect(server, port, configuration=cfg,
+                                create_protocol=TSQClientProtocol,
+                                session_ticket_handler=ticket_handler,
+                                wait_connected=not early_data)
+                    ),
+                    timeout=self.connect_timeout,
+                )
+            except BaseException:
+                await stack.aclose()
+                raise
+            self._connections[key] = (client, stack)
+            if self.first_ready_ns is None:
+                self.first_ready_ns = time.perf_counter_ns()
+            
+            if early_data:
+                task = asyncio.create_task(self._wait_handshake(key, client, start))
+                self._handshake_tasks.add(task)
+                task.add_done_callback(self._handshake_tasks.discard)
+            else:
+                self._record_handshake(key, client, start)
+            return client
+    
+    async def _wait_handshake(self, key, client, start):
+        try:
+            await client.wait_connected()
+        except Exception:
+            return
+        self._record_handshake(key, client, start)
+    
+    def _record_handshake(self, key, client, start):
+        self.connects += 1
+        self.spans.record("handshake", client.handshake_done_ns - start)
+        ms = (client.handshake_done_ns - start) / 1e6
+        resumed = bool(client.handshake.session_resumed)
+        early_data = bool(client.handshake.early_data_accepted)
+        self.handshake_ms[key] = ms
+        self.resumed[key] = (resumed, early_data)
+        if self.ticket_cache is not None:
+            self.saved_ms += self.ticket_cache.record(key[0], key[1], ms, resumed, early_data)
+    
+    async def discard(self, server, port, linger=True):
+        """Drop a connection that failed so the next query reconnects"""
+        entry = self._connections.pop((server, port), None)
+        if entry is not None:
+            try:
+                if not linger:
+                    entry[0].close_without_linger()
+                await entry[1].aclose()
+            except Exception:
+                pass
+    
+    async def close(self, linger=True):
+        """Close every pooled connection and persist any new session tickets.
+        
+        A one-shot run about to exit passes linger=False: the closing period
+        would otherwise add about three PTOs (~100ms) to every run.
+        """
+        for task in list(self._handshake_tasks):
+            task.cancel()
+        await asyncio.gather(*(
+            self.discard(server, port, linger) for server, port in list(self._connections)
+        ))
+        if self.ticket_cache is not None:
+            try:
+                self.ticket_cache.save()
+            except OSError as e:
+                print(f"[TSQ] Could not save session ticket cache: {e}", file=sys.stderr)
 
 class TSQAdjTime:
     def __init__(self, servers, port=443, insecure=False, queries=5, max_offset_ms=1000, 
-                 slew_threshold_ms=128, dry_run=False, verbose=False):
+                 slew_threshold_ms=128, dry_run=False, verbose=False,
+                 interval=0.05, deadline=5.0, min_good=2, ticket_cache_path=DEFAULT_TICKET_CACHE,
+                 mode="stream", probe_timeout=None, verifier=None, clock=None, show_timing=False,
+                 profiler=None):
         self.servers = servers
         self.port = port
         self.insecure = insecure
         self.queries = queries
+        self.interval = interval
+        self.deadline = deadline
+        self.min_good = min(min_good, queries)
         self.max_offset_ms = max_offset_ms
         self.slew_threshold_ms = slew_threshold_ms
         self.dry_run = dry_run
+        self.clock = clock if clock is not None else make_clock_backend(dry_run)
         self.verbose = verbose
         self.start_time = None
         self.end_time = None
+        self.ticket_cache = SessionTicketCache(ticket_cache_path) if ticket_cache_path else None
+        self.mode = mode
+        # Per-answer timeouts; --probe-timeout sets both
+        self.datagram_timeout = probe_timeout or DATAGRAM_TIMEOUT
+        self.stream_timeout = probe_timeout or STREAM_TIMEOUT
+        self.datagram_stats = {}   # server -> {"sent": n, "lost": n}
+        self.filters = {}          # server -> ClockFilter
+        self.server_quality = {}   # server -> (Clock Quality, Time Source Info) from its last response
+        self.last_used = {}        # server -> time of the filter sample last used for an adjustment
+        self.stream_fallback = set()
+        # Time per query phase (perf_counter_ns), logged on SIGUSR1 and with --timing
+        self.spans = PhaseSpans()
+        self.profiler = profiler
+        self.pool = QuicConnectionPool(insecure=insecure, ticket_cache=self.ticket_cache,
+                                       datagrams=(mode == "datagram"), spans=self.spans)
+        # With keys configured every request asks for a Signature Block (252)
+        # and unsigned or badly signed responses are rejected
+        self.verifier = verifier
+        self.request_flags = {T_SIGNATURE_REQUEST} if verifier else ()
+        self.timing = PhaseTimer()
+        self.show_timing = show_timing
         
     def log(self, message, level="INFO"):
         """Log with timestamp"""
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
         print(f"[{timestamp}] [{level}] {message}")
     
+    def log_spans(self, reason, write_profile=False):
+        """Log the query phase histograms (and write the --profile file so far)"""
+        self.log(f"Phase timings ({reason}):")
+        for line in self.spans.report() or ["no queries yet"]:
+            self.log(f"  {line}")
+        if write_profile and self.profiler is not None:
+            self.log(f"Profile: {self.profiler.samples} samples, {self.profiler.write()} stacks "
+                     f"written to {self.profiler.path}")
+    
+    async def exchange_datagram(self, client, server_ip, request, nonce):
+        """Send one request in a DATAGRAM frame and wait up to datagram_timeout for the answer"""
+        stats = self.datagram_stats.setdefault(server_ip, {"sent": 0, "lost": 0})
+        waiter, t1 = client.send_datagram_request(request, nonce)
+        self.timing.request_sent()
+        stats["sent"] += 1
+        try:
+            response_data, t4 = await asyncio.wait_for(waiter, timeout=self.datagram_timeout)
+        except asyncio.TimeoutError:
+            client.cancel_datagram_request(nonce)
+            stats["lost"] += 1
+            raise
+        return response_data, t1, t4
+    
     async def query_tsq_server(self, server_ip):
-        """Query a single TSQ server"""
+        """Query a single TSQ server on a new stream (or datagram) of its pooled connection"""
+        spans = self.spans
         try:
-            cfg = QuicConfiguration(is_client=True, alpn_protocols=["tsq/1"])
-            if self.insecure:
-                cfg.verify_mode = False
+            start = time.perf_counter_ns()
+            client = await self.pool.get(server_ip, self.port)
+            start = spans.end("connect", start)
             
-            async with connect(server_ip, self.port, configuration=cfg) as client:
-                nonce = os.urandom(16)
-                request = struct.pack("!BB", 1, 16) + nonce
-                
+            nonce = os.urandom(16)
+            request = encode_request(nonce, self.request_flags)
+            
+            if self.mode == "datagram" and client.datagrams_supported():
+                try:
+                    response_data, t1, t4 = await self.exchange_datagram(client, server_ip, request, nonce)
+                    start = spans.end("wait", start)
+                except asyncio.TimeoutError:
+                    # A lost datagram is not a broken connection
+                    if self.verbose:
+                        self.log(f"Datagram probe to {server_ip} lost", "WARN")
+                    return None, None
+            else:
+                # Streams are also the fallback when the server has no datagram support
+                if self.mode == "datagram" and server_ip not in self.stream_fallback:
+                    self.stream_fallback.add(server_ip)
+                    self.log(f"{server_ip} does not support datagrams, using streams", "WARN")
                 reader, writer = await client.create_stream()
+                start = spans.end("stream_open", start)
                 writer.write(request)
                 t1 = time.time_ns()
-                await writer.drain()
+                writer.write_eof()
+                self.timing.request_sent()
+                start = spans.end("send", start)
                 
-                response_data = await asyncio.wait_for(reader.read(100), timeout=3.0)
+                # The server ends the stream after answering: read to EOF so a
+                # response of any size (metadata, padding, signature) is whole
+                response_data = await asyncio.wait_for(reader.read(), timeout=self.stream_timeout)
                 t4 = time.time_ns()
-                
-                if len(response_data) == 0:
-                    return None, None
-                
-                # Parse TLV response
-                offset = 0
-                t2_ntp = None
-                t3_ntp = None
-                
-                while offset < len(response_data):
-                    if offset + 2 > len(response_data):
-                        break
-                    tlv_type = response_data[offset]
-                    tlv_len = response_data[offset + 1]
-                    tlv_val = response_data[offset + 2:offset + 2 + tlv_len]
-                    
-                    if tlv_type == 2:
-                        t2_ntp = tlv_val
-                    elif tlv_type == 3:
-                        t3_ntp = tlv_val
-                    
-                    offset += 2 + tlv_len
-                
-                if not t2_ntp or not t3_ntp:
+                start = spans.end("wait", start)
+            
+            if len(response_data) == 0:
+                return None, None
+            
+            try:
+                echoed_nonce, t2, t3, tlvs = decode_response(response_data)
+                start = spans.end("parse", start)
+            except TSQError as e:
+                # The server answered; only this request failed
+                self.log(f"{server_ip} rejected the request: {e}", "WARN")
+                return None, None
+            
+            if echoed_nonce != nonce:
+                self.log(f"Response from {server_ip} has a mismatched nonce, discarding", "WARN")
+                return None, None
+            
+            if self.verifier is not None:
+                try:
+                    self.verifier.verify(response_data)
+                    spans.end("verify", start)
+                except ValueError as e:
+                    self.log(f"Response from {server_ip} failed signature check ({e}), discarding", "WARN")
                     return None, None
-                
-                # Convert NTP timestamps to nanoseconds
-                NTP_EPOCH_OFFSET = 2208988800
-                ntp_seconds, ntp_fraction = struct.unpack("!II", t2_ntp)
-                t2 = (ntp_seconds - NTP_EPOCH_OFFSET) * 1_000_000_000 + int((ntp_fraction * 1_000_000_000) / 2**32)
-                
-                ntp_seconds, ntp_fraction = struct.unpack("!II", t3_ntp)
-                t3 = (ntp_seconds - NTP_EPOCH_OFFSET) * 1_000_000_000 + int((ntp_fraction * 1_000_000_000) / 2**32)
-                
-                # Calculate offset and RTT
-                rtt_ns = (t4 - t1) - (t3 - t2)
-                offset_ns = ((t2 - t1) + (t3 - t4)) // 2
-                
-                writer.close()
-                return offset_ns / 1e6, rtt_ns / 1e6  # Convert to ms
-                
+            
+            if t2 is None or t3 is None:
+                return None, None
+            
+            if T_CLOCK_QUALITY in tlvs or T_TIME_SOURCE in tlvs:
+                quality = decode_clock_quality(tlvs[T_CLOCK_QUALITY]) if T_CLOCK_QUALITY in tlvs else None
+                source = decode_time_source(tlvs[T_TIME_SOURCE]) if T_TIME_SOURCE in tlvs else None
+                self.server_quality[server_ip] = (quality, source)
+            
+            # Calculate offset and RTT
+            rtt_ns = (t4 - t1) - (t3 - t2)
+            offset_ns = ((t2 - t1) + (t3 - t4)) // 2
+            
+            return offset_ns / 1e6, rtt_ns / 1e6  # Convert to ms
+            
         except Exception as e:
             if self.verbose:
                 self.log(f"Error querying {server_ip}: {e}", "ERROR")
+            await self.pool.discard(server_ip, self.port)
             return None, None
     
-    async def measure_offsets(self):
-        """Query all servers multiple times and collect offsets"""
-        self.log(f"Querying {len(self.servers)} server(s), {self.queries} times each...")
-        
-        all_offsets = []
-        all_rtts = []
+    async def sample_server(self, server, offsets, rtts):
+        """Burst queries at one server until its clock filter holds enough good samples"""
+        clock_filter = self.filters.setdefault(server, ClockFilter())
         
         for query_num in range(self.queries):
-            if self.verbose:
-                self.log(f"Query round {query_num + 1}/{self.queries}")
+            offset, rtt = await self.query_tsq_server(server)
+            source = self.server_quality.get(server, (None, None))[1]
+            if source is not None and source[0] == 0:
+                # Its own clock is unsynchronized: more samples would be wasted
+                self.log(f"  {server}: reports it is unsynchronized (stratum 0), not sampling it", "WARN")
+                return
+            if offset is not None:
+                offsets.append(offset)
+                rtts.append(rtt)
+                clock_filter.add(offset, rtt, time.monotonic())
+                if self.verbose:
+                    self.log(f"  {server}: offset={offset:.3f}ms, rtt={rtt:.3f}ms")
+            else:
+                self.log(f"  {server}: FAILED", "WARN")
             
-            for server in self.servers:
-                offset, rtt = await self.query_tsq_server(server)
-                if offset is not None:
-                    all_offsets.append(offset)
-                    all_rtts.append(rtt)
-                    if self.verbose:
-                        self.log(f"  {server}: offset={offset:.3f}ms, rtt={rtt:.3f}ms")
-                else:
-                    self.log(f"  {server}: FAILED", "WARN")
+            # Stop early once this server has enough low-RTT samples (in
+            # daemon mode the filter keeps samples from earlier polls)
+            if clock_filter.good() >= self.min_good:
+                break
             
-            # Small delay between rounds
             if query_num < self.queries - 1:
-                await asyncio.sleep(0.5)
+                await asyncio.sleep(self.interval)
+    
+    async def measure_offsets(self):
+        """Query all servers concurrently and collect offsets before the sync deadline"""
+        self.log(f"Querying {len(self.servers)} server(s), up to {self.queries} times each...")
+        
+        all_offsets = []
+        all_rtts = []
+        
+        tasks = [
+            asyncio.create_task(self.sample_server(server, all_offsets, all_rtts))
+            for server in self.servers
+        ]
+        done, pending = await asyncio.wait(tasks, timeout=self.deadline)
+        
+        if pending:
+            self.log(f"Sync deadline of {self.deadline:.2f}s reached, "
+                     f"using {len(all_offsets)} sample(s)", "WARN")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
         
         return all_offsets, all_rtts
     
-    def calculate_adjustment(self, offsets, rtts):
-        """Calculate the time adjustment to apply"""
-        if not offsets:
+    def log_handshakes(self):
+        """Report connection setup cost separately from the per-sample RTT"""
+        handshakes = self.pool.handshake_ms
+        if not handshakes:
+            return
+        if self.verbose:
+            for key, ms in handshakes.items():
+                resumed, early_data = self.pool.resumed.get(key, (False, False))
+                mode = "0-RTT" if early_data else "resumed" if resumed else "full"
+                self.log(f"  {key[0]}:{key[1]}: handshake={ms:.3f}ms ({mode})")
+        total = sum(handshakes.values())
+        import statistics
+        self.log(f"Handshakes: {len(handshakes)} connection(s), total={total:.3f}ms, "
+                 f"median={statistics.median(handshakes.values()):.3f}ms")
+        
+        if self.ticket_cache is not None:
+            resumed = sum(1 for r, _ in self.pool.resumed.values() if r)
+            early = sum(1 for _, e in self.pool.resumed.values() if e)
+            stats = self.ticket_cache.stats
+            lifetime_rate = 100.0 * stats["resumed"] / stats["connections"] if stats["connections"] else 0.0
+            self.log(f"Session resumption: {resumed}/{len(self.pool.resumed)} resumed "
+                     f"({early} with 0-RTT), saved {self.pool.saved_ms:.3f}ms; "
+                     f"lifetime hit rate {lifetime_rate:.1f}% "
+                     f"({stats['resumed']}/{stats['connections']}), saved {stats['saved_ms']:.1f}ms")
+    
+    def log_datagram_loss(self):
+        """Report DATAGRAM probes sent and lost per run"""
+        if self.mode != "datagram":
+            return
+        sent = sum(stats["sent"] for stats in self.datagram_stats.values())
+        lost = sum(stats["lost"] for stats in self.datagram_stats.values())
+        if self.verbose:
+            for server, stats in self.datagram_stats.items():
+                self.log(f"  {server}: datagrams sent={stats['sent']} lost={stats['lost']}")
+        loss_pct = 100.0 * lost / sent if sent else 0.0
+        self.log(f"Datagram probes: sent={sent}, lost={lost} ({loss_pct:.1f}%)")
+    
+    def calculate_adjustment(self, detail=True):
+        """Select the servers that agree and combine their filtered offsets.
+        
+        Each server contributes its lowest-delay recent sample. Its correctness
+        interval is that offset +- its distance (half the delay plus dispersion
+        and jitter, widened by the server's Clock Quality error and stratum when
+        it sends them); servers outside the interval shared by a majority are
+        rejected as falsetickers, and the rest are averaged weighted by 1/distance.
+        Returns (offset_ms, jitter_ms, delay_ms, fresh); fresh is False when no
+        selected server has a sample newer than the previous call used.
+        """
+        now = time.monotonic()
+        candidates = []
+        chosen = {}
+        for server, clock_filter in self.filters.items():
+            best = clock_filter.best(now)
+            if best is None:
+                continue
+            offset, delay, jitter, dispersion, when = best
+            distance = delay / 2 + dispersion + jitter
+            quality, source = self.server_quality.get(server, (None, None))
+            info = ""
+            if source is not None:
+                stratum = source[0]
+                if stratum == 0:
+                    self.log(f"  {server}: reports it is unsynchronized (stratum 0), not used", "WARN")
+                    continue
+                distance += (stratum - 1) * STRATUM_DISTANCE_MS
+                info += f" stratum={stratum}"
+            if quality is not None:
+                distance += quality[1] / 1000.0
+                if quality[0] == CLOCK_CLASS_HOLDOVER:
+                    distance *= 2
+                info += f" class={quality[0]} error={quality[1]}us"
+            candidates.append((server, offset, distance))
+            chosen[server] = (offset, delay, jitter, distance, when)
+            if detail:
+                self.log(f"  {server}: offset={offset:.3f}ms delay={delay:.3f}ms jitter={jitter:.3f}ms "
+                         f"distance={distance:.3f}ms ({len(clock_filter.samples)} samples){info}")
+        if not candidates:
             raise ValueError("No valid measurements received")
         
-        # Use median to reject outliers
-        median_offset = statistics.median(offsets)
-        stdev_offset = statistics.stdev(offsets) if len(offsets) > 1 else 0
-        median_rtt = statistics.median(rtts)
+        survivors = select_truechimers(candidates)
+        if not survivors:
+            raise ValueError(f"No majority of the {len(candidates)} servers agree on the time")
+        falsetickers = [server for server, _, _ in candidates if server not in survivors]
+        if falsetickers:
+            self.log(f"Falsetickers rejected: {', '.join(falsetickers)}", "WARN")
         
-        self.log(f"Measurements: {len(offsets)} samples")
-        self.log(f"  Offset: median={median_offset:.3f}ms, stdev={stdev_offset:.3f}ms")
-        self.log(f"  RTT: median={median_rtt:.3f}ms")
+        weights = {server: 1.0 / max(chosen[server][3], 1e-6) for server in survivors}
+        total = sum(weights.values())
+        offset = sum(chosen[server][0] * w for server, w in weights.items()) / total
+        # System jitter: spread of the survivors around the combined offset,
+        # plus the jitter of the best one
+        system_peer = min(survivors, key=lambda server: chosen[server][3])
+        selection_jitter = math.sqrt(sum(w * (chosen[server][0] - offset) ** 2
+                                         for server, w in weights.items()) / total)
+        jitter = math.sqrt(selection_jitter ** 2 + chosen[system_peer][2] ** 2)
+        delay = chosen[system_peer][1]
+        
+        fresh = False
+        for server in survivors:
+            if chosen[server][4] > self.last_used.get(server, float("-inf")):
+                fresh = True
+                self.last_used[server] = chosen[server][4]
+        
+        if detail:
+            self.log(f"Selection: {len(survivors)}/{len(candidates)} server(s) agree, "
+                     f"system peer {system_peer}")
+            self.log(f"  Offset: combined={offset:.3f}ms, jitter={jitter:.3f}ms, delay={delay:.3f}ms")
         
         # Check if offset is within acceptable range
-        if abs(median_offset) > self.max_offset_ms:
-            raise ValueError(f"Offset too large: {median_offset:.3f}ms (max: {self.max_offset_ms}ms)")
+        if abs(offset) > self.max_offset_ms:
+            raise ValueError(f"Offset too large: {offset:.3f}ms (max: {self.max_offset_ms}ms)")
         
-        return median_offset, stdev_offset
+        return offset, jitter, delay, fresh
     
-    def adjust_clock(self, offset_ms):
-        """Adjust system clock by offset_ms milliseconds"""
+    async def adjust_clock(self, offset_ms):
+        """Adjust system clock by offset_ms milliseconds (the system call runs off the event loop)"""
         if self.dry_run:
-            self.log(f"DRY RUN: Would adjust clock by {offset_ms:.3f}ms")
-            return True
+            self.log(f"DRY RUN: adjusting a simulated clock by {offset_ms:.3f}ms")
+        elif not (IS_LINUX or IS_MACOS):
+            self.log(f"Unsupported OS: {sys.platform}", "ERROR")
+            self.log("Clock adjustment only supported on Linux and macOS", "ERROR")
+            return False
         
+        offset_ns = int(offset_ms * 1e6)
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter_ns()
         try:
-            if IS_LINUX:
-                return self._adjust_clock_linux(offset_ms)
-            elif IS_MACOS:
-                return self._adjust_clock_macos(offset_ms)
-            else:
-                self.log(f"Unsupported OS: {platform.system()}", "ERROR")
-                self.log("Clock adjustment only supported on Linux and macOS", "ERROR")
-                return False
+            if isinstance(self.clock, MacClockBackend):
+                return await self._adjust_clock_macos(loop, offset_ms, offset_ns)
+            return await self._adjust_clock_linux(loop, offset_ms, offset_ns)
         except Exception as e:
             self.log(f"Error adjusting clock: {e}", "ERROR")
             return False
+        finally:
+            self.spans.end("adjust", start)
+    
+    def log_adjustment(self, action, result):
+        method, latency_ns, residual_ns = result
+        self.log(f"Clock {action} via {method}: latency={latency_ns / 1000:.1f}us, "
+                 f"residual error={residual_ns}ns")
     
-    def _adjust_clock_linux(self, offset_ms):
+    async def _adjust_clock_linux(self, loop, offset_ms, offset_ns):
         """Adjust clock on Linux using adjtimex"""
-        # Convert ms to microseconds for adjtimex
-        offset_us = int(offset_ms * 1000)
-        
         # Determine if we should slew or step
         if abs(offset_ms) <= self.slew_threshold_ms:
             # Slew (gradual adjustment)
             self.log(f"Slewing clock by {offset_ms:.3f}ms (gradual adjustment)")
-            
-            libc = ctypes.CDLL(ctypes.util.find_library("c"))
-            tx = Timex()
-            tx.modes = ADJ_OFFSET | ADJ_MICRO
-            tx.offset = offset_us
-            
-            result = libc.adjtimex(ctypes.byref(tx))
-            if result == -1:
-                self.log("Failed to adjust clock via adjtimex", "ERROR")
-                return False
-            
-            self.log(f"Clock slewed successfully (will adjust gradually)")
-            
+            result = await loop.run_in_executor(None, self.clock.slew, offset_ns)
+            self.log_adjustment("slew started", result)
         else:
-            # Step (immediate adjustment)
+            # Step (immediate adjustment), relative to the clock at the moment of the call
             self.log(f"Stepping clock by {offset_ms:.3f}ms (immediate adjustment)")
-            
-            # Use settimeofday for immediate step
-            import subprocess
-            offset_sec = offset_ms / 1000.0
-            result = subprocess.run(
-                ["date", "-s", f"@{time.time() + offset_sec}"],
-                capture_output=True
-            )
-            
-            if result.returncode != 0:
-                self.log(f"Failed to step clock: {result.stderr.decode()}", "ERROR")
-                return False
-            
-            self.log(f"Clock stepped successfully")
-        
+            result = await loop.run_in_executor(None, self.clock.step, offset_ns)
+            self.log_adjustment("stepped", result)
         return True
     
-    def _adjust_clock_macos(self, offset_ms):
+    async def _adjust_clock_macos(self, loop, offset_ms, offset_ns):
         """Adjust clock on macOS using adjtime"""
         # macOS only supports slew (gradual adjustment)
         # The slew_threshold parameter is ignored on macOS
         
         if abs(offset_ms) > self.slew_threshold_ms:
-            self.log(f"Note: macOS only supports gradual adjustment (slew)", "WARN")
+            self.log("Note: macOS only supports gradual adjustment (slew)", "WARN")
             self.log(f"Large offset of {offset_ms:.3f}ms will be adjusted gradually", "WARN")
         
         self.log(f"Slewing clock by {offset_ms:.3f}ms (gradual adjustment)")
+        result = await loop.run_in_executor(None, self.clock.slew, offset_ns)
+        self.log_adjustment("slew started", result)
+        self.log("Note: macOS slew rate is fixed at ~500 ppm", "INFO")
+        return True
+    
+    async def poll_once(self, discipline, poll_exp):
+        """One daemon poll on the warm connections; returns (offset_ms, jitter_ms) or None"""
+        connects = self.pool.connects
+        offsets, rtts = await self.measure_offsets()
+        if self.pool.connects != connects:
+            # Only when a connection was (re)established during this poll
+            self.log_handshakes()
+        try:
+            offset_ms, jitter_ms, rtt_ms, fresh = self.calculate_adjustment(detail=self.verbose)
+        except ValueError as e:
+            self.log(f"{e}, not adjusting", "ERROR")
+            return None
         
-        # Convert ms to seconds and microseconds
-        offset_sec = int(offset_ms / 1000)
-        offset_usec = int((offset_ms % 1000) * 1000)
+        if not fresh:
+            # The filters still prefer samples an earlier poll already used
+            self.log(f"Poll: no new low-delay samples (offset={offset_ms:+.3f}ms), "
+                     f"samples={len(offsets)} poll={2 ** poll_exp}s")
+            return offset_ms, jitter_ms
+        if abs(offset_ms) > self.slew_threshold_ms:
+            # Too far off to slew: step once and let the PLL start over
+            await self.adjust_clock(offset_ms)
+            for clock_filter in self.filters.values():
+                clock_filter.clear()
+            freq = discipline.freq_ppm
+        else:
+            start = time.perf_counter_ns()
+            try:
+                freq = await asyncio.get_running_loop().run_in_executor(
+                    None, discipline.update, offset_ms, jitter_ms, rtt_ms, poll_exp)
+                self.spans.end("adjust", start)
+            except OSError as e:
+                self.log(f"Error disciplining clock: {e}", "ERROR")
+                return None
+        freq_text = f"{freq:+.3f}ppm" if freq is not None else "n/a"
+        self.log(f"Poll: offset={offset_ms:+.3f}ms jitter={jitter_ms:.3f}ms rtt={rtt_ms:.3f}ms "
+                 f"freq={freq_text} samples={len(offsets)} poll={2 ** poll_exp}s")
+        return offset_ms, jitter_ms
+    
+    async def run_daemon(self, discipline, min_poll_exp=MIN_POLL_EXP, max_poll_exp=MAX_POLL_EXP):
+        """Poll continuously on warm connections and discipline the clock until SIGTERM or SIGINT"""
+        self.log("="*70)
+        self.log("TSQ Client Daemon Starting")
+        self.log("="*70)
+        self.log(f"Servers: {', '.join(self.servers)}")
+        self.log(f"Port: {self.port}")
+        self.log(f"Mode: {self.mode}")
+        self.log(f"Poll interval: {2 ** min_poll_exp}s - {2 ** max_poll_exp}s")
+        self.log(f"Max offset: {self.max_offset_ms}ms")
+        self.log(f"Step threshold: {self.slew_threshold_ms}ms")
+        if self.dry_run:
+            self.log("DRY RUN MODE - No actual clock adjustment", "WARN")
         
-        libc = ctypes.CDLL(ctypes.util.find_library("c"))
+        try:
+            discipline.start()
+        except OSError as e:
+            self.log(f"Cannot start clock discipline: {e}", "ERROR")
+            return False
         
-        # Create delta timeval
-        delta = Timeval()
-        delta.tv_sec = offset_sec
-        delta.tv_usec = offset_usec
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
         
-        # Create olddelta timeval (we don't use it but adjtime requires it)
-        olddelta = Timeval()
+        poll_exp = min_poll_exp
+        counter = 0
+        try:
+            while not stop.is_set():
+                result = await self.poll_once(discipline, poll_exp)
+                if result is None:
+                    poll_exp, counter = min_poll_exp, 0
+                elif abs(result[0]) > self.slew_threshold_ms:
+                    poll_exp, counter = min_poll_exp, 0
+                else:
+                    poll_exp, counter = adapt_poll(poll_exp, counter, result[0], result[1],
+                                                   min_poll_exp, max_poll_exp)
+                    discipline.save()
+                if self.ticket_cache is not None:
+                    try:
+                        self.ticket_cache.save()
+                    except OSError as e:
+                        self.log(f"Could not save session ticket cache: {e}", "WARN")
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=2 ** poll_exp)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await self.pool.close()
+            discipline.save()
+            self.log_spans("daemon stopped")
+            self.log("TSQ Client Daemon stopped")
+        return True
+    
+    async def apply_measurements(self, offsets):
+        """Log the sampling results, then select, combine and apply the offset"""
+        self.log_handshakes()
+        self.log_datagram_loss()
         
-        # Call adjtime
-        result = libc.adjtime(ctypes.byref(delta), ctypes.byref(olddelta))
-        if result == -1:
-            self.log("Failed to adjust clock via adjtime", "ERROR")
+        if not offsets:
+            self.log("No valid measurements received", "ERROR")
             return False
         
-        self.log(f"Clock slewed successfully (will adjust gradually)")
-        self.log(f"Note: macOS slew rate is fixed at ~500 ppm", "INFO")
+        self.log("")
+        
+        # Calculate adjustment
+        self.log(f"Measurements: {len(offsets)} samples from {len(self.filters)} server(s)")
+        offset_ms, jitter_ms, _, _ = self.calculate_adjustment()
         
-        return True
+        self.log("")
+        self.log(f"Calculated adjustment: {offset_ms:.3f}ms ± {jitter_ms:.3f}ms")
+        
+        # Apply adjustment
+        return await self.adjust_clock(offset_ms)
     
     async def sync(self):
         """Main synchronization routine"""
@@ -304,7 +1175,9 @@ class TSQAdjTime:
         self.log("="*70)
         self.log(f"Servers: {', '.join(self.servers)}")
         self.log(f"Port: {self.port}")
-        self.log(f"Queries per server: {self.queries}")
+        self.log(f"Mode: {self.mode}")
+        self.log(f"Queries per server: {self.queries} (stop after {self.min_good} good)")
+        self.log(f"Query interval: {self.interval * 1000:.0f}ms, deadline: {self.deadline:.2f}s")
         self.log(f"Max offset: {self.max_offset_ms}ms")
         self.log(f"Slew threshold: {self.slew_threshold_ms}ms")
         if self.dry_run:
@@ -312,23 +1185,19 @@ class TSQAdjTime:
         self.log("")
         
         try:
-            # Measure offsets
-            offsets, rtts = await self.measure_offsets()
-            
-            if not offsets:
-                self.log("No valid measurements received", "ERROR")
-                return False
-            
-            self.log("")
-            
-            # Calculate adjustment
-            offset_ms, stdev_ms = self.calculate_adjustment(offsets, rtts)
-            
-            self.log("")
-            self.log(f"Calculated adjustment: {offset_ms:.3f}ms ± {stdev_ms:.3f}ms")
-            
-            # Apply adjustment
-            success = self.adjust_clock(offset_ms)
+            self.timing.mark("setup")
+            try:
+                offsets, rtts = await self.measure_offsets()
+                if self.pool.first_ready_ns is not None:
+                    self.timing.mark("handshake", self.pool.first_ready_ns)
+                self.timing.mark("sampling")
+                success = await self.apply_measurements(offsets)
+                self.timing.mark("adjustment")
+            finally:
+                # Closing waits out QUIC's closing period, so it happens after
+                # the clock is set rather than between measuring and adjusting
+                await self.pool.close(linger=False)
+                self.timing.mark("close")
             
             self.end_time = time.time()
             duration = (self.end_time - self.start_time) * 1000
@@ -340,6 +1209,9 @@ class TSQAdjTime:
             else:
                 self.log("TSQ Time Synchronization FAILED", "ERROR")
             self.log(f"Total sync duration: {duration:.1f}ms")
+            if self.show_timing:
+                self.log(f"Timing: {self.timing.report()}")
+                self.log_spans("exit")
             self.log("="*70)
             
             return success
@@ -355,7 +1227,7 @@ class TSQAdjTime:
             self.log("="*70)
             return False
 
-async def main():
+def parse_args():
     parser = argparse.ArgumentParser(
         description="TSQ Time Adjustment Tool - Synchronize system clock using TSQ"
     )
@@ -367,6 +1239,44 @@ async def main():
                         help="Maximum allowed offset in ms (default: 1000)")
     parser.add_argument("--slew-threshold", type=float, default=500,
                         help="Threshold for slew vs step in ms (default: 500)")
+    parser.add_argument("--interval", type=float, default=0.05,
+                        help="Delay between queries to the same server in seconds (default: 0.05)")
+    parser.add_argument("--deadline", type=float, default=5.0,
+                        help="Overall sampling deadline in seconds (default: 5.0)")
+    parser.add_argument("--min-good", type=int, default=2,
+                        help="Stop querying a server after this many low-RTT samples (default: 2)")
+    parser.add_argument("--mode", choices=["stream", "datagram"], default="stream",
+                        help="Send requests on QUIC streams or DATAGRAM frames (default: stream)")
+    parser.add_argument("--probe-timeout", type=float,
+                        help=f"Seconds to wait for each answer before it counts as lost or failed "
+                             f"(default: {DATAGRAM_TIMEOUT:g} for datagrams, {STREAM_TIMEOUT:g} for streams)")
+    parser.add_argument("--ticket-cache", default=DEFAULT_TICKET_CACHE,
+                        help=f"TLS session ticket cache file (default: {DEFAULT_TICKET_CACHE})")
+    parser.add_argument("--no-ticket-cache", action="store_true",
+                        help="Always do a full handshake; don't read or write session tickets")
+    parser.add_argument("--hmac-key", action="append", default=[], metavar="FILE",
+                        help="Require responses signed with this HMAC-SHA256 shared secret (repeatable)")
+    parser.add_argument("--verify-key", action="append", default=[], metavar="FILE",
+                        help="Require responses signed by this Ed25519 public key (PEM, repeatable)")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Keep running: poll on warm connections and discipline the clock (Linux)")
+    parser.add_argument("--min-poll", type=int, default=2 ** MIN_POLL_EXP,
+                        help=f"Daemon: shortest poll interval in seconds, rounded down to a power of two "
+                             f"(default: {2 ** MIN_POLL_EXP})")
+    parser.add_argument("--max-poll", type=int, default=2 ** MAX_POLL_EXP,
+                        help=f"Daemon: longest poll interval in seconds (default: {2 ** MAX_POLL_EXP})")
+    parser.add_argument("--drift-file", default=DEFAULT_DRIFT_FILE,
+                        help=f"Daemon: file keeping the learned clock frequency (default: {DEFAULT_DRIFT_FILE})")
+    parser.add_argument("--uvloop", action="store_true",
+                        help="Run on the uvloop event loop if it is installed")
+    parser.add_argument("--timing", action="store_true",
+                        help="Log how long startup, imports, setup, handshake, sampling, adjustment "
+                             "and close took, and per-query phase timings (one-shot runs)")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="Sample the event loop's Python stack and write folded stacks for "
+                             "flamegraph.pl or speedscope at exit and on SIGUSR1")
+    parser.add_argument("--profile-interval", type=float, default=1.0, metavar="MS",
+                        help="Milliseconds between --profile samples (default: 1)")
     parser.add_argument("--dry-run", action="store_true", help="Don't actually adjust clock")
     parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
     
@@ -381,10 +1291,50 @@ async def main():
         print("Error: Queries must be between 1 and 100", file=sys.stderr)
         sys.exit(1)
     
+    if args.interval < 0 or args.deadline <= 0:
+        print("Error: Interval must be >= 0 and deadline must be > 0", file=sys.stderr)
+        sys.exit(1)
+    
+    if args.min_good < 1:
+        print("Error: Min-good must be at least 1", file=sys.stderr)
+        sys.exit(1)
+    
+    if args.probe_timeout is not None and args.probe_timeout <= 0:
+        print("Error: Probe-timeout must be > 0", file=sys.stderr)
+        sys.exit(1)
+    
+    if args.profile_interval <= 0:
+        print("Error: Profile-interval must be > 0", file=sys.stderr)
+        sys.exit(1)
+    
     if not args.servers:
         print("Error: At least one server must be specified", file=sys.stderr)
         sys.exit(1)
     
+    if args.daemon:
+        if not IS_LINUX and not args.dry_run:
+            print("Error: Daemon mode requires Linux (adjtimex)", file=sys.stderr)
+            sys.exit(1)
+        if args.min_poll < 1 or args.max_poll < args.min_poll:
+            print("Error: Min-poll must be >= 1 and max-poll must be >= min-poll", file=sys.stderr)
+            sys.exit(1)
+        # Line-buffered output for the systemd journal
+        sys.stdout.reconfigure(line_buffering=True)
+    
+    return args
+
+async def main(args, profiler=None):
+    verifier = None
+    if args.hmac_key or args.verify_key:
+        from tsq_sign import ResponseVerifier
+        try:
+            verifier = ResponseVerifier.from_files(args.hmac_key, args.verify_key)
+        except (OSError, ValueError) as e:
+            print(f"Error: Cannot load signature key: {e}", file=sys.stderr)
+            sys.exit(1)
+    elif args.mode == "datagram":
+        print("WARNING: Datagram responses are unauthenticated without --hmac-key or --verify-key", file=sys.stderr)
+    
     # Warn about insecure mode
     if args.insecure:
         print("WARNING: Certificate verification disabled!", file=sys.stderr)
@@ -399,11 +1349,47 @@ async def main():
         max_offset_ms=args.max_offset,
         slew_threshold_ms=args.slew_threshold,
         dry_run=args.dry_run,
-        verbose=args.verbose
+        verbose=args.verbose,
+        interval=args.interval,
+        deadline=args.deadline,
+        min_good=args.min_good,
+        ticket_cache_path=None if args.no_ticket_cache else args.ticket_cache,
+        mode=args.mode,
+        probe_timeout=args.probe_timeout,
+        verifier=verifier,
+        show_timing=args.timing,
+        profiler=profiler
     )
+    # kill -USR1 logs the phase timings so far (e.g. of a running daemon)
+    if not add_sigusr1_handler(asyncio.get_running_loop(), adjtime.log_spans, "SIGUSR1", True) and profiler:
+        adjtime.log("No SIGUSR1 on this platform, the profile is written at exit only", "WARN")
     
-    success = await adjtime.sync()
+    if args.daemon:
+        discipline = ClockDiscipline(adjtime.log, adjtime.clock, drift_file=args.drift_file)
+        success = await adjtime.run_daemon(discipline, int(math.log2(args.min_poll)), int(math.log2(args.max_poll)))
+    else:
+        success = await adjtime.sync()
     sys.exit(0 if success else 1)
 
+def use_uvloop():
+    """Switch asyncio to uvloop; returns False (with a warning) if it is not installed"""
+    try:
+        import uvloop
+    except ImportError:
+        print("WARNING: --uvloop given but uvloop is not installed, using asyncio", file=sys.stderr)
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    args = parse_args()
+    if args.uvloop:
+        use_uvloop()
+    profiler = SamplingProfiler(args.profile, args.profile_interval / 1000).start() if args.profile else None
+    try:
+        asyncio.run(main(args, profiler))
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            print(f"[TSQ] Profile: {profiler.samples} samples, {profiler.write()} stacks "
+                  f"written to {profiler.path}", file=sys.stderr)
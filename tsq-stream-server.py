@@ -4,12 +4,70 @@ import asyncio
 import struct
 import time
 import argparse
+import ctypes
+import multiprocessing
+import os
+import signal
 import sys
 from datetime import datetime, timezone
+import aioquic
 from aioquic.asyncio import QuicConnectionProtocol
+from aioquic.asyncio.server import QuicServer
 from aioquic.quic.configuration import QuicConfiguration
-from aioquic.quic.events import QuicEvent, StreamDataReceived
+from aioquic.quic.packet import QuicErrorCode
+from aioquic.quic.events import (
+    ConnectionTerminated,
+    DatagramFrameReceived,
+    HandshakeCompleted,
+    QuicEvent,
+    StreamDataReceived,
+)
+from aioquic.tls import CipherSuite, SessionTicket
+import collections
 import socket
+from collections import OrderedDict
+from tsq_codec import (
+    CLOCK_CLASS_GNSS,
+    CLOCK_CLASS_HOLDOVER,
+    CLOCK_CLASS_NTP,
+    CLOCK_CLASS_PTP,
+    CLOCK_CLASS_UNKNOWN,
+    ERR_MALFORMED,
+    ERR_RATE_LIMITED,
+    ERR_REPLAYED,
+    ERR_UNSUPPORTED,
+    SOURCE_GPS,
+    SOURCE_MANUAL,
+    SOURCE_NTP,
+    SOURCE_PTP,
+    SOURCE_UNKNOWN,
+    T_METADATA_QUERY,
+    T_NONCE,
+    T_PADDING,
+    T_PRECISION,
+    T_SIGNATURE_REQUEST,
+    ResponseEncoder,
+    TSQError,
+    decode_request,
+    encode_clock_quality,
+    encode_error,
+    encode_metadata,
+    encode_time_source,
+    tlv_pack,
+)
+from tsq_clock import FREQ_SCALE, STA_PPSSIGNAL, STA_PPSTIME, STA_UNSYNC, TIME_ERROR, read_kernel_clock
+from tsq_sign import ResponseSigner
+from tsq_replay import LINE_BYTES, ReplayCache, block_count
+from tsq_metrics import (
+    Histogram,
+    LogWriter,
+    PhaseSpans,
+    SamplingProfiler,
+    add_sigusr1_handler,
+    prometheus_metric,
+    rss_bytes,
+    serve_metrics,
+)
 
 # Force unbuffered output for systemd
 sys.stdout.reconfigure(line_buffering=True)
@@ -17,159 +75,1287 @@ sys.stdout.reconfigure(line_buffering=True)
 VERSION = "2024-11-05-12:18"
 ALPN = ["tsq/1"]
 
-# TLV: 1 byte Type, 1 byte Length (per draft-mccollum-ntp-tsq-01), then Value
-# Types:
-#   1 = Nonce (16 bytes)
-#   2 = Receive Timestamp (8 bytes, NTP format)
-#   3 = Send Timestamp (8 bytes, NTP format)
-
-T_NONCE = 1
-T_RECV_TS = 2
-T_SEND_TS = 3
-
-def tlv_unpack(data: bytes):
-    """Unpack a single TLV from data. Returns (type, value, bytes_consumed)."""
-    if len(data) < 2:
-        raise ValueError("TLV too short")
-    t = data[0]
-    l = data[1]
-    if len(data) < 2 + l:
-        raise ValueError("TLV length mismatch")
-    v = data[2:2+l]
-    return t, v, 2 + l
-
-def tlv_pack(t: int, v: bytes) -> bytes:
-    """Pack a TLV with 1-byte length field."""
-    if len(v) > 255:
-        raise ValueError("TLV value too long (max 255 bytes)")
-    return struct.pack("!BB", t, len(v)) + v
-
-def parse_tlvs(data: bytes) -> list:
-    """Parse all TLVs from data. Returns list of (type, value) tuples."""
-    tlvs = []
+# Largest QUIC DATAGRAM frame accepted in datagram mode
+MAX_DATAGRAM_FRAME_SIZE = 65536
+
+# Linux socket options for kernel receive timestamps (not exported by the
+# socket module); SCM_TIMESTAMPNS has the same value as SO_TIMESTAMPNS
+SO_TIMESTAMPNS = getattr(socket, "SO_TIMESTAMPNS", 35)
+SCM_TIMESTAMPNS = SO_TIMESTAMPNS
+TIMESPEC = struct.Struct("@qq")
+
+# Per-process counters (plus the open connection count and the memory they
+# use, conn_mem_kb = RSS growth since startup); in --workers mode each worker publishes them to shared
+# memory and the parent rolls them up into a periodic [TSQ-LOG] line
+STAT_FIELDS = ("queries", "sessions", "errors", "rejected", "steered", "connections", "conn_mem_kb")
+STATS = dict.fromkeys(STAT_FIELDS, 0)
+
+# Per-process metrics served by --metrics-port in Prometheus text format
+QUERIES = {"stream": 0, "datagram": 0}
+ERRORS = {}   # error type -> count
+REJECTIONS = {"connection_rate": 0, "global_rate": 0}   # admission control, by reason
+HANDSHAKES = dict.fromkeys(("full", "resumed", "early_data"), 0)
+GAUGES = {"active_connections": 0, "queries_per_second": 0, "open_streams": 0,
+          "rss_bytes": 0, "memory_per_connection_bytes": 0}
+PROCESSING_NS = Histogram()   # T2 -> T3
+# Time per hot-path phase (perf_counter_ns), logged on SIGUSR1 and at shutdown:
+# "packet" is all work for one UDP datagram, the others are parts of it
+SPANS = PhaseSpans()
+ERROR_TYPES = {ERR_MALFORMED: "malformed", ERR_UNSUPPORTED: "unsupported", ERR_REPLAYED: "replayed"}
+
+# Batched [TSQ-LOG] writer, started in run_server()
+LOG = None
+
+# Connection limits and stream handling, set from the command line in run_server()
+MAX_CONNECTIONS = 0            # 0 = unlimited
+CONNECTION_IDLE_TIMEOUT = 60.0
+ANSWER_STREAMS = True
+
+# Admission control: requests per second per connection (0 = unlimited) and
+# its burst, and the process-wide TokenBucket; set in run_server()
+RATE_LIMIT = 0.0
+RATE_BURST = 10
+GLOBAL_BUCKET = None
+
+# Appended to [TSQ-LOG] lines by worker processes (" worker=N")
+WORKER_TAG = ""
+
+def split_messages(data: bytes):
+    """Split buffered stream bytes into complete TSQ messages.
+    
+    Every TSQ message starts with a Nonce TLV and has no length, so a message
+    runs up to the next Nonce TLV or to the end of the buffered data: a request
+    must arrive whole, which it does when the client writes it at once (it is
+    far smaller than a packet). If the buffer ends inside a TLV, the message
+    holding it is incomplete and is left for the next read.
+    Returns (messages, bytes_consumed).
+    """
+    messages = []
+    msg_start = 0
     offset = 0
-    while offset < len(data):
-        t, v, consumed = tlv_unpack(data[offset:])
-        tlvs.append((t, v))
-        offset += consumed
-    return tlvs
+    end = len(data)
+    while offset < end:
+        if data[offset] == T_NONCE and offset > msg_start:
+            messages.append(data[msg_start:offset])
+            msg_start = offset
+        if offset + 2 > end or offset + 2 + data[offset + 1] > end:
+            # Partial TLV: wait for more data
+            return messages, msg_start
+        offset += 2 + data[offset + 1]
+    if msg_start < end:
+        messages.append(data[msg_start:end])
+    return messages, end
 
-def log_session(query_count: int, duration_ms: float):
+def log_session(query_count: int, duration_ms: float, protocol: str = "stream"):
     """Log session statistics (no client IP due to aioquic limitation)"""
-    timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3] + " UTC"
-    print(f"[TSQ-LOG] {timestamp} protocol=stream queries={query_count} duration={duration_ms:.1f}ms")
+    STATS["sessions"] += 1
+    LOG.log(f"protocol={protocol} queries={query_count} duration={duration_ms:.1f}ms{WORKER_TAG}")
 
-def log_request(status: str, error: str):
+def log_request(status: str, error: str, protocol: str = "stream", kind: str = "malformed"):
     """Log failed request"""
-    timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3] + " UTC"
-    print(f"[TSQ-LOG] {timestamp} protocol=stream status={status} error=\"{error}\"")
+    STATS["errors"] += 1
+    ERRORS[kind] = ERRORS.get(kind, 0) + 1
+    LOG.log(f"protocol={protocol} status={status} error=\"{error}\"{WORKER_TAG}")
+
+def error_kind(e: Exception) -> str:
+    return ERROR_TYPES.get(getattr(e, "code", ERR_MALFORMED), "malformed")
+
+def render_metrics() -> list:
+    """Current metrics as Prometheus text lines"""
+    lines = []
+    lines += prometheus_metric("tsq_queries_total", "counter", "TSQ requests answered",
+                               {f'protocol="{p}"': n for p, n in QUERIES.items()})
+    lines += prometheus_metric("tsq_queries_per_second", "gauge", "Requests answered in the last second",
+                               GAUGES["queries_per_second"])
+    lines += PROCESSING_NS.prometheus("tsq_processing_seconds", "Server time from T2 (receive) to T3 (send)")
+    lines += prometheus_metric("tsq_handshakes_total", "counter", "Completed QUIC handshakes",
+                               {f'type="{k}"': n for k, n in HANDSHAKES.items()})
+    lines += prometheus_metric("tsq_active_connections", "gauge", "Connections with a completed handshake",
+                               GAUGES["active_connections"])
+    lines += prometheus_metric("tsq_open_connections", "gauge", "Open connections, including handshakes",
+                               STATS["connections"])
+    lines += prometheus_metric("tsq_open_streams", "gauge", "Streams with an open request session",
+                               GAUGES["open_streams"])
+    lines += prometheus_metric("tsq_resident_memory_bytes", "gauge", "Resident set size", GAUGES["rss_bytes"])
+    lines += prometheus_metric("tsq_memory_per_connection_bytes", "gauge",
+                               "RSS growth since startup divided by open connections",
+                               GAUGES["memory_per_connection_bytes"])
+    lines += prometheus_metric("tsq_sessions_total", "counter", "Finished sessions", STATS["sessions"])
+    lines += prometheus_metric("tsq_errors_total", "counter", "Failed requests by type",
+                               {f'type="{k}"': n for k, n in ERRORS.items()})
+    lines += prometheus_metric("tsq_rejected_total", "counter", "Requests refused by rate limits, by reason",
+                               {f'reason="{k}"': n for k, n in REJECTIONS.items()})
+    if REPLAY_CACHE is not None:
+        lines += prometheus_metric("tsq_replay_cache_nonces", "gauge",
+                                   "Nonces this process added to the current replay cache generation",
+                                   REPLAY_CACHE.added)
+    if CLOCK_STATUS is not None and CLOCK_STATUS.synchronized is not None:
+        lines += prometheus_metric("tsq_clock_synchronized", "gauge",
+                                   "1 if the kernel reports the system clock synchronized", int(CLOCK_STATUS.synchronized))
+        lines += prometheus_metric("tsq_clock_max_error_seconds", "gauge",
+                                   "Kernel maximum error estimate (adjtimex maxerror)", CLOCK_STATUS.max_error_us / 1e6)
+    lines += prometheus_metric("tsq_steered_packets_total", "counter",
+                               "Packets forwarded to the worker owning their connection", STATS["steered"])
+    return lines
+
+async def track_rates():
+    """Update the queries-per-second and memory gauges once a second"""
+    last = STATS["queries"]
+    baseline = rss_bytes()
+    while True:
+        await asyncio.sleep(1.0)
+        GAUGES["queries_per_second"] = STATS["queries"] - last
+        last = STATS["queries"]
+        GAUGES["rss_bytes"] = rss_bytes()
+        conn_mem = max(GAUGES["rss_bytes"] - baseline, 0)
+        STATS["conn_mem_kb"] = conn_mem // 1024
+        GAUGES["memory_per_connection_bytes"] = conn_mem // STATS["connections"] if STATS["connections"] else 0
+
+# Reused for every response; stream writes copy it into the send buffer
+RESPONSE_ENCODER = ResponseEncoder()
+
+# Static optional TLVs, built once in run_server()
+METADATA_TLV = b""
+PRECISION_ACK_TLV = tlv_pack(T_PRECISION, b"")
+# Sent (then FIN) instead of a response when admission control refuses a request
+RATE_LIMITED_REPLY = encode_error(ERR_RATE_LIMITED, "Rate limit exceeded")
 
-async def handle_stream(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-    session_start = time.time()
-    query_count = 0
-    writer_id = id(writer)
+# ResponseSigner for Signature Request (252), loaded once in run_server()
+SIGNER = None
+# ReplayCache of recent request nonces, set in run_server() unless --replay-window is 0
+REPLAY_CACHE = None
+# SamplingProfiler of the event loop thread, started in run_server() with --profile
+PROFILER = None
+
+def build_response(message: bytes, t1_recv: int):
+    """Build the TSQ response for one request message (same TLVs in both modes).
     
-    try:
-        # Read request
-        request_data = await reader.read(1024)
-        t1_recv = time.time_ns()
-        
-        # Parse nonce
-        if len(request_data) < 18:
-            log_request("FAILED", "Request too short")
-            return
-        nonce = request_data[2:18]
-        query_count += 1
-        
-        # Convert nanosecond timestamps to NTP format
-        NTP_EPOCH_OFFSET = 2208988800
-        
-        def ns_to_ntp(ns_timestamp):
-            seconds = ns_timestamp // 1_000_000_000
-            nanos = ns_timestamp % 1_000_000_000
-            ntp_seconds = seconds + NTP_EPOCH_OFFSET
-            ntp_fraction = int((nanos * 2**32) / 1_000_000_000)
-            return struct.pack("!II", ntp_seconds, ntp_fraction)
-        
-        # Convert T2 (receive timestamp)
-        ntp_t1 = ns_to_ntp(t1_recv)
-        
-        # Build response (without T3 yet)
-        response = b""
-        response += tlv_pack(T_NONCE, nonce)
-        response += tlv_pack(T_RECV_TS, ntp_t1)
-        
+    Returns (response, sign): when sign is set the response still needs its
+    Signature Block from SIGNER. A plain request is answered from the shared
+    buffer, which the next call overwrites; other requests get a new bytes object.
+    Raises ValueError if the message is malformed or has no 16-byte nonce, and
+    TSQError if its nonce was seen recently or it asks for a signature this
+    server cannot provide.
+    """
+    start = time.perf_counter_ns()
+    nonce, flags = decode_request(message)
+    start = SPANS.end("decode", start)
+    if REPLAY_CACHE is not None:
+        seen = REPLAY_CACHE.check(nonce)
+        start = SPANS.end("replay", start)
+        if seen:
+            raise TSQError(ERR_REPLAYED, "Nonce already seen")
+    if not flags:
         # Record T3 RIGHT BEFORE sending
         t2_send = time.time_ns()
-        ntp_t2 = ns_to_ntp(t2_send)
-        response += tlv_pack(T_SEND_TS, ntp_t2)
+        response = RESPONSE_ENCODER.encode(nonce, t1_recv, t2_send)
+        PROCESSING_NS.record(t2_send - t1_recv)
+        SPANS.end("encode", start)
+        return response, False
+    
+    sign = T_SIGNATURE_REQUEST in flags
+    if sign and SIGNER is None:
+        raise TSQError(ERR_UNSUPPORTED, "Signatures not configured")
+    tail = b""
+    if T_METADATA_QUERY in flags:
+        tail += METADATA_TLV
+    if T_PRECISION in flags:
+        tail += PRECISION_ACK_TLV
+        # Pad the response to the request's size for symmetric serialization
+        # delay; padding goes before the Signature Block
+        pad = len(message) - (RESPONSE_ENCODER.size + len(tail) + (SIGNER.tlv_size if sign else 0))
+        if pad >= 2:
+            tail += tlv_pack(T_PADDING, bytes(min(pad - 2, 255)))
+    t2_send = time.time_ns()
+    response = RESPONSE_ENCODER.encode(nonce, t1_recv, t2_send).tobytes() + tail
+    PROCESSING_NS.record(t2_send - t1_recv)
+    SPANS.end("encode", start)
+    return response, sign
+
+def sign_now(response) -> bytes:
+    start = time.perf_counter_ns()
+    response = SIGNER.sign_now(response)
+    SPANS.end("sign", start)
+    return response
+
+def log_spans(reason: str):
+    """Log the phase span histograms (and write the --profile file so far)"""
+    print(f"[TSQ] Phase timings ({reason}){WORKER_TAG}:")
+    for line in SPANS.report() or ["no requests yet"]:
+        print(f"[TSQ]   {line}")
+    if PROFILER is not None:
+        print(f"[TSQ] Profile: {PROFILER.samples} samples, {PROFILER.write()} stacks "
+              f"written to {PROFILER.path}{WORKER_TAG}")
+
+class TokenBucket:
+    """Allows rate requests per second on average and up to burst at once"""
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+    
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+    
+    def take(self, now: float) -> bool:
+        """Spend one token if available; now is loop time in seconds"""
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        self.stamp = now
+        if tokens > self.burst:
+            tokens = self.burst
+        if tokens < 1.0:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1.0
+        return True
+
+# --time-source names for Time Source Info (251), and the Clock Quality (248)
+# class and tag each one implies while the clock is synchronized
+TIME_SOURCES = {"gps": SOURCE_GPS, "ptp": SOURCE_PTP, "ntp": SOURCE_NTP,
+                "manual": SOURCE_MANUAL, "unknown": SOURCE_UNKNOWN}
+SOURCE_CLASSES = {SOURCE_GPS: CLOCK_CLASS_GNSS, SOURCE_PTP: CLOCK_CLASS_PTP, SOURCE_NTP: CLOCK_CLASS_NTP}
+SOURCE_TAGS = {value: name for name, value in TIME_SOURCES.items()}
+
+class ClockStatus:
+    """Kernel clock state, read with adjtimex(2) every --clock-poll seconds.
+    
+    Each poll pre-encodes the Clock Quality (248) and Time Source Info (251)
+    TLVs and makes them the tail of RESPONSE_ENCODER, so every response carries
+    them without any per-request syscall or encoding. An unsynchronized clock
+    (STA_UNSYNC, clock state TIME_ERROR) is sent as stratum 0, which clients
+    treat as "do not use this server".
+    """
+    
+    def __init__(self, stratum=None, source_type=None, info: str = ""):
+        self.stratum = stratum            # None: 1 with a PPS signal, else 2
+        self.source_type = source_type    # None: GPS with a PPS signal, else NTP
+        self.info = info
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.synchronized = None
+        self.max_error_us = 0
+        self.failed = False
+    
+    def poll(self):
+        """Read the kernel clock and install the TLVs it implies"""
+        state, tx = read_kernel_clock(self.libc)
+        synchronized = state != TIME_ERROR and not tx.status & STA_UNSYNC
+        pps = tx.status & (STA_PPSSIGNAL | STA_PPSTIME) == STA_PPSSIGNAL | STA_PPSTIME
+        source_type = self.source_type or (SOURCE_GPS if pps else SOURCE_NTP)
+        if not synchronized:
+            stratum, clock_class, tag = 0, CLOCK_CLASS_UNKNOWN, "unsynchronized"
+        else:
+            stratum = self.stratum or (1 if pps else 2)
+            clock_class = SOURCE_CLASSES.get(source_type, CLOCK_CLASS_UNKNOWN)
+            tag = SOURCE_TAGS[source_type]
+            if source_type == SOURCE_GPS and not tx.status & STA_PPSSIGNAL:
+                # Configured for GPS but the PPS signal is gone: free-running
+                clock_class, tag = CLOCK_CLASS_HOLDOVER, "holdover"
+        drift_ppb = abs(tx.freq) * 1000 // FREQ_SCALE
+        RESPONSE_ENCODER.set_tail(encode_clock_quality(clock_class, tx.maxerror, drift_ppb, tag)
+                                  + encode_time_source(stratum, source_type, self.info))
+        if synchronized != self.synchronized:
+            if synchronized:
+                print(f"[TSQ] System clock synchronized: stratum {stratum}, max error {tx.maxerror}us, "
+                      f"class {tag}{WORKER_TAG}")
+            else:
+                print(f"[TSQ] WARNING: System clock is not synchronized; responses report stratum 0{WORKER_TAG}")
+        self.synchronized = synchronized
+        self.max_error_us = tx.maxerror
+    
+    def refresh(self):
+        try:
+            self.poll()
+            self.failed = False
+        except OSError as e:
+            # Stop advertising a clock state that can no longer be read
+            RESPONSE_ENCODER.set_tail(b"")
+            self.synchronized = None
+            if not self.failed:
+                print(f"[TSQ] Cannot read clock state ({e}); not sending TLVs 248/251{WORKER_TAG}")
+            self.failed = True
+    
+    async def run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self.refresh()
+
+# Set in run_server() unless --clock-poll is 0
+CLOCK_STATUS = None
+
+# Close a stream after this long without a new request on it
+STREAM_IDLE_TIMEOUT = 5.0
+
+class IdleReaper:
+    """One timing wheel for every idle deadline in the process, ticked by a single task.
+    
+    Owners register (owner, key) once; activity only updates a timestamp the
+    owner keeps. When a slot expires the owner is asked for the current
+    deadline: entries that saw activity are re-slotted, the rest are reaped.
+    """
+    
+    def __init__(self, resolution: float = 0.5):
+        self.resolution = resolution
+        self.slots = {}   # tick -> [(owner, key)]
+        self.last_tick = None
+    
+    def schedule(self, owner, key, deadline: float):
+        tick = int(deadline / self.resolution) + 1
+        if self.last_tick is not None and tick <= self.last_tick:
+            tick = self.last_tick + 1
+        self.slots.setdefault(tick, []).append((owner, key))
+    
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.last_tick = int(loop.time() / self.resolution)
+        while True:
+            await asyncio.sleep(self.resolution)
+            now = loop.time()
+            tick = int(now / self.resolution)
+            for t in range(self.last_tick + 1, tick + 1):
+                for owner, key in self.slots.pop(t, ()):
+                    deadline = owner.idle_deadline(key)
+                    if deadline is None:
+                        continue  # Already closed
+                    if deadline > now:
+                        self.schedule(owner, key, deadline)
+                    else:
+                        owner.reap(key)
+            self.last_tick = tick
+
+REAPER = IdleReaper()
+
+class StreamState:
+    """Per-stream request buffer and session counters"""
+    __slots__ = ("buffer", "buffer_rx_ns", "queries", "started", "last_active", "outbox", "finished")
+    
+    def __init__(self, now: float):
+        self.buffer = b""
+        self.buffer_rx_ns = 0   # receive time of the packet that started the buffered request
+        self.queries = 0
+        self.started = now
+        self.last_active = now
+        self.outbox = None   # deque of responses queued behind an off-loop signature
+        self.finished = False
+
+class TSQServerProtocol(QuicConnectionProtocol):
+    """Answers TSQ requests on QUIC streams and in QUIC DATAGRAM frames.
+    
+    Stream data is handled directly in the event callback: no StreamReader,
+    StreamWriter or task is created per stream, and idle streams and
+    connections are closed by the shared IdleReaper.
+    """
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session_start = time.time()
+        self.datagram_queries = 0
+        self.streams = {}   # stream_id -> StreamState
+        self.stopped = set()   # streams we ended before the client finished sending
+        self.bucket = TokenBucket(RATE_LIMIT, RATE_BURST, self._loop.time()) if RATE_LIMIT else None
+        self.connected = False
+        self.counted = False
+        self.refused = False
+        self.last_active = None
+    
+    def packet_rx_ns(self):
+        """Receive time of the packet being processed (kernel timestamp if available)"""
+        return getattr(self._transport, "last_rx_ns", None) or time.time_ns()
+    
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        if MAX_CONNECTIONS and STATS["connections"] >= MAX_CONNECTIONS:
+            self.refused = True
+            return
+        self.counted = True
+        STATS["connections"] += 1
+        self.last_active = self._loop.time()
+        REAPER.schedule(self, None, self.last_active + CONNECTION_IDLE_TIMEOUT)
+    
+    def datagram_received(self, data, addr):
+        if self.refused:
+            # Over --max-connections: process the client's Initial, then answer
+            # with CONNECTION_CLOSE instead of our handshake flight
+            self.refused = False
+            ERRORS["connection_limit"] = ERRORS.get("connection_limit", 0) + 1
+            self._quic.receive_datagram(data, addr, now=self._loop.time())
+            self._quic.close(error_code=QuicErrorCode.CONNECTION_REFUSED, reason_phrase="server busy")
+            self._process_events()
+            self.transmit()
+            return
+        start = time.perf_counter_ns()
+        super().datagram_received(data, addr)
+        SPANS.end("packet", start)
+    
+    # IdleReaper callbacks: key is a stream ID, or None for the connection
+    
+    def idle_deadline(self, key):
+        if key is None:
+            return self.last_active + CONNECTION_IDLE_TIMEOUT if self.counted else None
+        state = self.streams.get(key)
+        return state.last_active + STREAM_IDLE_TIMEOUT if state is not None else None
+    
+    def reap(self, key):
+        if key is None:
+            self.close()
+        else:
+            self.end_stream(key, self.streams[key], stop=True)
+    
+    def admit(self, now: float):
+        """Charge one request to the rate limits; returns the rejection reason or None"""
+        if self.bucket is not None and not self.bucket.take(now):
+            return "connection_rate"
+        if GLOBAL_BUCKET is not None and not GLOBAL_BUCKET.take(now):
+            return "global_rate"
+        return None
+    
+    def end_stream(self, stream_id: int, state: StreamState, stop: bool = False):
+        """Finish our side of a stream once its queued responses are out.
         
-        # Send response immediately
-        writer.write(response)
-        await writer.drain()
+        With stop, the client has not finished sending: ask it to stop
+        (STOP_SENDING) and ignore whatever it already has in flight.
+        """
+        state.finished = True
+        if stop:
+            state.buffer = b""
+            if stream_id not in self.stopped:
+                self.stopped.add(stream_id)
+                try:
+                    self._quic.stop_stream(stream_id, 0)
+                except Exception:
+                    pass  # Stream already finished or connection closing
+        if state.outbox:
+            return
+        del self.streams[stream_id]
+        GAUGES["open_streams"] -= 1
+        if state.queries > 0:
+            log_session(state.queries, (self._loop.time() - state.started) * 1000.0)
+        try:
+            self._quic.send_stream_data(stream_id, b"", end_stream=True)
+        except Exception:
+            pass  # Stream already reset or connection closing
+        self.transmit()
+    
+    def reject_stream(self, stream_id: int, state: StreamState, reason: str):
+        """Answer with the pre-encoded rate-limit Error TLV and close the stream"""
+        REJECTIONS[reason] += 1
+        STATS["rejected"] += 1
+        self.send_stream_response(stream_id, state, RATE_LIMITED_REPLY)
+        self.end_stream(stream_id, state, stop=True)
+    
+    def send_stream_response(self, stream_id: int, state: StreamState, response):
+        if state.outbox:
+            state.outbox.append(response)
+            return
+        start = time.perf_counter_ns()
+        self._quic.send_stream_data(stream_id, response)
+        # Flush now so T3 is as close to the wire as possible
+        self.transmit()
+        SPANS.end("send", start)
+    
+    def flush_outbox(self, stream_id: int, state: StreamState):
+        """Send queued responses in request order as their signatures complete"""
+        outbox = state.outbox
+        while outbox and (not isinstance(outbox[0], asyncio.Future) or outbox[0].done()):
+            item = outbox.popleft()
+            if isinstance(item, asyncio.Future):
+                if item.cancelled():
+                    continue
+                error = item.exception()
+                if error is not None:
+                    log_request("FAILED", f"Signing failed: {type(error).__name__}: {error}", kind="signing")
+                    continue
+                item = item.result()
+            try:
+                self._quic.send_stream_data(stream_id, item)
+            except Exception:
+                outbox.clear()   # Stream reset or connection closing
+        self.transmit()
+        if not outbox and state.finished and stream_id in self.streams:
+            self.end_stream(stream_id, state)
+    
+    def handle_stream_data(self, event: StreamDataReceived):
+        # T2: when the packet carrying this data reached the socket, if the
+        # transport recorded it, rather than when it was processed
+        t1_recv = self.packet_rx_ns()
+        stream_id = event.stream_id
+        if stream_id in self.stopped:
+            # Still in flight when we ended the stream
+            if event.end_stream:
+                self.stopped.discard(stream_id)
+            return
+        now = self._loop.time()
+        self.last_active = now
+        state = self.streams.get(stream_id)
+        if state is None:
+            state = self.streams[stream_id] = StreamState(now)
+            GAUGES["open_streams"] += 1
+            REAPER.schedule(self, stream_id, now + STREAM_IDLE_TIMEOUT)
+        state.last_active = now
         
-        # Keep open
-        await asyncio.sleep(5)
+        # Answer every request on this stream until the client finishes it
+        # or it goes idle. A request whose TLVs were split across packets
+        # keeps T2 from the packet that carried its Nonce TLV.
+        held_rx_ns = state.buffer_rx_ns if state.buffer else t1_recv
+        buffer = state.buffer + event.data if state.buffer else event.data
+        messages, consumed = split_messages(buffer)
+        state.buffer = buffer[consumed:]
+        if state.buffer:
+            state.buffer_rx_ns = held_rx_ns if consumed == 0 else t1_recv
         
-    except Exception as e:
-        print(f"[TSQ] Error handling stream: {e}")
-    finally:
-        # Always log session summary when closing
-        session_duration = (time.time() - session_start) * 1000.0  # Convert to ms
-        if query_count > 0:
-            log_session(query_count, session_duration)
+        for i, message in enumerate(messages):
+            reason = self.admit(now)
+            if reason is not None:
+                self.reject_stream(stream_id, state, reason)
+                return
+            try:
+                response, sign = build_response(message, held_rx_ns if i == 0 else t1_recv)
+            except ValueError as e:
+                log_request("FAILED", str(e), kind=error_kind(e))
+                # Stream mode can tell the client why (datagrams are dropped silently)
+                self.send_stream_response(
+                    stream_id, state, encode_error(getattr(e, "code", ERR_MALFORMED), getattr(e, "reason", str(e))))
+                continue
+            state.queries += 1
+            STATS["queries"] += 1
+            QUERIES["stream"] += 1
+            if sign and not SIGNER.inline:
+                if state.outbox is None:
+                    state.outbox = collections.deque()
+                future = asyncio.ensure_future(SIGNER.sign(response))
+                start = time.perf_counter_ns()
+                future.add_done_callback(lambda _, start=start: SPANS.end("sign_queued", start))
+                future.add_done_callback(lambda _: self.flush_outbox(stream_id, state))
+                state.outbox.append(future)
+                continue
+            if sign:
+                response = sign_now(response)
+            self.send_stream_response(stream_id, state, bytes(response))
         
-        # Close writer
+        if event.end_stream:
+            if state.buffer:
+                log_request("FAILED", "Truncated request", kind="truncated")
+            self.end_stream(stream_id, state)
+    
+    def quic_event_received(self, event: QuicEvent):
+        if isinstance(event, StreamDataReceived):
+            if ANSWER_STREAMS:
+                self.handle_stream_data(event)
+            return
+        if isinstance(event, DatagramFrameReceived):
+            t1_recv = self.packet_rx_ns()
+            now = self.last_active = self._loop.time()
+            reason = self.admit(now)
+            if reason is not None:
+                # Over the limit: dropped silently like malformed datagrams
+                REJECTIONS[reason] += 1
+                STATS["rejected"] += 1
+                return
+            try:
+                response, sign = build_response(event.data, t1_recv)
+            except ValueError as e:
+                # Malformed datagrams are dropped silently (no amplification)
+                log_request("FAILED", str(e), protocol="datagram", kind=error_kind(e))
+                return
+            if sign and not SIGNER.inline:
+                task = asyncio.ensure_future(self.send_signed_datagram(response))
+                active_tasks.add(task)
+                task.add_done_callback(active_tasks.discard)
+            else:
+                if sign:
+                    response = sign_now(response)
+                start = time.perf_counter_ns()
+                # Datagram frames are queued by reference, so copy the shared buffer
+                self._quic.send_datagram_frame(bytes(response))
+                self.transmit()
+                SPANS.end("send", start)
+            self.datagram_queries += 1
+            STATS["queries"] += 1
+            QUERIES["datagram"] += 1
+        elif isinstance(event, HandshakeCompleted):
+            if event.early_data_accepted:
+                HANDSHAKES["early_data"] += 1
+            elif event.session_resumed:
+                HANDSHAKES["resumed"] += 1
+            else:
+                HANDSHAKES["full"] += 1
+            self.connected = True
+            GAUGES["active_connections"] += 1
+        elif isinstance(event, ConnectionTerminated):
+            if self.connected:
+                self.connected = False
+                GAUGES["active_connections"] -= 1
+            if self.counted:
+                self.counted = False
+                STATS["connections"] -= 1
+            for state in self.streams.values():
+                if state.queries > 0:
+                    log_session(state.queries, (self._loop.time() - state.started) * 1000.0)
+            GAUGES["open_streams"] -= len(self.streams)
+            self.streams.clear()
+            self.stopped.clear()
+            if self.datagram_queries > 0:
+                session_duration = (time.time() - self.session_start) * 1000.0
+                log_session(self.datagram_queries, session_duration, protocol="datagram")
+        super().quic_event_received(event)
+    
+    async def send_signed_datagram(self, response: bytes):
+        start = time.perf_counter_ns()
+        try:
+            response = await SIGNER.sign(response)
+        except Exception as e:
+            # e.g. the signing executor failed; the probe is lost like a dropped datagram
+            log_request("FAILED", f"Signing failed: {type(e).__name__}: {e}", protocol="datagram", kind="signing")
+            return
+        start = SPANS.end("sign_queued", start)
         try:
-            writer.close()
-            await writer.wait_closed()
+            self._quic.send_datagram_frame(response)
+            self.transmit()
         except Exception as e:
-            print(f"[TSQ] Error closing writer: {e}")
+            log_request("FAILED", f"Send failed: {type(e).__name__}: {e}", protocol="datagram", kind="send")
+            return
+        SPANS.end("send", start)
+
+class TimestampingTransport(asyncio.DatagramTransport):
+    """UDP transport that reads with recvmsg() to get a receive timestamp per datagram.
+    
+    With SO_TIMESTAMPNS the kernel stamps each packet on arrival, so T2 does not
+    include decryption, stream reassembly or event-loop scheduling delay. Where the
+    option is unavailable the time recvmsg() returned is used instead.
+    """
+    
+    # Datagrams read per readiness callback before yielding to the loop
+    MAX_READS = 64
+    
+    def __init__(self, loop, sock: socket.socket, protocol: asyncio.DatagramProtocol):
+        super().__init__()
+        self._loop = loop
+        self._sock = sock
+        self._protocol = protocol
+        self._closing = False
+        self.last_rx_ns = None
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+            self.kernel_timestamps = True
+        except OSError:
+            self.kernel_timestamps = False
+        self._ancbufsize = socket.CMSG_SPACE(TIMESPEC.size)
+        sock.setblocking(False)
+        loop.add_reader(sock.fileno(), self._read_ready)
+        protocol.connection_made(self)
+    
+    def _read_ready(self):
+        for _ in range(self.MAX_READS):
+            try:
+                data, ancdata, _flags, addr = self._sock.recvmsg(65536, self._ancbufsize)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as exc:
+                self._protocol.error_received(exc)
+                return
+            rx_ns = None
+            for level, ctype, cdata in ancdata:
+                if level == socket.SOL_SOCKET and ctype == SCM_TIMESTAMPNS:
+                    sec, nsec = TIMESPEC.unpack_from(cdata)
+                    rx_ns = sec * 1_000_000_000 + nsec
+            self.last_rx_ns = rx_ns or time.time_ns()
+            self._protocol.datagram_received(data, addr)
+        self.last_rx_ns = None
+    
+    def sendto(self, data, addr=None):
+        try:
+            self._sock.sendto(data, addr)
+        except (BlockingIOError, InterruptedError):
+            pass  # Socket buffer full: drop, QUIC loss recovery resends
+        except OSError as exc:
+            self._protocol.error_received(exc)
+    
+    def get_extra_info(self, name, default=None):
+        if name == "socket":
+            return self._sock
+        if name == "sockname":
+            return self._sock.getsockname()
+        return default
+    
+    def is_closing(self):
+        return self._closing
+    
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        self._loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._loop.call_soon(self._protocol.connection_lost, None)
+    
+    def abort(self):
+        self.close()
+
+class SessionTicketStore:
+    """In-memory TLS session tickets so clients can resume and send 0-RTT requests.
+    
+    With --workers every worker holds every ticket: publish is called with
+    each issued ticket and each used label so the other workers can learn() or
+    forget() it, as a client's next connection may land on another worker.
+    """
+    
+    def __init__(self, max_tickets=100_000, publish=None):
+        self.max_tickets = max_tickets
+        self.publish = publish
+        self.tickets = OrderedDict()
+        self.issued = 0
+        self.resumed = 0
+    
+    def add(self, ticket):
+        self.learn(ticket)
+        self.issued += 1
+        if self.publish is not None:
+            self.publish(STEER_TICKET, encode_ticket(ticket))
+    
+    def learn(self, ticket):
+        self.tickets[ticket.ticket] = ticket
+        # Drop the oldest tickets once the store is full
+        while len(self.tickets) > self.max_tickets:
+            self.tickets.popitem(last=False)
+    
+    def forget(self, label):
+        self.tickets.pop(label, None)
+    
+    def pop(self, label):
+        # Tickets are single use, which also keeps 0-RTT data from being replayed
+        ticket = self.tickets.pop(label, None)
+        if ticket is not None:
+            self.resumed += 1
+            if self.publish is not None:
+                self.publish(STEER_TICKET_USED, label)
+        return ticket
 
+TICKET_HEADER = struct.Struct("!IHddIBHB")
+EXTENSION_HEADER = struct.Struct("!HH")
+NO_EARLY_DATA = 0xFFFFFFFF
 
+def encode_ticket(ticket) -> bytes:
+    """Serialize a SessionTicket for the other workers (field by field, not pickle)"""
+    server_name = (ticket.server_name or "").encode()
+    max_early_data = NO_EARLY_DATA if ticket.max_early_data_size is None else ticket.max_early_data_size
+    parts = [TICKET_HEADER.pack(
+        ticket.age_add, ticket.cipher_suite, ticket.not_valid_before.timestamp(),
+        ticket.not_valid_after.timestamp(), max_early_data, len(ticket.resumption_secret),
+        len(server_name), len(ticket.ticket),
+    ), ticket.resumption_secret, server_name, ticket.ticket]
+    for ext_type, ext_value in ticket.other_extensions:
+        parts.append(EXTENSION_HEADER.pack(ext_type, len(ext_value)) + ext_value)
+    return b"".join(parts)
 
+def decode_ticket(data: bytes) -> SessionTicket:
+    """Inverse of encode_ticket(); raises ValueError or struct.error on a malformed one"""
+    (age_add, cipher_suite, not_before, not_after, max_early_data,
+     secret_len, name_len, label_len) = TICKET_HEADER.unpack_from(data)
+    offset = TICKET_HEADER.size
+    secret = data[offset:offset + secret_len]
+    offset += secret_len
+    server_name = data[offset:offset + name_len].decode()
+    offset += name_len
+    label = data[offset:offset + label_len]
+    offset += label_len
+    if len(label) != label_len:
+        raise ValueError("truncated ticket")
+    extensions = []
+    while offset < len(data):
+        ext_type, ext_len = EXTENSION_HEADER.unpack_from(data, offset)
+        offset += EXTENSION_HEADER.size
+        extensions.append((ext_type, data[offset:offset + ext_len]))
+        offset += ext_len
+    return SessionTicket(
+        age_add=age_add,
+        cipher_suite=CipherSuite(cipher_suite),
+        not_valid_after=datetime.fromtimestamp(not_after, timezone.utc),
+        not_valid_before=datetime.fromtimestamp(not_before, timezone.utc),
+        resumption_secret=secret,
+        server_name=server_name or None,
+        ticket=label,
+        max_early_data_size=None if max_early_data == NO_EARLY_DATA else max_early_data,
+        other_extensions=extensions,
+    )
 
-# Keep track of active stream tasks
+# Keep track of in-flight signing tasks for datagram responses
 active_tasks = set()
 
-def stream_handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-    # aioquic calls this synchronously, so we spawn our async handler
-    task = asyncio.create_task(handle_stream(reader, writer))
-    active_tasks.add(task)
-    task.add_done_callback(active_tasks.discard)
+# --workers mode: N processes bind the same UDP port with SO_REUSEPORT and the
+# kernel spreads clients across them by address. Every server-chosen connection
+# ID starts with the owning worker's ID byte, so a 1-RTT packet that lands on
+# the wrong worker (e.g. after the client's address changed) is forwarded to its
+# owner over a local unix socket. The same sockets carry session tickets
+# between workers.
+
+# tag_connection_ids() rewrites connection IDs aioquic has generated but not yet
+# sent, which relies on QuicConnection internals of aioquic 1.x
+assert aioquic.__version__.split(".")[0] == "1", f"untested aioquic {aioquic.__version__}"
+
+def tag_connection_ids(connection, worker_id: int):
+    """Make every connection ID this server-side connection issues start with worker_id"""
+    def tag(cid: bytes) -> bytes:
+        return bytes([worker_id]) + cid[1:]
+    
+    # Called from the protocol factory, before the first packet is sent;
+    # QuicServer registers connection.host_cid afterwards
+    first = connection._host_cids[0]
+    first.cid = connection.host_cid = connection._local_initial_source_connection_id = tag(first.cid)
+    replenish = connection._replenish_connection_ids
+    
+    def tagged_replenish():
+        start = len(connection._host_cids)
+        replenish()
+        # Before the NEW_CONNECTION_ID frames carrying them are written
+        for issued in connection._host_cids[start:]:
+            issued.cid = tag(issued.cid)
+    
+    connection._replenish_connection_ids = tagged_replenish
+
+def worker_protocol(worker_id: int):
+    """create_protocol for QuicServer that tags connection IDs with the worker ID"""
+    def create_protocol(connection, **kwargs):
+        tag_connection_ids(connection, worker_id)
+        return TSQServerProtocol(connection, **kwargs)
+    return create_protocol
+
+# Kinds of message on the steering sockets
+STEER_PACKET = 0
+STEER_TICKET = 1
+STEER_TICKET_USED = 2
+
+def steering_address(group_id: int, worker_id: int) -> str:
+    """Abstract unix socket name of a worker's steering inbox"""
+    return f"\0tsq-steer-{group_id}-{worker_id}"
+
+def encode_steered(data: bytes, addr, rx_ns) -> bytes:
+    header = "|".join(str(part) for part in addr).encode()
+    return struct.pack("!BQB", STEER_PACKET, rx_ns or 0, len(header)) + header + data
+
+def decode_steered(payload: bytes):
+    _, rx_ns, header_len = struct.unpack_from("!BQB", payload)
+    parts = payload[10:10 + header_len].decode().split("|")
+    addr = (parts[0],) + tuple(int(part) for part in parts[1:])
+    return payload[10 + header_len:], addr, rx_ns
+
+class SteeringQuicServer(QuicServer):
+    """QuicServer that hands 1-RTT packets for another worker's connections to that worker"""
+    
+    def __init__(self, *, worker_id: int, num_workers: int, group_id: int, **kwargs):
+        super().__init__(**kwargs)
+        self.worker_id = worker_id
+        self.num_workers = num_workers
+        self.group_id = group_id
+        self.cid_length = self._configuration.connection_id_length
+        self.steer_transport = None
+    
+    def datagram_received(self, data, addr):
+        # Short-header packets carry our connection ID right after the first byte
+        if len(data) > self.cid_length and not data[0] & 0x80:
+            owner = data[1]
+            if (owner != self.worker_id and owner < self.num_workers
+                    and data[1:1 + self.cid_length] not in self._protocols):
+                rx_ns = getattr(self._transport, "last_rx_ns", None)
+                self.steer_transport.sendto(encode_steered(data, addr, rx_ns),
+                                            steering_address(self.group_id, owner))
+                STATS["steered"] += 1
+                return
+        super().datagram_received(data, addr)
+    
+    def broadcast(self, kind: int, data: bytes):
+        """Send a message to every other worker's steering inbox"""
+        if self.steer_transport is None:
+            return
+        for worker_id in range(self.num_workers):
+            if worker_id != self.worker_id:
+                self.steer_transport.sendto(bytes([kind]) + data, steering_address(self.group_id, worker_id))
+
+class SteeringReceiver(asyncio.DatagramProtocol):
+    """Feeds packets forwarded by other workers into this worker's QUIC server"""
+    
+    def __init__(self, server: SteeringQuicServer, ticket_store=None):
+        self.server = server
+        self.ticket_store = ticket_store
+    
+    def datagram_received(self, payload, _addr):
+        if not payload:
+            return
+        if payload[0] != STEER_PACKET:
+            self.ticket_received(payload[0], payload[1:])
+            return
+        data, addr, rx_ns = decode_steered(payload)
+        # Keep the receive time taken by the worker that got the packet
+        transport = self.server._transport
+        if isinstance(transport, TimestampingTransport):
+            transport.last_rx_ns = rx_ns or None
+        # Bypass steering: these packets are ours by construction
+        QuicServer.datagram_received(self.server, data, addr)
+        if isinstance(transport, TimestampingTransport):
+            transport.last_rx_ns = None
+    
+    def ticket_received(self, kind: int, data: bytes):
+        if self.ticket_store is None:
+            return
+        if kind == STEER_TICKET:
+            try:
+                self.ticket_store.learn(decode_ticket(data))
+            except (ValueError, struct.error) as e:
+                print(f"[TSQ] Ignoring malformed session ticket from another worker: {e}{WORKER_TAG}")
+        elif kind == STEER_TICKET_USED:
+            self.ticket_store.forget(data)
+
+def udp_socket(host: str, port: int, reuseport: bool = False) -> socket.socket:
+    family, _, _, _, sockaddr = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)[0]
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    if reuseport:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(sockaddr)
+    return sock
+
+def make_configuration(args) -> QuicConfiguration:
+    cfg = QuicConfiguration(is_client=False, alpn_protocols=ALPN)
+    cfg.load_cert_chain(args.cert, args.key)
+    if args.mode != "stream":
+        cfg.max_datagram_frame_size = MAX_DATAGRAM_FRAME_SIZE
+    return cfg
+
+async def publish_stats(shared_stats, worker_id: int):
+    """Copy this worker's counters into its slots of the shared stats array"""
+    base = worker_id * len(STAT_FIELDS)
+    while True:
+        for i, field in enumerate(STAT_FIELDS):
+            shared_stats[base + i] = STATS[field]
+        await asyncio.sleep(1.0)
+
+async def run_server(args, worker_id=None, group_id=None, shared_stats=None, replay_memory=None):
+    """Serve until cancelled; worker_id is set when running as one of --workers"""
+    global METADATA_TLV, SIGNER, LOG, MAX_CONNECTIONS, CONNECTION_IDLE_TIMEOUT, ANSWER_STREAMS
+    global RATE_LIMIT, RATE_BURST, GLOBAL_BUCKET, REPLAY_CACHE, CLOCK_STATUS, PROFILER
+    METADATA_TLV = args.metadata_tlv
+    MAX_CONNECTIONS = args.max_connections
+    CONNECTION_IDLE_TIMEOUT = args.idle_timeout
+    RATE_LIMIT = args.rate_limit
+    RATE_BURST = args.rate_burst
+    if args.global_rate_limit:
+        # One second's worth of burst for the whole process
+        GLOBAL_BUCKET = TokenBucket(args.global_rate_limit, max(args.global_rate_limit, 1.0),
+                                    asyncio.get_running_loop().time())
+    ANSWER_STREAMS = args.mode != "datagram"
+    if args.replay_window:
+        # Workers share one cache so a nonce replayed to another worker is caught too;
+        # the parent rotates it then
+        REPLAY_CACHE = ReplayCache(args.replay_window, args.replay_capacity, replay_memory)
+        if replay_memory is None:
+            REPLAY_CACHE.start()
+    LOG = LogWriter()
+    if args.hmac_key or args.signing_key:
+        SIGNER = ResponseSigner.from_files(args.hmac_key, args.signing_key)
+        print(f"[TSQ] Signing responses on request: {SIGNER.description}{WORKER_TAG}")
+    cfg = make_configuration(args)
+    
+    ticket_store = None
+    ticket_kwargs = {}
+    if args.max_tickets > 0:
+        ticket_store = SessionTicketStore(args.max_tickets)
+        ticket_kwargs = dict(
+            session_ticket_fetcher=ticket_store.pop,
+            session_ticket_handler=ticket_store.add,
+        )
+    server_kwargs = dict(
+        configuration=cfg,
+        create_protocol=TSQServerProtocol,
+        **ticket_kwargs,
+    )
+    
+    loop = asyncio.get_running_loop()
+    tasks = []
+    transports = []
+    if worker_id is None:
+        server_factory = lambda: QuicServer(**server_kwargs)
+        sock = udp_socket(args.host, args.port)
+    else:
+        server_kwargs["create_protocol"] = worker_protocol(worker_id)
+        server_factory = lambda: SteeringQuicServer(worker_id=worker_id, num_workers=args.workers,
+                                                    group_id=group_id, **server_kwargs)
+        sock = udp_socket(args.host, args.port, reuseport=True)
+    
+    if args.kernel_timestamps:
+        server = server_factory()
+        transport = TimestampingTransport(loop, sock, server)
+        source = "kernel (SO_TIMESTAMPNS)" if transport.kernel_timestamps else "recvmsg return"
+        print(f"[TSQ] Receive timestamps: {source}{WORKER_TAG}")
+    else:
+        transport, server = await loop.create_datagram_endpoint(server_factory, sock=sock)
+    
+    if worker_id is not None:
+        steer_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        steer_sock.bind(steering_address(group_id, worker_id))
+        steer_transport, _ = await loop.create_datagram_endpoint(
+            lambda: SteeringReceiver(server, ticket_store), sock=steer_sock,
+        )
+        server.steer_transport = steer_transport
+        if ticket_store is not None:
+            ticket_store.publish = server.broadcast
+        transports.append(steer_transport)
+        tasks.append(asyncio.create_task(publish_stats(shared_stats, worker_id)))
+    
+    tasks.append(asyncio.create_task(track_rates()))
+    if args.clock_poll:
+        CLOCK_STATUS = ClockStatus(args.stratum, TIME_SOURCES.get(args.time_source), args.time_source_info)
+        CLOCK_STATUS.refresh()
+        tasks.append(asyncio.create_task(CLOCK_STATUS.run(args.clock_poll)))
+    tasks.append(asyncio.create_task(REAPER.run()))
+    metrics_server = None
+    if args.metrics_port:
+        # Each worker serves its own metrics on the next port up
+        metrics_port = args.metrics_port + (worker_id or 0)
+        metrics_server = await serve_metrics(args.metrics_host, metrics_port, render_metrics)
+        print(f"[TSQ] Metrics on http://{args.metrics_host}:{metrics_port}/metrics{WORKER_TAG}")
+    
+    sigusr1 = add_sigusr1_handler(loop, log_spans, "SIGUSR1")
+    if args.profile:
+        # Each worker profiles itself into its own file
+        path = args.profile if worker_id is None else f"{args.profile}.{worker_id}"
+        PROFILER = SamplingProfiler(path, args.profile_interval / 1000).start()
+        if not sigusr1:
+            print(f"[TSQ] No SIGUSR1 on this platform, the profile is written at exit only{WORKER_TAG}")
+    
+    print(f"[TSQ] Server ready{WORKER_TAG}")
+    try:
+        await asyncio.Future()  # Run forever until Ctrl+C
+    finally:
+        if PROFILER is not None:
+            PROFILER.stop()
+        log_spans("shutdown")
+        if ticket_store is not None:
+            print(f"[TSQ] Session tickets: issued={ticket_store.issued} resumed={ticket_store.resumed}{WORKER_TAG}")
+        for task in tasks:
+            task.cancel()
+        for transport in transports:
+            transport.close()
+        server.close()
+        if SIGNER is not None:
+            print(f"[TSQ] Signed responses: {SIGNER.signed} in {SIGNER.batches or SIGNER.signed} batches{WORKER_TAG}")
+            SIGNER.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        LOG.close()
+
+def run_worker(args, worker_id: int, group_id: int, shared_stats, replay_memory):
+    """Entry point of one --workers process"""
+    global WORKER_TAG
+    WORKER_TAG = f" worker={worker_id}"
+    # The parent handles Ctrl+C and stops the workers; SIGUSR1 is ignored
+    # until run_server() is ready to log phase timings
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    sys.stdout.reconfigure(line_buffering=True)
+    asyncio.run(run_server(args, worker_id, group_id, shared_stats, replay_memory))
+
+def log_rollup(shared_stats, num_workers: int):
+    """Log the summed per-worker counters as one [TSQ-LOG] line"""
+    timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3] + " UTC"
+    width = len(STAT_FIELDS)
+    per_worker = [shared_stats[w * width:(w + 1) * width] for w in range(num_workers)]
+    totals = " ".join(
+        f"{field}={sum(values[i] for values in per_worker)}" for i, field in enumerate(STAT_FIELDS)
+    )
+    queries = "/".join(str(values[0]) for values in per_worker)
+    connections = sum(values[STAT_FIELDS.index("connections")] for values in per_worker)
+    conn_mem_kb = sum(values[STAT_FIELDS.index("conn_mem_kb")] for values in per_worker)
+    mem_per_conn = f"{conn_mem_kb / connections:.1f}KB" if connections else "n/a"
+    print(f"[TSQ-LOG] {timestamp} protocol=all workers={num_workers} {totals} "
+          f"mem_per_conn={mem_per_conn} per_worker_queries={queries}")
+
+def run_workers(args):
+    """Start --workers processes on the same port and roll up their stats"""
+    group_id = os.getpid()
+    # systemd stops the service with SIGTERM; unwind so the workers are stopped too
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    shared_stats = multiprocessing.Array("Q", args.workers * len(STAT_FIELDS), lock=False)
+    replay_memory = None
+    if args.replay_window:
+        replay_memory = ReplayCache.allocate(args.replay_capacity)
+        # One rotation thread for all workers, in the otherwise idle parent
+        ReplayCache(args.replay_window, args.replay_capacity, replay_memory).start()
+    
+    def start(worker_id):
+        proc = multiprocessing.Process(target=run_worker, daemon=True,
+                                       args=(args, worker_id, group_id, shared_stats, replay_memory))
+        proc.start()
+        return proc
+    
+    def log_worker_spans(*_):
+        # kill -USR1 on the parent makes every worker log its phase timings
+        for proc in workers:
+            try:
+                os.kill(proc.pid, signal.SIGUSR1)
+            except ProcessLookupError:
+                pass
+    
+    workers = [start(worker_id) for worker_id in range(args.workers)]
+    signal.signal(signal.SIGUSR1, log_worker_spans)
+    
+    next_rollup = time.monotonic() + args.stats_interval
+    try:
+        while True:
+            time.sleep(1.0)
+            for worker_id, proc in enumerate(workers):
+                if not proc.is_alive():
+                    print(f"[TSQ] Worker {worker_id} exited (code {proc.exitcode}), restarting")
+                    workers[worker_id] = start(worker_id)
+            if time.monotonic() >= next_rollup:
+                log_rollup(shared_stats, args.workers)
+                next_rollup += args.stats_interval
+    except KeyboardInterrupt:
+        print("\n[TSQ] Server stopped.")
+    finally:
+        for proc in workers:
+            proc.terminate()
+        for proc in workers:
+            proc.join()
+        log_rollup(shared_stats, args.workers)
 
-async def main():
+def main():
     ap = argparse.ArgumentParser(description="TSQ QUIC Server")
     ap.add_argument("--host", default="0.0.0.0")
     ap.add_argument("--port", type=int, default=443)
     ap.add_argument("--cert", default="server.crt")
     ap.add_argument("--key", default="server.key")
+    ap.add_argument("--mode", choices=["stream", "datagram", "both"], default="stream",
+                    help="Answer requests on QUIC streams, DATAGRAM frames, or both (default: stream)")
+    ap.add_argument("--max-tickets", type=int, default=100_000,
+                    help="Session tickets kept for resumption/0-RTT (0 disables)")
+    ap.add_argument("--max-connections", type=int, default=0,
+                    help="Refuse new connections above this many per process (default: 0, unlimited)")
+    ap.add_argument("--idle-timeout", type=float, default=60.0,
+                    help="Close connections with no requests for this many seconds (default: 60)")
+    ap.add_argument("--rate-limit", type=float, default=0.0, metavar="QPS",
+                    help="Requests per second allowed per connection (default: 0, unlimited)")
+    ap.add_argument("--rate-burst", type=float, default=10.0, metavar="N",
+                    help="Requests a connection may send at once before --rate-limit applies (default: 10)")
+    ap.add_argument("--global-rate-limit", type=float, default=0.0, metavar="QPS",
+                    help="Requests per second allowed per process across all connections (default: 0, unlimited)")
+    ap.add_argument("--replay-window", type=float, default=60.0, metavar="SECONDS",
+                    help="Reject request nonces seen within this many seconds (0 disables; default: 60)")
+    ap.add_argument("--replay-capacity", type=int, default=1_000_000, metavar="N",
+                    help="Nonces per replay window the cache is sized for, at 8 bytes each (default: 1000000)")
+    ap.add_argument("--clock-poll", type=float, default=0.0, metavar="SECONDS",
+                    help="Read the kernel clock state this often and send it as Clock Quality (248) and "
+                         "Time Source Info (251) TLVs, e.g. 16; an unsynchronized clock is sent as "
+                         "stratum 0, which clients skip; Linux only (default: 0, off)")
+    ap.add_argument("--stratum", type=int, metavar="N",
+                    help="Stratum sent while synchronized (default: 1 with a PPS signal, else 2)")
+    ap.add_argument("--time-source", choices=list(TIME_SOURCES),
+                    help="Source type sent in TLV 251 (default: gps with a PPS signal, else ntp)")
+    ap.add_argument("--time-source-info", default="", metavar="TEXT",
+                    help="Info sent in TLV 251, e.g. the upstream server or region")
+    ap.add_argument("--kernel-timestamps", action="store_true",
+                    help="Take T2 from per-packet kernel receive timestamps (SO_TIMESTAMPNS)")
+    ap.add_argument("--workers", type=int, default=1,
+                    help="Worker processes sharing the port via SO_REUSEPORT (default: 1)")
+    ap.add_argument("--stats-interval", type=float, default=60.0,
+                    help="Seconds between rolled-up worker stats lines (default: 60)")
+    ap.add_argument("--metrics-port", type=int, default=0,
+                    help="Serve Prometheus metrics on this TCP port (default: off; workers use port+N)")
+    ap.add_argument("--metrics-host", default="127.0.0.1",
+                    help="Address for the metrics endpoint (default: 127.0.0.1)")
+    ap.add_argument("--profile", metavar="FILE",
+                    help="Sample the event loop's Python stack and write folded stacks for flamegraph.pl "
+                         "or speedscope at exit and on SIGUSR1 (workers write FILE.N)")
+    ap.add_argument("--profile-interval", type=float, default=1.0, metavar="MS",
+                    help="Milliseconds between --profile samples (default: 1)")
+    signing = ap.add_mutually_exclusive_group()
+    signing.add_argument("--hmac-key", metavar="FILE",
+                         help="Shared secret for HMAC-SHA256 Signature Blocks (TLV 255)")
+    signing.add_argument("--signing-key", metavar="FILE",
+                         help="Ed25519 private key (PEM) for Signature Blocks (TLV 255)")
+    ap.add_argument("--metadata", action="append", default=[], metavar="KEY=VALUE",
+                    help="Metadata returned to Metadata Query requests (repeatable; version is always included)")
     args = ap.parse_args()
-
-    cfg = QuicConfiguration(is_client=False, alpn_protocols=ALPN)
-    cfg.load_cert_chain(args.cert, args.key)
+    
+    if args.workers < 1 or args.workers > 255:
+        print("Error: Workers must be between 1 and 255", file=sys.stderr)
+        sys.exit(1)
+    
+    if args.max_connections < 0 or args.idle_timeout <= 0:
+        print("Error: Max-connections must be >= 0 and idle-timeout must be > 0", file=sys.stderr)
+        sys.exit(1)
+    
+    if args.rate_limit < 0 or args.global_rate_limit < 0 or args.rate_burst < 1:
+        print("Error: Rate limits must be >= 0 and rate-burst must be >= 1", file=sys.stderr)
+        sys.exit(1)
+    
+    if args.replay_window < 0 or args.replay_capacity < 1:
+        print("Error: Replay-window must be >= 0 and replay-capacity must be >= 1", file=sys.stderr)
+        sys.exit(1)
+    try:
+        block_count(args.replay_capacity)
+    except ValueError as e:
+        print(f"Error: Replay {e}", file=sys.stderr)
+        sys.exit(1)
+    
+    if args.clock_poll < 0 or (args.stratum is not None and not 1 <= args.stratum <= 15):
+        print("Error: Clock-poll must be >= 0 and stratum must be between 1 and 15", file=sys.stderr)
+        sys.exit(1)
+    if len(args.time_source_info.encode()) > 253:
+        print("Error: Time-source-info too long (max 253 bytes)", file=sys.stderr)
+        sys.exit(1)
+    if args.clock_poll and not sys.platform.startswith("linux"):
+        print("[TSQ] Clock Quality/Time Source TLVs need adjtimex (Linux); not sent")
+        args.clock_poll = 0
+    
+    if args.profile_interval <= 0:
+        print("Error: Profile-interval must be > 0", file=sys.stderr)
+        sys.exit(1)
+    
+    if args.metrics_port < 0 or args.metrics_port + args.workers - 1 > 65535:
+        print("Error: Metrics port must be between 1 and 65535", file=sys.stderr)
+        sys.exit(1)
+    
+    metadata = {"version": VERSION}
+    for item in args.metadata:
+        key, sep, value = item.partition("=")
+        if not sep or not key:
+            print(f"Error: Invalid --metadata '{item}' (expected KEY=VALUE)", file=sys.stderr)
+            sys.exit(1)
+        metadata[key] = value
+    try:
+        args.metadata_tlv = encode_metadata(metadata)
+    except ValueError:
+        print("Error: Metadata too long (max 255 bytes encoded)", file=sys.stderr)
+        sys.exit(1)
+    
+    # Fail fast on a bad certificate or signing key before starting any workers
+    make_configuration(args)
+    if args.hmac_key or args.signing_key:
+        try:
+            ResponseSigner.from_files(args.hmac_key, args.signing_key).close()
+        except (OSError, ValueError) as e:
+            print(f"Error: Cannot load signing key: {e}", file=sys.stderr)
+            sys.exit(1)
 
     print(f"[TSQ] Server Version {VERSION}")
-    print(f"[TSQ] Server listening on {args.host}:{args.port} (UDP/QUIC)")
+    print(f"[TSQ] Server listening on {args.host}:{args.port} (UDP/QUIC, mode={args.mode})")
     print(f"[TSQ] Note: Stream server logs statistics only (no client IPs due to aioquic limitation)")
+    if args.rate_limit or args.global_rate_limit:
+        per_connection = f"{args.rate_limit:g}/s burst {args.rate_burst:g}" if args.rate_limit else "unlimited"
+        per_process = f"{args.global_rate_limit:g}/s" if args.global_rate_limit else "unlimited"
+        print(f"[TSQ] Rate limits: per connection {per_connection}, per process {per_process}")
+    if args.replay_window:
+        memory = block_count(args.replay_capacity) * LINE_BYTES
+        print(f"[TSQ] Replay cache: {args.replay_window:g}s window, {args.replay_capacity} nonces, "
+              f"{memory / 2**20:.1f} MB")
     
-    from aioquic.asyncio import serve
+    if args.workers > 1:
+        run_workers(args)
+        return
     
-    server = await serve(
-        args.host,
-        args.port,
-        configuration=cfg,
-        stream_handler=stream_handler,
-    )
-    
-    print(f"[TSQ] Server ready")
+    # systemd stops the service with SIGTERM; unwind so buffered log lines are written
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
     try:
-        await asyncio.Future()  # Run forever until Ctrl+C
+        asyncio.run(run_server(args))
     except KeyboardInterrupt:
         print("\n[TSQ] Server stopped.")
-    finally:
-        server.close()
-        await server.wait_closed()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    main()
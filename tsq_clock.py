@@ -0,0 +1,66 @@
+"""Linux adjtimex(2) structure and constants shared by tsq-stream-client.py and tsq-stream-server.py"""
+import ctypes
+import os
+
+# Linux timex structure for adjtimex
+class Timex(ctypes.Structure):
+    _fields_ = [
+        ("modes", ctypes.c_uint),
+        ("offset", ctypes.c_long),
+        ("freq", ctypes.c_long),
+        ("maxerror", ctypes.c_long),
+        ("esterror", ctypes.c_long),
+        ("status", ctypes.c_int),
+        ("constant", ctypes.c_long),
+        ("precision", ctypes.c_long),
+        ("tolerance", ctypes.c_long),
+        ("time", ctypes.c_long * 2),
+        ("tick", ctypes.c_long),
+        ("ppsfreq", ctypes.c_long),
+        ("jitter", ctypes.c_long),
+        ("shift", ctypes.c_int),
+        ("stabil", ctypes.c_long),
+        ("jitcnt", ctypes.c_long),
+        ("calcnt", ctypes.c_long),
+        ("errcnt", ctypes.c_long),
+        ("stbcnt", ctypes.c_long),
+        ("tai", ctypes.c_int),
+        ("_padding", ctypes.c_int * 11),
+    ]
+
+# adjtimex modes
+ADJ_OFFSET = 0x0001
+ADJ_FREQUENCY = 0x0002
+ADJ_MAXERROR = 0x0004
+ADJ_ESTERROR = 0x0008
+ADJ_STATUS = 0x0010
+ADJ_TIMECONST = 0x0020
+ADJ_SETOFFSET = 0x0100
+ADJ_MICRO = 0x1000
+ADJ_NANO = 0x2000
+# adjtime(2) semantics: offset (microseconds) is slewed out once at 500 ppm
+ADJ_OFFSET_SINGLESHOT = 0x8001
+
+# adjtimex status bits
+STA_PLL = 0x0001
+STA_PPSFREQ = 0x0002
+STA_PPSTIME = 0x0004
+STA_UNSYNC = 0x0040
+STA_PPSSIGNAL = 0x0100
+STA_NANO = 0x2000
+
+# adjtimex return value (clock state) while the clock is not synchronized
+TIME_ERROR = 5
+
+# freq and ppsfreq are in ppm with a 16-bit binary fraction
+FREQ_SCALE = 1 << 16
+
+def read_kernel_clock(libc):
+    """Read the kernel clock without changing it: returns (clock state, Timex).
+    Raises OSError if adjtimex fails."""
+    tx = Timex()
+    state = libc.adjtimex(ctypes.byref(tx))
+    if state == -1:
+        err = ctypes.get_errno()
+        raise OSError(err, f"adjtimex failed: {os.strerror(err)}")
+    return state, tx
@@ -0,0 +1,311 @@
+"""TSQ message codec shared by tsq-stream-server.py and tsq-stream-client.py"""
+import struct
+
+# TLV: 1 byte Type, 1 byte Length (per draft-mccollum-ntp-tsq-01), then Value
+# Types:
+#   1 = Nonce (16 bytes)
+#   2 = Receive Timestamp (8 bytes, NTP format)
+#   3 = Send Timestamp (8 bytes, NTP format)
+#   247 = Metadata Query (request, 0 bytes)
+#   248 = Clock Quality (class, reserved, error us u16, drift ppb u16, tag)
+#   249 = Error (code, reserved, reason; alone in a stream response)
+#   250 = Precision Mode (request and acknowledgment, 0 bytes)
+#   251 = Time Source Info (stratum, source type, info)
+#   252 = Signature Request (request, 0 bytes)
+#   253 = Metadata (length-prefixed key/value pairs, keys in lexicographic order)
+#   254 = Padding (zero bytes, only at the end of a message)
+#   255 = Signature Block (always last)
+# Types 4-246 are reserved; unknown types are skipped.
+
+T_NONCE = 1
+T_RECV_TS = 2
+T_SEND_TS = 3
+T_METADATA_QUERY = 247
+T_CLOCK_QUALITY = 248
+T_ERROR = 249
+T_PRECISION = 250
+T_TIME_SOURCE = 251
+T_SIGNATURE_REQUEST = 252
+T_METADATA = 253
+T_PADDING = 254
+T_SIGNATURE = 255
+
+NONCE_LEN = 16
+
+# Value length rules: exact for fixed-size TLVs, minimum for the others
+TLV_FIXED_LENGTHS = {
+    T_NONCE: NONCE_LEN,
+    T_RECV_TS: 8,
+    T_SEND_TS: 8,
+    T_METADATA_QUERY: 0,
+    T_PRECISION: 0,
+    T_SIGNATURE_REQUEST: 0,
+}
+TLV_MIN_LENGTHS = {
+    T_CLOCK_QUALITY: 6,
+    T_ERROR: 2,
+    T_TIME_SOURCE: 2,
+    T_METADATA: 0,
+    T_PADDING: 0,
+    T_SIGNATURE: 7,
+}
+KNOWN_TLV_TYPES = frozenset(TLV_FIXED_LENGTHS) | frozenset(TLV_MIN_LENGTHS)
+# Zero-length request flags the server acts on
+REQUEST_FLAGS = frozenset((T_METADATA_QUERY, T_PRECISION, T_SIGNATURE_REQUEST))
+
+# Error TLV codes
+ERR_MALFORMED = 0x01
+ERR_UNSUPPORTED = 0x02
+ERR_AUTH_REQUIRED = 0x03
+# Not assigned by the draft (its codes are examples): request refused by server rate limits
+ERR_RATE_LIMITED = 0x04
+# Not assigned by the draft either: request nonce already seen within the replay window
+ERR_REPLAYED = 0x05
+
+# Clock Quality (248) classes
+CLOCK_CLASS_UNKNOWN = 0
+CLOCK_CLASS_GNSS = 1
+CLOCK_CLASS_PTP = 2
+CLOCK_CLASS_NTP = 3
+CLOCK_CLASS_OCXO = 4
+CLOCK_CLASS_HOLDOVER = 5
+
+# Time Source Info (251) source types; stratum 0 means unsynchronized
+SOURCE_GPS = 1
+SOURCE_PTP = 2
+SOURCE_NTP = 3
+SOURCE_MANUAL = 4
+SOURCE_UNKNOWN = 5
+
+NTP_EPOCH_OFFSET = 2208988800
+NS_PER_SEC = 1_000_000_000
+# NTP seconds below this are in era 1 (after 2036-02-07), per RFC 4330 section 3
+NTP_ERA_PIVOT = 0x80000000
+
+TLV_HEADER = struct.Struct("!BB")
+NTP_TIMESTAMP = struct.Struct("!II")
+# Nonce TLV
+REQUEST = struct.Struct("!BB16s")
+# Nonce TLV, T2 TLV, T3 TLV
+RESPONSE = struct.Struct("!BB16sBBIIBBII")
+CLOCK_QUALITY = struct.Struct("!BBHH")
+# Signature Block value header: algorithm, key ID, signature length
+SIGNATURE_HEADER = struct.Struct("!BIH")
+
+def ns_to_ntp_parts(ns_timestamp: int):
+    """Convert Unix nanoseconds to (NTP seconds, NTP fraction) using integer math only"""
+    seconds, nanos = divmod(ns_timestamp, NS_PER_SEC)
+    return (seconds + NTP_EPOCH_OFFSET) & 0xFFFFFFFF, (nanos << 32) // NS_PER_SEC
+
+def ntp_parts_to_ns(ntp_seconds: int, ntp_fraction: int) -> int:
+    """Convert (NTP seconds, NTP fraction) to Unix nanoseconds; exact inverse of ns_to_ntp_parts"""
+    if ntp_seconds < NTP_ERA_PIVOT:
+        ntp_seconds += 1 << 32
+    # Round to nearest: a fraction unit (~0.23 ns) is finer than a nanosecond
+    nanos = (ntp_fraction * NS_PER_SEC + (1 << 31)) >> 32
+    return (ntp_seconds - NTP_EPOCH_OFFSET) * NS_PER_SEC + nanos
+
+def ns_to_ntp(ns_timestamp: int) -> bytes:
+    """Encode Unix nanoseconds as an 8-byte NTP timestamp"""
+    return NTP_TIMESTAMP.pack(*ns_to_ntp_parts(ns_timestamp))
+
+def ntp_to_ns(value) -> int:
+    """Decode an 8-byte NTP timestamp to Unix nanoseconds"""
+    return ntp_parts_to_ns(*NTP_TIMESTAMP.unpack(value))
+
+class TSQError(ValueError):
+    """A response carried an Error TLV (249)"""
+
+    def __init__(self, code: int, reason: str):
+        super().__init__(f"server error {code}: {reason}" if reason else f"server error {code}")
+        self.code = code
+        self.reason = reason
+
+def tlv_pack(t: int, v: bytes) -> bytes:
+    """Pack a TLV with 1-byte length field."""
+    if len(v) > 255:
+        raise ValueError("TLV value too long (max 255 bytes)")
+    return TLV_HEADER.pack(t, len(v)) + v
+
+def iter_tlvs(data):
+    """Yield (type, value) for each known TLV in a message, without copying.
+
+    Values are memoryview slices of data. Unknown types are skipped. Raises
+    ValueError on truncation, bad lengths, or order violations: Nonce must come
+    first, Padding only before Signature, Signature last, Error only with Signature.
+    """
+    view = memoryview(data)
+    end = len(view)
+    offset = 0
+    prev = None
+    seen_error = False
+    while offset < end:
+        if offset + 2 > end:
+            raise ValueError("TLV too short")
+        t = view[offset]
+        l = view[offset + 1]
+        start = offset + 2
+        offset = start + l
+        if offset > end:
+            raise ValueError("TLV length mismatch")
+        if prev is None and t != T_NONCE and t != T_ERROR:
+            raise ValueError("Missing nonce")
+        if prev == T_SIGNATURE:
+            raise ValueError("TLV after Signature Block")
+        if prev == T_PADDING and t != T_PADDING and t != T_SIGNATURE:
+            raise ValueError("TLV after Padding")
+        if t not in KNOWN_TLV_TYPES:
+            prev = t
+            continue
+        if (seen_error and t != T_SIGNATURE) or (t == T_ERROR and prev is not None):
+            raise ValueError("Error TLV must appear alone")
+        if t == T_NONCE and prev is not None:
+            raise ValueError("Duplicate nonce")
+        fixed = TLV_FIXED_LENGTHS.get(t)
+        if fixed is not None and l != fixed:
+            raise ValueError(f"Bad length {l} for TLV {t}")
+        if l < TLV_MIN_LENGTHS.get(t, 0):
+            raise ValueError(f"TLV {t} too short")
+        value = view[start:offset]
+        if t == T_PADDING and any(value):
+            raise ValueError("Non-zero padding")
+        seen_error = seen_error or t == T_ERROR
+        prev = t
+        yield t, value
+
+def parse_tlvs(data) -> list:
+    """Parse all known TLVs from data. Returns list of (type, memoryview) tuples."""
+    return list(iter_tlvs(data))
+
+def encode_metadata(pairs: dict) -> bytes:
+    """Build a canonical Metadata TLV (253): key/value pairs sorted by UTF-8 key bytes"""
+    items = sorted((k.encode(), v.encode()) for k, v in pairs.items())
+    value = b"".join(bytes([len(k)]) + k + bytes([len(v)]) + v for k, v in items)
+    return tlv_pack(T_METADATA, value)
+
+def decode_metadata(value) -> dict:
+    """Decode a Metadata TLV value into a dict of strings"""
+    pairs = {}
+    offset = 0
+    end = len(value)
+    while offset < end:
+        fields = []
+        for _ in range(2):
+            if offset >= end or offset + 1 + value[offset] > end:
+                raise ValueError("Truncated metadata")
+            fields.append(bytes(value[offset + 1:offset + 1 + value[offset]]).decode("utf-8", "replace"))
+            offset += 1 + value[offset]
+        pairs[fields[0]] = fields[1]
+    return pairs
+
+def encode_error(code: int, reason: str = "") -> bytes:
+    """Build an Error TLV (249)"""
+    return tlv_pack(T_ERROR, bytes((code, 0)) + reason.encode()[:253])
+
+def decode_error(value) -> TSQError:
+    """Decode an Error TLV value"""
+    return TSQError(value[0], bytes(value[2:]).decode("utf-8", "replace"))
+
+def encode_clock_quality(clock_class: int, error_us: int, drift_ppb: int, tag: str = "") -> bytes:
+    """Build a Clock Quality TLV (248); error and drift saturate at 65535"""
+    value = CLOCK_QUALITY.pack(clock_class, 0, min(max(error_us, 0), 0xFFFF), min(max(drift_ppb, 0), 0xFFFF))
+    return tlv_pack(T_CLOCK_QUALITY, value + tag.encode()[:255 - CLOCK_QUALITY.size])
+
+def encode_time_source(stratum: int, source_type: int, info: str = "") -> bytes:
+    """Build a Time Source Info TLV (251)"""
+    return tlv_pack(T_TIME_SOURCE, bytes((stratum, source_type)) + info.encode()[:253])
+
+def decode_clock_quality(value):
+    """Decode a Clock Quality value. Returns (class, error_us, drift_ppb, tag)."""
+    clock_class, _, error_us, drift_ppb = CLOCK_QUALITY.unpack_from(value)
+    return clock_class, error_us, drift_ppb, bytes(value[CLOCK_QUALITY.size:]).decode("utf-8", "replace")
+
+def decode_time_source(value):
+    """Decode a Time Source Info value. Returns (stratum, source_type, info)."""
+    return value[0], value[1], bytes(value[2:]).decode("utf-8", "replace")
+
+def encode_request(nonce: bytes, flags=()) -> bytes:
+    """Build a request message: the Nonce TLV, then any zero-length flag TLVs (247, 250, 252)"""
+    request = REQUEST.pack(T_NONCE, NONCE_LEN, nonce)
+    for t in sorted(flags):
+        request += TLV_HEADER.pack(t, 0)
+    return request
+
+def decode_request(message):
+    """Return (nonce, flags) of a request message.
+
+    flags is the set of zero-length request TLVs present (247, 250, 252).
+    Raises ValueError if the message is malformed or has no 16-byte nonce.
+    """
+    if len(message) == REQUEST.size:
+        t, l, nonce = REQUEST.unpack(message)
+        if t != T_NONCE or l != NONCE_LEN:
+            raise ValueError("Missing nonce")
+        return nonce, ()
+    nonce = None
+    flags = set()
+    for t, v in iter_tlvs(message):
+        if t == T_NONCE:
+            nonce = bytes(v)
+        elif t in REQUEST_FLAGS:
+            flags.add(t)
+    if nonce is None:
+        raise ValueError("Missing nonce")
+    return nonce, flags
+
+class ResponseEncoder:
+    """Preallocated Nonce/T2/T3 response that is refilled in place for each request.
+
+    encode() returns a view of the shared buffer, valid until the next call;
+    callers that keep the response beyond that (e.g. queued datagrams) must copy it.
+    TLVs set with set_tail() follow the timestamps in every response at no
+    per-request cost.
+    """
+
+    def __init__(self, tail: bytes = b""):
+        self.set_tail(tail)
+
+    def set_tail(self, tail: bytes):
+        """Replace the TLVs sent after T3 (the buffer from earlier calls is left alone)"""
+        self.buffer = bytearray(RESPONSE.size) + tail
+        self.view = memoryview(self.buffer)
+        self.size = len(self.buffer)
+
+    def encode(self, nonce: bytes, t2_ns: int, t3_ns: int) -> memoryview:
+        t2_seconds, t2_nanos = divmod(t2_ns, NS_PER_SEC)
+        t3_seconds, t3_nanos = divmod(t3_ns, NS_PER_SEC)
+        RESPONSE.pack_into(
+            self.buffer, 0,
+            T_NONCE, NONCE_LEN, nonce,
+            T_RECV_TS, 8, (t2_seconds + NTP_EPOCH_OFFSET) & 0xFFFFFFFF, (t2_nanos << 32) // NS_PER_SEC,
+            T_SEND_TS, 8, (t3_seconds + NTP_EPOCH_OFFSET) & 0xFFFFFFFF, (t3_nanos << 32) // NS_PER_SEC,
+        )
+        return self.view
+
+def decode_response(data):
+    """Parse a response. Returns (nonce, t2_ns, t3_ns, tlvs); missing fields are None.
+
+    tlvs maps each optional TLV type present to its value.
+    Raises TSQError for an Error TLV and ValueError for a malformed message.
+    """
+    if len(data) == RESPONSE.size:
+        (t1, l1, nonce, t2, l2, t2_seconds, t2_fraction,
+         t3, l3, t3_seconds, t3_fraction) = RESPONSE.unpack(data)
+        if (t1, l1, t2, l2, t3, l3) == (T_NONCE, NONCE_LEN, T_RECV_TS, 8, T_SEND_TS, 8):
+            return (nonce, ntp_parts_to_ns(t2_seconds, t2_fraction),
+                    ntp_parts_to_ns(t3_seconds, t3_fraction), {})
+
+    nonce = t2_ns = t3_ns = None
+    tlvs = {}
+    for t, v in iter_tlvs(data):
+        if t == T_NONCE:
+            nonce = bytes(v)
+        elif t == T_RECV_TS:
+            t2_ns = ntp_to_ns(v)
+        elif t == T_SEND_TS:
+            t3_ns = ntp_to_ns(v)
+        elif t == T_ERROR:
+            raise decode_error(v)
+        else:
+            tlvs[t] = v
+    return nonce, t2_ns, t3_ns, tlvs
@@ -0,0 +1,303 @@
+"""Counters, HDR-style histograms, phase spans, a Prometheus text endpoint, a batched log
+writer and a sampling profiler for TSQ"""
+import asyncio
+import collections
+import os
+import signal
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+# Log-linear buckets: 2**SUB_BITS sub-buckets per power of two, so any recorded
+# value is off by less than 1/16 (6.25%) from its bucket's upper bound
+SUB_BITS = 4
+SUB_COUNT = 1 << SUB_BITS
+
+# Prometheus "le" boundaries (seconds) exported for every histogram
+EXPORT_BOUNDS = tuple(m * 10.0 ** e for e in range(-7, 1) for m in (1, 2, 5))
+
+def bucket_index(value: int) -> int:
+    if value < SUB_COUNT:
+        return value
+    shift = value.bit_length() - SUB_BITS - 1
+    return (shift + 1) * SUB_COUNT + (value >> shift) - SUB_COUNT
+
+def bucket_upper(index: int) -> int:
+    """Largest value that falls into bucket index"""
+    if index < SUB_COUNT:
+        return index
+    shift = index // SUB_COUNT - 1
+    mantissa = index % SUB_COUNT + SUB_COUNT
+    return ((mantissa + 1) << shift) - 1
+
+class Histogram:
+    """HDR-style histogram of non-negative integers (e.g. nanoseconds); record() is O(1)"""
+
+    def __init__(self):
+        self.counts = [0] * (SUB_COUNT * 8)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def record(self, value: int):
+        if value < 0:
+            value = 0
+        index = bucket_index(value)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: "Histogram"):
+        self.merge_counts(other.counts)
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def to_dict(self) -> dict:
+        """JSON-serializable state, restored by from_dict()"""
+        last = max((i for i, n in enumerate(self.counts) if n), default=-1)
+        return {"counts": self.counts[:last + 1], "count": self.count, "sum": self.sum, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, state: dict) -> "Histogram":
+        hist = cls()
+        hist.merge_counts(state["counts"])
+        hist.count, hist.sum, hist.max = state["count"], state["sum"], state["max"]
+        return hist
+
+    def merge_counts(self, counts):
+        if len(counts) > len(self.counts):
+            self.counts.extend([0] * (len(counts) - len(self.counts)))
+        for i, n in enumerate(counts):
+            self.counts[i] += n
+
+    def percentile(self, q: float) -> int:
+        """Upper bound of the bucket holding the q-th percentile (0-100)"""
+        if self.count == 0:
+            return 0
+        target = max(1, -(-self.count * q // 100))
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return min(bucket_upper(i), self.max)
+        return self.max
+
+    def prometheus(self, name: str, help_text: str, scale: float = 1e-9, labels: str = "") -> list:
+        """Prometheus histogram lines; scale converts recorded units to the exported unit"""
+        lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        sep = "," if labels else ""
+        cumulative = 0
+        index = 0
+        for bound in EXPORT_BOUNDS:
+            limit = bound / scale
+            while index < len(self.counts) and bucket_upper(index) <= limit:
+                cumulative += self.counts[index]
+                index += 1
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{bound:g}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {self.sum * scale:.9g}")
+        lines.append(f"{name}_count{suffix} {self.count}")
+        return lines
+
+class PhaseSpans:
+    """Duration histograms for the phases of a hot path, fed from perf_counter_ns().
+
+    end() reads the clock once and returns it, so consecutive phases chain:
+    t = spans.end("decode", t) closes one phase and opens the next.
+    """
+
+    def __init__(self):
+        self.phases = {}   # phase -> Histogram of nanoseconds, in first-seen order
+
+    def record(self, phase: str, ns: int):
+        hist = self.phases.get(phase)
+        if hist is None:
+            hist = self.phases[phase] = Histogram()
+        hist.record(ns)
+
+    def end(self, phase: str, start_ns: int) -> int:
+        now = time.perf_counter_ns()
+        hist = self.phases.get(phase)
+        if hist is None:
+            hist = self.phases[phase] = Histogram()
+        hist.record(now - start_ns)
+        return now
+
+    def report(self) -> list:
+        """One line per phase: count and percentiles in microseconds"""
+        lines = []
+        for phase, hist in self.phases.items():
+            if hist.count:
+                lines.append(
+                    f"{phase:<12} n={hist.count} mean={hist.sum / hist.count / 1e3:.1f}us "
+                    f"p50={hist.percentile(50) / 1e3:.1f}us p90={hist.percentile(90) / 1e3:.1f}us "
+                    f"p99={hist.percentile(99) / 1e3:.1f}us max={hist.max / 1e3:.1f}us"
+                )
+        return lines
+
+def rss_bytes() -> int:
+    """Current resident set size (Linux), else the peak RSS"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+def format_value(value) -> str:
+    return str(value) if isinstance(value, int) else f"{value:.9g}"
+
+def prometheus_metric(name: str, kind: str, help_text: str, values) -> list:
+    """Lines for a counter or gauge; values is a number or a {label string: number} dict"""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    if isinstance(values, dict):
+        lines.extend(f"{name}{{{labels}}} {format_value(value)}" for labels, value in values.items())
+    else:
+        lines.append(f"{name} {format_value(values)}")
+    return lines
+
+async def serve_metrics(host: str, port: int, render):
+    """Serve render() (a list of lines) as Prometheus text on GET /metrics"""
+
+    async def handle(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5.0)
+            path = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b""
+            if path.split(b"?")[0] == b"/metrics":
+                status, body = "200 OK", ("\n".join(render()) + "\n").encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+class LogWriter:
+    """Collects log lines without blocking and writes them in batches from a thread.
+
+    log() only appends (wall-clock time, text) to a deque; timestamp formatting
+    and the write to stdout happen on the writer thread every flush_interval.
+    """
+
+    def __init__(self, prefix: str = "[TSQ-LOG]", flush_interval: float = 0.25, stream=None):
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self.stream = stream or sys.stdout
+        self.pending = collections.deque()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="tsq-log", daemon=True)
+        self._thread.start()
+
+    def log(self, text: str):
+        self.pending.append((time.time(), text))
+
+    def _format(self, when: float, text: str) -> str:
+        timestamp = datetime.fromtimestamp(when, timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+        return f"{self.prefix} {timestamp} UTC {text}\n"
+
+    def flush(self):
+        lines = []
+        while self.pending:
+            lines.append(self._format(*self.pending.popleft()))
+        if lines:
+            self.stream.write("".join(lines))
+            self.stream.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+
+def add_sigusr1_handler(loop, callback, *args) -> bool:
+    """Call callback(*args) on SIGUSR1; False where the platform or event loop has
+    no SIGUSR1 (Windows)"""
+    if not hasattr(signal, "SIGUSR1"):
+        return False
+    try:
+        loop.add_signal_handler(signal.SIGUSR1, callback, *args)
+    except NotImplementedError:
+        return False
+    return True
+
+class SamplingProfiler:
+    """Samples one thread's Python stack from a background thread and writes the
+    counts as folded stacks ("outer;inner count" per line), the input format of
+    flamegraph.pl, inferno and speedscope.
+
+    The sampler needs the GIL, so while the sampled thread is busy samples land
+    at most every sys.getswitchinterval() (5ms); time blocked in select() or a
+    system call is sampled at the full rate and shows up as those frames.
+    """
+
+    def __init__(self, path: str, interval: float = 0.001, thread_id: int = None):
+        self.path = path
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.counts = collections.Counter()   # tuple of code objects, outermost first -> samples
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="tsq-profile", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        counts = self.counts
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            if stack:
+                stack.reverse()
+                counts[tuple(stack)] += 1
+                self.samples += 1
+
+    @staticmethod
+    def label(code) -> str:
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def write(self) -> int:
+        """Write the samples so far (atomically); returns the number of stacks written"""
+        labels = {}
+        folded = collections.Counter()
+        for stack, count in list(self.counts.items()):
+            names = []
+            for code in stack:
+                name = labels.get(code)
+                if name is None:
+                    name = labels[code] = self.label(code).replace(";", ":")
+                names.append(name)
+            folded[";".join(names)] += count
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in sorted(folded.items()))
+        os.replace(tmp, self.path)
+        return len(folded)
+
+    def stop(self):
+        """Stop sampling; write() still has the samples"""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
@@ -0,0 +1,172 @@
+"""Bounded-memory replay cache for TSQ request nonces"""
+import math
+import multiprocessing
+import os
+import threading
+import time
+
+# Split block Bloom filter: a nonce maps to one 256-bit block and sets one bit
+# in each of its eight 32-bit words. The two generations of a block share one
+# 64-byte cache line (low half: generation 0, high half: generation 1), so a
+# lookup in both plus the insert is one read and one write.
+BLOCK_BITS = 256
+HALF_BYTES = BLOCK_BITS // 8
+LINE_BYTES = 2 * HALF_BYTES
+# Filter bits per nonce at capacity; the block count is rounded up to a power of two
+BITS_PER_NONCE = 32
+# Odd 128-bit multiplier (golden ratio) for mixing the salted nonce
+MIX = 0x9E3779B97F4A7C15F39CC0605CEDC835
+MASK_128 = (1 << 128) - 1
+HALF_MASK = (1 << BLOCK_BITS) - 1
+
+# MASK_j[v]: bits for words 2j and 2j+1 of a block from a 10-bit hash slice v
+MASK_0, MASK_1, MASK_2, MASK_3 = (
+    tuple((1 << (64 * j + (v & 31))) | (1 << (64 * j + 32 + (v >> 5))) for v in range(1024))
+    for j in range(4)
+)
+# The 64-bit hash picks the block with its low bits and the mask with the next 40
+MAX_BLOCKS = 1 << 24
+
+# Rotation clears this many blocks (256 KB of lines) at a time, then yields the
+# GIL for CLEAR_PAUSE seconds so request handling is delayed by well under 1 ms
+CLEAR_CHUNK = 4096
+CLEAR_PAUSE = 0.001
+
+def false_positive_rate(bits_per_nonce: float) -> float:
+    """Expected false positive rate of one generation holding BLOCK_BITS/bits_per_nonce
+    nonces per block on average (Poisson block loads, 8 bits per nonce)"""
+    if bits_per_nonce <= 0:
+        return 1.0
+    load = BLOCK_BITS / bits_per_nonce
+    rate = 0.0
+    for j in range(1, int(load * 4 + 40)):
+        weight = math.exp(j * math.log(load) - load - math.lgamma(j + 1))
+        rate += weight * (1 - (31 / 32) ** j) ** 8
+    return rate
+
+def block_count(capacity: int) -> int:
+    """Blocks per generation for capacity nonces; raises ValueError past MAX_BLOCKS"""
+    blocks = 1 << max(1, math.ceil(math.log2(max(capacity, 1) * BITS_PER_NONCE / BLOCK_BITS)))
+    if blocks > MAX_BLOCKS:
+        raise ValueError(f"capacity too large (max {MAX_BLOCKS * BLOCK_BITS // BITS_PER_NONCE})")
+    return blocks
+
+class ReplayCache:
+    """Remembers request nonces for at least window seconds in fixed memory.
+
+    Two Bloom filter generations take turns: nonces are looked up in both and
+    added to the current one. A background thread (start()) rotates them: window
+    seconds after the last switch it clears the older one in small chunks, then
+    makes it current, so check() never clears anything itself and a nonce is
+    remembered for window to about 2*window seconds. Memory is 2 * 4 bytes per
+    nonce of capacity (nonces per window), rounded up to a power of two; past
+    capacity the false positive rate rises instead of memory growing. Pass
+    allocate()'s result as shared to let --workers processes check each other's
+    nonces; exactly one process (the parent) should then call start().
+    """
+
+    def __init__(self, window: float, capacity: int, shared=None):
+        self.window = window
+        self.blocks = block_count(capacity)
+        self.shift = self.blocks.bit_length() - 1
+        if shared is None:
+            shared = ReplayCache.allocate(capacity, lock=False)
+        self.shared = shared
+        buffer, self.header, self.lock, self.salt = shared
+        self.lines = memoryview(buffer).cast("B")
+        self.words = self.lines.cast("Q")
+        self.current = self.header[0]
+        # Nonces this process added to the current generation
+        self.added = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def allocate(capacity: int, lock=True):
+        """Filter memory for capacity nonces per window: (buffer, header, lock, salt).
+
+        Made of multiprocessing shared memory, so it can be handed to worker
+        processes; the header holds the current half (0 or 1). The lock
+        serializes inserts between processes.
+        """
+        buffer = multiprocessing.RawArray("B", block_count(capacity) * LINE_BYTES)
+        header = multiprocessing.RawArray("q", [0])
+        salt = int.from_bytes(os.urandom(16), "little")
+        return buffer, header, multiprocessing.Lock() if lock else None, salt
+
+    @property
+    def size(self) -> int:
+        """Filter memory in bytes"""
+        return len(self.lines)
+
+    def start(self):
+        """Rotate generations from a background thread until stop()"""
+        self._thread = threading.Thread(target=self._run, name="tsq-replay", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        # Waiting a full window after each switch keeps the half just retired
+        # (and its newest nonces) for at least window seconds
+        while not self._stop.wait(self.window):
+            self.rotate(CLEAR_PAUSE)
+
+    def rotate(self, pause: float = 0.0):
+        """Clear the half that is not current, CLEAR_CHUNK blocks at a time with
+        pause seconds between chunks, then make it current.
+
+        Lookups still read the half being cleared (its stale bits can only add
+        false positives), and inserts write only the current half, so nothing
+        here needs the lock.
+        """
+        stale = 1 - self.header[0]
+        zeros = memoryview(bytes(8 * CLEAR_CHUNK)).cast("Q")
+        words = self.words
+        for first in range(0, self.blocks, CLEAR_CHUNK):
+            last = min(first + CLEAR_CHUNK, self.blocks)
+            for word in range(4 * stale, 4 * stale + 4):
+                words[first * 8 + word:last * 8:8] = zeros[:last - first]
+            if pause:
+                time.sleep(pause)
+        self.header[0] = stale
+
+    def check(self, nonce: bytes) -> bool:
+        """Record nonce; True if it was already seen (or is a false positive)"""
+        h = ((int.from_bytes(nonce, "little") ^ self.salt) * MIX & MASK_128) >> 64
+        offset = (h & (self.blocks - 1)) * LINE_BYTES
+        h >>= self.shift
+        mask = MASK_0[h & 1023] | MASK_1[(h >> 10) & 1023] | MASK_2[(h >> 20) & 1023] | MASK_3[(h >> 30) & 1023]
+        line = int.from_bytes(self.lines[offset:offset + LINE_BYTES], "little")
+        high = mask << BLOCK_BITS
+        if line & mask == mask or line & high == high:
+            return True
+        current = self.header[0]
+        if current != self.current:
+            # Another process (or the rotation thread) switched generations
+            self.current = current
+            self.added = 0
+        if self.lock is None:
+            offset += current * HALF_BYTES
+            half = line >> (current * BLOCK_BITS) & HALF_MASK
+            self.lines[offset:offset + HALF_BYTES] = (half | mask).to_bytes(HALF_BYTES, "little")
+            self.added += 1
+            return False
+        offset += current * HALF_BYTES
+        # Re-read under the lock so workers inserting into the same block at
+        # once neither lose each other's bits nor both accept one nonce
+        with self.lock:
+            return self._insert(offset, mask)
+
+    def _insert(self, offset: int, mask: int) -> bool:
+        end = offset + HALF_BYTES
+        half = int.from_bytes(self.lines[offset:end], "little")
+        if half & mask == mask:
+            return True
+        self.lines[offset:end] = (half | mask).to_bytes(HALF_BYTES, "little")
+        self.added += 1
+        return False
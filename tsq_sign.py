@@ -0,0 +1,175 @@
+"""Signature Block (TLV 255) signing and verification shared by the TSQ server and client"""
+import asyncio
+import hashlib
+import hmac
+from concurrent.futures import ThreadPoolExecutor
+
+from tsq_codec import SIGNATURE_HEADER, T_SIGNATURE, TLV_HEADER, iter_tlvs
+
+# Signature Algorithm IDs (draft section 8)
+ALG_ED25519 = 0x01
+ALG_HMAC_SHA256 = 0x02
+ALG_NAMES = {ALG_ED25519: "Ed25519", ALG_HMAC_SHA256: "HMAC-SHA256"}
+SIGNATURE_SIZES = {ALG_ED25519: 64, ALG_HMAC_SHA256: 32}
+
+def key_id(material: bytes) -> int:
+    """Key ID: first 4 bytes of SHA-256 over the HMAC secret or raw Ed25519 public key"""
+    return int.from_bytes(hashlib.sha256(material).digest()[:4], "big")
+
+def load_hmac_key(path: str) -> bytes:
+    """Read a shared HMAC secret (surrounding whitespace is ignored)"""
+    with open(path, "rb") as f:
+        secret = f.read().strip()
+    if len(secret) < 16:
+        raise ValueError(f"HMAC key in {path} is too short (min 16 bytes)")
+    return secret
+
+def load_ed25519_private_key(path: str):
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+    from cryptography.hazmat.primitives.serialization import load_pem_private_key
+    with open(path, "rb") as f:
+        key = load_pem_private_key(f.read(), password=None)
+    if not isinstance(key, Ed25519PrivateKey):
+        raise ValueError(f"{path} is not an Ed25519 private key")
+    return key
+
+def load_ed25519_public_key(path: str):
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+    from cryptography.hazmat.primitives.serialization import load_pem_public_key
+    with open(path, "rb") as f:
+        key = load_pem_public_key(f.read())
+    if not isinstance(key, Ed25519PublicKey):
+        raise ValueError(f"{path} is not an Ed25519 public key")
+    return key
+
+def raw_public_bytes(public_key) -> bytes:
+    from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+    return public_key.public_bytes(Encoding.Raw, PublicFormat.Raw)
+
+class ResponseSigner:
+    """Appends a Signature Block to responses.
+
+    HMAC-SHA256 takes about a microsecond and is computed inline. Ed25519 costs
+    tens of microseconds, so responses waiting in the same loop iteration are
+    signed together as one batch on a worker thread.
+    """
+
+    def __init__(self, alg: int, key, key_id_value: int):
+        self.alg = alg
+        self.key = key
+        self.key_id = key_id_value
+        sig_len = SIGNATURE_SIZES[alg]
+        self.tlv_size = TLV_HEADER.size + SIGNATURE_HEADER.size + sig_len
+        self._prefix = (TLV_HEADER.pack(T_SIGNATURE, SIGNATURE_HEADER.size + sig_len)
+                        + SIGNATURE_HEADER.pack(alg, key_id_value, sig_len))
+        self._pending = []
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="tsq-sign") if alg == ALG_ED25519 else None
+        self.signed = 0
+        self.batches = 0
+
+    @classmethod
+    def from_files(cls, hmac_key_path=None, ed25519_key_path=None):
+        if hmac_key_path:
+            secret = load_hmac_key(hmac_key_path)
+            return cls(ALG_HMAC_SHA256, secret, key_id(secret))
+        key = load_ed25519_private_key(ed25519_key_path)
+        return cls(ALG_ED25519, key, key_id(raw_public_bytes(key.public_key())))
+
+    @property
+    def inline(self) -> bool:
+        """True when sign_now() is cheap enough to call on the event loop"""
+        return self._executor is None
+
+    @property
+    def description(self) -> str:
+        return f"{ALG_NAMES[self.alg]} key_id={self.key_id:08x}"
+
+    def sign_now(self, data: bytes) -> bytes:
+        """Return data followed by its Signature Block"""
+        if self.alg == ALG_HMAC_SHA256:
+            signature = hmac.digest(self.key, data, "sha256")
+        else:
+            signature = self.key.sign(data)
+        self.signed += 1
+        return data + self._prefix + signature
+
+    def _sign_batch(self, batch):
+        return [self.sign_now(data) for data in batch]
+
+    async def sign(self, data: bytes) -> bytes:
+        if self._executor is None:
+            return self.sign_now(data)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((data, future))
+        if len(self._pending) == 1:
+            loop.call_soon(self._flush, loop)
+        return await future
+
+    def _flush(self, loop):
+        batch, self._pending = self._pending, []
+        self.batches += 1
+        job = loop.run_in_executor(self._executor, self._sign_batch, [data for data, _ in batch])
+
+        def deliver(job):
+            if job.cancelled():
+                exc = asyncio.CancelledError()
+            else:
+                exc = job.exception()
+            for i, (_, future) in enumerate(batch):
+                if future.done():
+                    continue
+                if exc is not None:
+                    future.set_exception(exc)
+                else:
+                    future.set_result(job.result()[i])
+
+        job.add_done_callback(deliver)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+class ResponseVerifier:
+    """Checks the Signature Block of responses against provisioned keys"""
+
+    def __init__(self):
+        self.keys = {}  # key_id -> (alg, key)
+
+    @classmethod
+    def from_files(cls, hmac_key_paths=(), ed25519_key_paths=()):
+        verifier = cls()
+        for path in hmac_key_paths:
+            secret = load_hmac_key(path)
+            verifier.keys[key_id(secret)] = (ALG_HMAC_SHA256, secret)
+        for path in ed25519_key_paths:
+            public_key = load_ed25519_public_key(path)
+            verifier.keys[key_id(raw_public_bytes(public_key))] = (ALG_ED25519, public_key)
+        return verifier
+
+    def verify(self, data):
+        """Raise ValueError unless data ends in a valid Signature Block from a known key"""
+        value = None
+        for t, v in iter_tlvs(data):
+            if t == T_SIGNATURE:
+                value = v
+        if value is None:
+            raise ValueError("response is not signed")
+        alg, kid, sig_len = SIGNATURE_HEADER.unpack_from(value)
+        signature = bytes(value[SIGNATURE_HEADER.size:])
+        if sig_len != len(signature):
+            raise ValueError("signature length mismatch")
+        if kid not in self.keys or self.keys[kid][0] != alg:
+            raise ValueError(f"unknown signing key {kid:08x} ({ALG_NAMES.get(alg, alg)})")
+        key = self.keys[kid][1]
+        # Signed data: every TLV before the Signature Block, exactly as received
+        signed = bytes(data[:len(data) - TLV_HEADER.size - len(value)])
+        if alg == ALG_HMAC_SHA256:
+            if not hmac.compare_digest(hmac.digest(key, signed, "sha256"), signature):
+                raise ValueError("bad HMAC-SHA256 signature")
+        else:
+            from cryptography.exceptions import InvalidSignature
+            try:
+                key.verify(signature, signed)
+            except InvalidSignature:
+                raise ValueError("bad Ed25519 signature") from None